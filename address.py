@@ -1,19 +1,51 @@
 #! /usr/bin/env python3
 
 from ecdsa import SigningKey, VerifyingKey, BadSignatureError
+from ecdsa.ellipticcurve import PointJacobi
 from ecdsa.util import randrange_from_seed__trytryagain
 import os
-from config import CURVE
+import functools
+from config import CURVE, VERIFYING_KEY_CACHE
+from metrics import REGISTRY
 # from transaction import Transaction
 
+VERIFICATION_SECONDS = REGISTRY.histogram(
+    "signature_verification_seconds", "Time to verify a signature")
+
+class _VerifyingKey(object):
+    """The verifying key of an address. Once the address is used again,
+    the multiples of its point are precomputed, which makes verification
+    several times faster but costs more than a single verification."""
+    def __init__(self, address):
+        self.key = VerifyingKey.from_string(bytes.fromhex(address),
+                                            curve=CURVE)
+        self.uses = 0
+
+    def get(self):
+        self.uses += 1
+        if self.uses == 2:
+            point = self.key.pubkey.point.to_affine()
+            key = VerifyingKey.from_public_point(
+                PointJacobi(CURVE.curve, point.x(), point.y(), 1,
+                            CURVE.order, generator=True), curve=CURVE)
+            key.precompute()
+            self.key = key # replaced at once: other threads may use it
+        return self.key
+
+@functools.lru_cache(maxsize=VERIFYING_KEY_CACHE)
+def _verifying_key(address):
+    return _VerifyingKey(address)
+
 # address and signature are in hex format
 def verify_signature(msg, signature, address):
     """Verify a signed message using a (public) address in hex format."""
-    verifying_key = VerifyingKey.from_string(bytes.fromhex(address), curve=CURVE)
-    try:
-        return verifying_key.verify(bytes.fromhex(signature), msg.encode("utf-8"))
-    except BadSignatureError:
-        return False
+    with VERIFICATION_SECONDS.time():
+        verifying_key = _verifying_key(address).get()
+        try:
+            return verifying_key.verify(bytes.fromhex(signature),
+                                        msg.encode("utf-8"))
+        except BadSignatureError:
+            return False
 
 def could_be_valid_address(s):
     """Returns whether the string could represent a valid address:
@@ -0,0 +1,52 @@
+#! /usr/bin/env python3
+
+"""Generators of synthetic data for the benchmarks: addresses, signed
+transactions between them, blockchains of blocks with such transactions
+(mined at difficulty 0) and mempools filled with them. The transactions are
+small compared to the balances, so all of them are valid.
+"""
+
+import os
+import sys
+import random
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from address import Address
+from transaction import Transaction, TransactionBundle, TransactionBlockChain
+from mempool import Database, migrate, insert
+
+def addresses(n):
+    """n Addresses, the same ones every time"""
+    return [Address(seed="benchmark %d" % i) for i in range(n)]
+
+def transactions(keys, n, rng=random):
+    """n signed transactions between random pairs of the addresses, with
+    random small amounts and fees"""
+    txs = []
+    for i in range(n):
+        sender, receiver = rng.sample(keys, 2)
+        tx = Transaction(sender.address, receiver.address,
+                         round(rng.uniform(0.0001, 0.001), 6),
+                         round(rng.uniform(0, 0.0001), 6), "tx %d" % i)
+        tx.sign(sender)
+        txs.append(tx)
+    return txs
+
+def blockchain(n_blocks, txs_per_block, keys, rng=random):
+    """A TransactionBlockChain of n_blocks blocks with txs_per_block
+    transactions each, mined by the addresses in turn at difficulty 0"""
+    chain = TransactionBlockChain()
+    for i in range(n_blocks):
+        bundle = TransactionBundle("block %d" % i, keys[i % len(keys)].address,
+                                   transactions(keys, txs_per_block, rng))
+        chain.append(chain.mine(bundle.as_json(), 0))
+    return chain
+
+def mempool(path, txs):
+    """A transaction database at path with the transactions unprocessed"""
+    database = Database(path)
+    migrate(database.connection)
+    for tx in txs:
+        insert(tx, database.connection, commit=False)
+    database.connection.commit()
+    return database
@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+
+"""Microbenchmarks of the state shared between the processes of a node:
+sharedstate.SharedDict against the multiprocessing.Manager dictionaries it
+replaces. Times the operations done by the miner and the web server (the
+running flag checked in every iteration of the miner, lookups and listings
+of the peers, registering a peer) in microseconds per operation, in the
+process that created the dictionaries and in a forked one.
+
+Usage: python benchmark/shared_state.py [-n <operations>] [-p <peers>]
+"""
+
+import os
+import sys
+import time
+import getopt
+from multiprocessing import Manager, Pipe, Process
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from sharedstate import SharedDict
+
+def per_operation(f, n):
+    """The time in microseconds per call of f, called n times"""
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter() - start) / n * 1e6
+
+def measure(flags, peers, n):
+    """A dictionary of the time per operation of each kind"""
+    peer = next(iter(peers.keys()))
+    return {
+        "flag read": per_operation(lambda: flags["running"], n),
+        "peer lookup": per_operation(lambda: peer in peers, n),
+        "peer list": per_operation(lambda: list(peers.keys()), n),
+        "peer write": per_operation(
+            lambda: peers.__setitem__(peer, time.time()), n // 10),
+    }
+
+def measure_in_child(flags, peers, n, connection):
+    connection.send(measure(flags, peers, n))
+    connection.close()
+
+def run(name, flags, peers, n, npeers):
+    flags["running"] = True
+    for i in range(npeers):
+        peers["peer%d.example.com:%d" % (i, 5000 + i)] = time.time()
+    results = {"same process": measure(flags, peers, n)}
+    receiver, sender = Pipe(duplex=False)
+    child = Process(target=measure_in_child, args=(flags, peers, n, sender))
+    child.start()
+    results["forked process"] = receiver.recv()
+    child.join()
+    for where, timings in results.items():
+        for operation, us in timings.items():
+            print("%-14s %-15s %-12s %10.2f us" % (name, where, operation, us))
+
+if __name__ == "__main__":
+    opt, _ = getopt.getopt(sys.argv[1:], "n:p:")
+    opt = dict(opt)
+    n = int(opt.get("-n", 10000))
+    npeers = int(opt.get("-p", 50))
+    manager = Manager()
+    run("Manager.dict", manager.dict(), manager.dict(), n, npeers)
+    run("SharedDict", SharedDict(4096), SharedDict(1 << 16), n, npeers)
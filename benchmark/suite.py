@@ -0,0 +1,263 @@
+#! /usr/bin/env python3
+
+"""Benchmarks of the hot paths of a node, on synthetic data (see
+generate.py): mining, saving and loading, validating and replaying a
+blockchain, verifying signatures, accepting transactions through /pushtx
+and in batches through /pushtxs, assembling the data of the next block, and syncing a blockchain from a
+node over localhost.
+
+Every benchmark reports one or more metrics. Those ending in _per_s are
+rates (higher is better), the others times in seconds (lower is better);
+each is the best of a number of repetitions. The results can be written to
+a json file and compared to such a file from an earlier run (the baseline):
+metrics that got worse by more than the threshold are reported as
+regressions, and the exit status is 1 if there are any.
+
+Usage: python benchmark/suite.py [-s <scale>] [-r <repetitions>]
+           [-b <benchmark>[,<benchmark>...]] [-o <results.json>]
+           [-c <baseline.json>] [-t <threshold>]
+
+-s  multiplies the sizes of the data (default 1)
+-r  repetitions of every measurement (default 3)
+-b  only run these benchmarks
+-o  write the results to this json file
+-c  compare the results to those in this json file
+-t  relative change that counts as a regression (default 0.1)
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import random
+import tempfile
+import datetime
+import platform
+import logging
+import threading
+from collections import OrderedDict
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import generate
+import node as nodemodule
+import transactionnode
+from node import node, Synchronizer
+from transaction import TransactionBundle, TransactionBlockChain
+from address import verify_signature
+from util import port_is_free
+from werkzeug.serving import make_server
+
+def best_of(f, repetitions, setup=None):
+    """The shortest time in seconds of repetitions calls of f, each after a
+    call of setup (not timed) if given, whose result is passed to f"""
+    times = []
+    for _ in range(repetitions):
+        arguments = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        f(*arguments)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench_mine(scale, repetitions):
+    """Hashes per second of BlockChain.mine, at a difficulty that is never
+    met"""
+    chain = TransactionBlockChain()
+    keys = generate.addresses(20)
+    data = TransactionBundle("mine", keys[0].address,
+                             generate.transactions(keys, 5)).as_json()
+    intents = 50 * scale
+    seconds = best_of(lambda: chain.mine(data, 64, intents=intents),
+                      repetitions)
+    return {"hashes_per_s": intents / seconds}
+
+def bench_storage(scale, repetitions):
+    """Saving a blockchain (all blocks new) and loading it"""
+    chain = generate.blockchain(100 * scale, 5, generate.addresses(20))
+    with tempfile.TemporaryDirectory() as data_dir:
+        save = best_of(lambda chain: chain.save(data_dir), repetitions,
+                       setup=lambda: TransactionBlockChain(chain.blocks))
+        load = best_of(lambda: TransactionBlockChain.load(data_dir),
+                       repetitions)
+    return {"save_s": save, "load_s": load}
+
+def bench_validation(scale, repetitions):
+    """BlockChain.is_valid and TransactionBlockChain.get_balances"""
+    chain = generate.blockchain(100 * scale, 5, generate.addresses(20))
+    return {"is_valid_s": best_of(lambda: chain.is_valid(0), repetitions),
+            "get_balances_s": best_of(chain.get_balances, repetitions)}
+
+def bench_signatures(scale, repetitions):
+    """Verifications of signatures of transactions per second"""
+    txs = generate.transactions(generate.addresses(20), 100 * scale)
+    def verify():
+        for tx in txs:
+            assert verify_signature(tx.header(), tx.signature, tx.from_addr)
+    return {"verify_per_s": len(txs) / best_of(verify, repetitions)}
+
+def bench_pushtx(scale, repetitions):
+    """Transactions per second accepted through /pushtx"""
+    txs = generate.transactions(generate.addresses(20), 100 * scale)
+    client = node.test_client()
+    with tempfile.TemporaryDirectory() as directory:
+        def setup():
+            path = tempfile.mktemp(dir=directory)
+            transactionnode.database = generate.mempool(path, [])
+        def push(_):
+            for tx in txs:
+                response = client.put("/pushtx", json=tx.as_json())
+                assert response.data.startswith(b"received")
+        seconds = best_of(push, repetitions, setup)
+    return {"pushtx_per_s": len(txs) / seconds}
+
+def bench_pushtxs(scale, repetitions, batch_size=100):
+    """Transactions per second accepted through /pushtxs, in batches"""
+    txs = generate.transactions(generate.addresses(20), 100 * scale)
+    client = node.test_client()
+    with tempfile.TemporaryDirectory() as directory:
+        def setup():
+            path = tempfile.mktemp(dir=directory)
+            transactionnode.database = generate.mempool(path, [])
+        def push(_):
+            for i in range(0, len(txs), batch_size):
+                response = client.put("/pushtxs", json=[
+                    tx.__dict__ for tx in txs[i:i + batch_size]])
+                assert all(result.startswith("received")
+                           for result in response.get_json())
+        seconds = best_of(push, repetitions, setup)
+    return {"pushtxs_per_s": len(txs) / seconds}
+
+def bench_next_block_data(scale, repetitions):
+    """TransactionSynchronizer.next_block_data with a full mempool, on a new
+    tip and when nothing changed"""
+    keys = generate.addresses(20)
+    chain = generate.blockchain(20, 5, keys)
+    txs = generate.transactions(keys, 500 * scale)
+    with tempfile.TemporaryDirectory() as directory:
+        database = generate.mempool(os.path.join(directory, "mempool.db"),
+                                    txs)
+        synchronizer = transactionnode.TransactionSynchronizer(
+            database, keys[0].address)
+        synchronizer.init("localhost", 0, {}, {})
+        synchronizer.update(chain)
+        def select():
+            synchronizer.selection = None # as on a new tip
+        seconds = best_of(lambda _: synchronizer.next_block_data(chain, {}),
+                          repetitions, setup=select)
+        # the selection is kept while the tip and the mempool don't change
+        cached = best_of(lambda: synchronizer.next_block_data(chain, {}),
+                         repetitions)
+    return {"next_block_data_s": seconds, "cached_s": cached}
+
+def free_port(port=5900):
+    while not port_is_free(port):
+        port += 1
+    return port
+
+def bench_sync(scale, repetitions):
+    """Syncing an empty blockchain with a node over localhost, that serves
+    a blockchain from a web server in a thread"""
+    chain = generate.blockchain(100 * scale, 5, generate.addresses(20))
+    port = free_port()
+    with tempfile.TemporaryDirectory() as data_dir:
+        # the node's data in a temporary directory, and the difficulty at
+        # which the synthetic blocks are mined
+        nodemodule.DATA_DIR = data_dir
+        nodemodule.DIFFICULTY = 0
+        chain.save(nodemodule.get_chaindata_dir(
+            port, TransactionBlockChain, create=True))
+        # as the miner publishes it, which doesn't run here
+        nodemodule.shared_dict["chainwork"] = {
+            "length": len(chain), "work": chain.work(0)}
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("localhost", port, node, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        def setup():
+            synchronizer = Synchronizer()
+            synchronizer.chainclass = TransactionBlockChain
+            synchronizer.init("localhost", free_port(port + 1), {}, {})
+            return synchronizer
+        def sync(synchronizer):
+            synced = synchronizer.get_longest_blockchain(
+                TransactionBlockChain(), {"localhost:%d" % port: 0})
+            assert len(synced) == len(chain)
+        try:
+            seconds = best_of(sync, repetitions, setup)
+        finally:
+            server.shutdown()
+    return {"sync_s": seconds, "sync_blocks_per_s": len(chain) / seconds}
+
+BENCHMARKS = OrderedDict([
+    ("mine", bench_mine),
+    ("storage", bench_storage),
+    ("validation", bench_validation),
+    ("signatures", bench_signatures),
+    ("pushtx", bench_pushtx),
+    ("pushtxs", bench_pushtxs),
+    ("next_block_data", bench_next_block_data),
+    ("sync", bench_sync),
+])
+
+def run(names, scale, repetitions):
+    """The results of the benchmarks as a dictionary {benchmark: {metric:
+    value}}, printing them as they become available"""
+    results = OrderedDict()
+    for name in names:
+        results[name] = BENCHMARKS[name](scale, repetitions)
+        for metric, value in results[name].items():
+            print("%-16s %-20s %14.6g" % (name, metric, value))
+    return results
+
+def compare(results, baseline, threshold):
+    """Prints the relative change of every metric compared to the
+    baseline, and returns the list of (benchmark, metric) that regressed"""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if not before:
+                continue
+            change = (value - before) / before
+            worse = -change if metric.endswith("_per_s") else change
+            regressed = worse > threshold
+            if regressed:
+                regressions.append((name, metric))
+            print("%-16s %-20s %14.6g %14.6g %+8.1f%%%s" %
+                  (name, metric, before, value, 100 * change,
+                   "  REGRESSION" if regressed else ""))
+    return regressions
+
+if __name__ == "__main__":
+    opt, _ = getopt.getopt(sys.argv[1:], "s:r:b:o:c:t:")
+    opt = dict(opt)
+    scale = int(opt.get("-s", 1))
+    repetitions = int(opt.get("-r", 3))
+    names = opt["-b"].split(",") if "-b" in opt else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit("Unknown benchmark %s, choose from %s" %
+                     (name, ", ".join(BENCHMARKS)))
+    node.chainclass = TransactionBlockChain
+    random.seed(0)
+
+    results = run(names, scale, repetitions)
+    if "-o" in opt:
+        with open(opt["-o"], "w") as results_file:
+            json.dump({"time": datetime.datetime.utcnow().isoformat(),
+                       "python": platform.python_version(),
+                       "scale": scale,
+                       "repetitions": repetitions,
+                       "results": results}, results_file, indent=2)
+    if "-c" in opt:
+        with open(opt["-c"]) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("scale") != scale:
+            print("Warning: the baseline was run with scale %s" %
+                  baseline.get("scale"))
+        print()
+        print("%-16s %-20s %14s %14s %9s" %
+              ("benchmark", "metric", "baseline", "current", "change"))
+        if compare(results, baseline["results"],
+                   float(opt.get("-t", 0.1))):
+            sys.exit(1)
@@ -1,12 +1,18 @@
 #! /usr/bin/env python3
 
 from util import utc_to_local
+from config import BLOCK_STORAGE
+import encoding
 import hashlib
 import os
+import glob
 import json
 import datetime
 from textwrap import dedent
 
+# File extensions of blocks stored in json and in binary (see encoding.py)
+EXTENSIONS = {"json": ".json", "binary": ".bin"}
+
 def to_string(index, prev_hash, data, timestamp, nonce):
     return "%d%s%s%s%s" % (index, prev_hash, data, timestamp, nonce)
 
@@ -16,6 +22,46 @@ def calculate_hash(index, prev_hash, data, timestamp, nonce):
     sha.update(header_string.encode("utf8"))
     return sha.hexdigest()
 
+def difficulty_target(difficulty):
+    """The target of a hash with difficulty leading zeros (in hex): the
+    largest such hash, as an integer
+
+    >>> difficulty_target(2) == int(2 * "0" + 62 * "f", 16)
+    True
+    >>> work(difficulty_target(2))
+    256
+    """
+    return 16 ** (64 - difficulty) - 1
+
+def work(target):
+    """The expected number of hashes to find one at most target"""
+    return 2 ** 256 // (target + 1)
+
+def block_filenames(data_dir):
+    """The files of all blocks stored in data_dir, in either format, in the
+    order of the blocks"""
+    return sorted((filename for extension in EXTENSIONS.values()
+                   for filename in glob.glob(
+                       os.path.join(data_dir, "*" + extension))),
+                  key=os.path.basename)
+
+def block_filename(data_dir, index):
+    """The file of block index in data_dir, or None if it isn't stored"""
+    for extension in EXTENSIONS.values():
+        filename = os.path.join(data_dir, "%06d%s" % (index, extension))
+        if os.path.isfile(filename):
+            return filename
+    return None
+
+def read_block_file(filename):
+    """The fields of the block stored in the file, as a dictionary that can
+    be passed to the constructor"""
+    if filename.endswith(EXTENSIONS["binary"]):
+        with open(filename, 'rb') as block_file:
+            return encoding.loads(block_file.read())
+    with open(filename, 'r') as block_file:
+        return json.load(block_file)
+
 class Block(object):
     def __init__(self, index, timestamp=None, prev_hash=None, hash=None,
                  data="", nonce=None):
@@ -45,20 +91,48 @@ class Block(object):
     def get_hash(self):
         """
         The sha256 hash of this object, that depends deterministically on the 
-        fields index, timestamp, prev_hash, data, nonce
+        fields index, timestamp, prev_hash, data, nonce.
+        For a pruned block this is the hash it had before pruning.
         """
+        if self.is_pruned():
+            return self.hash
         return calculate_hash(self.index, self.prev_hash, self.data,
                               self.timestamp, self.nonce)
 
-    def save(self, data_dir):
-        """Save a json version of this block to the specified directory"""
-        filename = os.path.join(data_dir, "%06d.json" % (self.index))
-        with open(filename, 'w') as block_file:
-            json.dump(self.__dict__, block_file)
+    def prune(self):
+        """Discard the data of the block, keeping only what is needed to
+        check that it is part of a blockchain (its header). As the hash
+        depends on the data, it is stored in the field hash."""
+        if not self.is_pruned():
+            self.hash = self.get_hash()
+            self.data = None
+
+    def is_pruned(self):
+        return self.data is None
+
+    def save(self, data_dir, storage=BLOCK_STORAGE):
+        """Save a json or binary (see encoding.py) version of this block to
+        the specified directory, replacing it if it was stored in the
+        other format. The file is replaced at once, so that the web server
+        never reads a partially written block."""
+        previous = block_filename(data_dir, self.index)
+        filename = os.path.join(
+            data_dir, "%06d%s" % (self.index, EXTENSIONS[storage]))
+        temporary = filename + ".tmp"
+        if storage == "binary":
+            with open(temporary, 'wb') as block_file:
+                block_file.write(encoding.dumps(self.__dict__))
+        else:
+            with open(temporary, 'w') as block_file:
+                json.dump(self.__dict__, block_file)
+        os.replace(temporary, filename)
+        if previous is not None and previous != filename:
+            os.remove(previous)
 
-    def satisfies_pow(self, difficulty):
-        """Check that the proof-of-work is satisfied for this block."""
-        return self.get_hash().startswith('0' * difficulty)
+    def satisfies_pow(self, target):
+        """Check that the proof-of-work is satisfied for this block: its
+        hash, as an integer, is at most target (see BlockChain.target)."""
+        return int(self.get_hash(), 16) <= target
 
     def is_valid(self):
         """Validity as far as independent of its position in the blockchain.
@@ -1,15 +1,52 @@
-from block import Block
+from block import Block, block_filenames, read_block_file, \
+    difficulty_target, work
+import encoding
+import copy
 import json
 import os
 import requests
 import time
-import glob
 import datetime
+from metrics import REGISTRY
+from config import TARGET_BLOCK_INTERVAL, RETARGET_WINDOW
+
+HASHES = REGISTRY.counter("hashes_total", "Nonces tried while mining")
+
+def retarget(target, first, last, limit):
+    """The target after a window of blocks with the target, the first and
+    the last of which have the given timestamps: adjusted by the ratio of
+    the time they took to TARGET_BLOCK_INTERVAL per block, by at most a
+    factor 4, and at most limit.
+
+    >>> expected = TARGET_BLOCK_INTERVAL * (RETARGET_WINDOW - 1)
+    >>> def after(seconds):
+    ...     return (datetime.datetime(2020, 1, 1) +
+    ...             datetime.timedelta(seconds=seconds)).isoformat()
+    >>> retarget(1000, after(0), after(expected / 2), 10 ** 6)
+    500
+    >>> retarget(1000, after(0), after(0), 10 ** 6)
+    250
+    >>> retarget(1000, after(0), after(10 * expected), 2000)
+    2000
+    """
+    expected = TARGET_BLOCK_INTERVAL * (RETARGET_WINDOW - 1)
+    timespan = (datetime.datetime.fromisoformat(last) -
+                datetime.datetime.fromisoformat(first)).total_seconds()
+    timespan = min(max(timespan, expected / 4), expected * 4)
+    # in milliseconds, so that all nodes compute the same integer
+    return max(1, min(limit, target * round(timespan * 1000) //
+                      (expected * 1000)))
 
 class BlockChain(object):
+    # the record of the last validation, in the data directory of the blocks
+    VALIDATED_FILENAME = "validated.state"
+
     def __init__(self, blocks=None): # , data_dir=None, json_string=None):
         assert blocks is None or isinstance(blocks, list)
         self.blocks = blocks or []
+        # {data_dir: {index: (block, whether it was pruned)}} of the blocks
+        # as they were saved (subclasses may add other keys for other files)
+        self._saved = {}
 
     @staticmethod
     def new_block(*args, **kwargs):
@@ -21,10 +58,9 @@ class BlockChain(object):
     def load(cls, data_dir):
         bchain = cls()
         if os.path.exists(data_dir):
-            for filepath in glob.glob(os.path.join(data_dir, "*.json")):
-                with open(filepath, 'r') as block_file:
-                    block_info = json.load(block_file)
-                    bchain.append(bchain.new_block(**block_info))
+            for filepath in block_filenames(data_dir):
+                block_info = read_block_file(filepath)
+                bchain.append(bchain.new_block(**block_info))
         bchain.blocks.sort(key=lambda b: int(b.index))
         return bchain        
     
@@ -34,47 +70,166 @@ class BlockChain(object):
     
     @classmethod
     def from_url(cls, url):
-        """This function expects a url from which a json encoding a 
-        blockchain will be returned."""
-        chaindata = requests.get(url).json()
-        return cls([cls.new_block(**blockdata) for blockdata in chaindata])
+        """This function expects a url from which a json or binary encoding
+        (see encoding.py) of a blockchain will be returned. The blocks are
+        constructed as they arrive."""
+        return cls.from_response(requests.get(
+            url, headers={"Accept": encoding.ACCEPT}, stream=True))
+
+    @classmethod
+    def from_response(cls, response):
+        """The blockchain in a response as requested by from_url"""
+        return cls([cls.new_block(**blockdata)
+                    for blockdata in encoding.iter_response(response)])
+
+    def extended(self, start, blocks):
+        """A blockchain of the same class with the first start blocks of
+        this one, followed by the blocks (from index start on)"""
+        return type(self)(self.blocks[:start] + blocks)
 
     def as_json(self):
         return json.dumps([block.__dict__ for block in self.blocks])
     
-    def is_valid(self, difficulty):
+    def _targets(self, end, difficulty):
+        """The targets of the windows of RETARGET_WINDOW blocks up to block
+        end (not included), see target"""
+        limit = difficulty_target(difficulty)
+        targets = [limit]
+        if difficulty == 0: # no proof of work, e.g. in tests
+            return targets
+        for start in range(RETARGET_WINDOW, end, RETARGET_WINDOW):
+            targets.append(retarget(targets[-1],
+                                    self[start - RETARGET_WINDOW].timestamp,
+                                    self[start - 1].timestamp, limit))
+        return targets
+
+    def target(self, index, difficulty):
+        """The target that the hash of block index has to satisfy, for the
+        given initial difficulty (leading zeros). After every window of
+        RETARGET_WINDOW blocks it is adjusted to the time that these blocks
+        took (see retarget), but it never gets easier than the initial one.
+        Only the blocks before index are used. At difficulty 0 there is no
+        proof of work, and no adjustment."""
+        return self._targets(index + 1, difficulty)[-1]
+
+    def work(self, difficulty):
+        """The cumulative work of the blocks: the expected number of hashes
+        needed to mine them. The blockchain with the most work wins."""
+        targets = self._targets(len(self), difficulty)
+        return sum(work(targets[min(index // RETARGET_WINDOW,
+                                    len(targets) - 1)])
+                   for index in range(len(self)))
+
+    def is_valid(self, difficulty, assumed=0):
         """
         Is a valid blockchain if
 
         1) Each block is indexed one after the other
         2) Each block's prev hash is the hash of the prev block
-        3) The block's hash is valid for the number of zeros
+        3) The block's hash satisfies its target, which is adjusted to the
+           timestamps of earlier blocks starting from the initial difficulty
+           (see target)
+
+        The data of pruned blocks can't be checked, they are assumed to have
+        been validated before they were pruned. Of the first assumed blocks
+        only 1) and 2) are checked, e.g. because they were validated before
+        (see validated).
 
         Not taken into account but could be relevant:
 
         4) Conditions on the timestamps
-        5) Difficulty depending on the timestamps of previous blocks
         """
         if not self.blocks:
             return True
         if self.blocks[0].index != 0:
             return False
+        targets = self._targets(len(self), difficulty)
         for (prev_block, block) in zip(self.blocks[:-1], self.blocks[1:]):
-            if not block.is_valid():
+            if not prev_block.is_valid_predecessor(block):
                 return False
-            if not block.satisfies_pow(difficulty):
+            if block.index < assumed:
+                continue
+            if not block.is_pruned() and not block.is_valid():
                 return False
-            if not prev_block.is_valid_predecessor(block):
+            if not block.satisfies_pow(
+                    targets[min(block.index // RETARGET_WINDOW,
+                                len(targets) - 1)]):
                 return False
-        return self.blocks[0].satisfies_pow(difficulty) and self.blocks[0].is_valid()
+        return assumed > 0 or (self.blocks[0].satisfies_pow(targets[0]) and
+                               (self.blocks[0].is_pruned() or
+                                self.blocks[0].is_valid()))
+
+    def mark_validated(self, data_dir):
+        """Record in data_dir that this blockchain, that is saved there, is
+        valid: its length and the hash of its last block (see validated)"""
+        filename = os.path.join(data_dir, self.VALIDATED_FILENAME)
+        temporary = filename + ".tmp"
+        with open(temporary, 'w') as validated_file:
+            json.dump({"length": len(self),
+                       "hash": self.head().get_hash() if len(self) else None},
+                      validated_file)
+        os.replace(temporary, filename)
+
+    def validated(self, data_dir):
+        """The number of blocks at the start of this blockchain that were
+        validated before, according to the record left in data_dir by
+        mark_validated: the blocks up to the last one recorded, if this
+        blockchain still has it.
+
+        >>> import tempfile
+        >>> data_dir = tempfile.mkdtemp()
+        >>> chain = BlockChain()
+        >>> for i in range(3):
+        ...     chain.append(chain.mine("block %d" % i, 0))
+        >>> chain.validated(data_dir)
+        0
+        >>> chain.mark_validated(data_dir)
+        >>> chain.append(chain.mine("block 3", 0))
+        >>> chain.validated(data_dir)
+        3
+        >>> chain[2].nonce += 1
+        >>> chain.validated(data_dir)
+        0
+        """
+        filename = os.path.join(data_dir, self.VALIDATED_FILENAME)
+        try:
+            with open(filename, 'r') as validated_file:
+                validated = json.load(validated_file)
+            length = validated["length"]
+            if 0 < length <= len(self) and \
+               self[length - 1].get_hash() == validated["hash"]:
+                return length
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return 0
   
     def save(self, data_dir):
         """
-        Save each block in this chain (the filename only depends on the index).
+        Save each block in this chain (the filename only depends on the index),
+        except those that were saved to data_dir before and didn't change,
+        and remove the blocks stored after its last one.
         """
+        saved = self._saved.setdefault(data_dir, {})
         for block in self.blocks:
-            block.save(data_dir)
+            state = saved.get(block.index)
+            if state is None or state[0] is not block or \
+               state[1] != block.is_pruned():
+                block.save(data_dir)
+                saved[block.index] = (block, block.is_pruned())
+        # the blocks of a longer blockchain that this one replaced, the last
+        # one first so that the stored blocks stay contiguous
+        for filename in reversed(block_filenames(data_dir)):
+            index = int(os.path.basename(filename).split(".")[0])
+            if index < len(self):
+                break
+            os.remove(filename)
+            saved.pop(index, None)
   
+    def prune(self, depth):
+        """Discard the data of all blocks except the last depth ones."""
+        for block in self.blocks[:max(len(self) - depth, 0)]:
+            block.prune()
+
     def head(self):
         return None if len(self) == 0 else self.blocks[-1]
       
@@ -94,29 +249,27 @@ class BlockChain(object):
     def next_index(self):
         return 0 if len(self) == 0 else self.head().index + 1
         
-    def mine(self, data, difficulty, intents=1000):
-        """Try to mine a next block for the given difficulty by computing 
+    def next_block(self, data, timestamp=None):
+        """A block with the given data that can be appended to this chain
+        once its nonce satisfies the proof-of-work. By default the timestamp
+        is the current time."""
+        timestamp = timestamp or datetime.datetime.utcnow().isoformat()
+        prev_hash = "" if len(self) == 0 else self.head().get_hash()
+        return self.new_block(index=self.next_index(), timestamp=timestamp,
+                              data=data, prev_hash=prev_hash, nonce=0)
+
+    def mine(self, data, difficulty, intents=1000, stop=None):
+        """Try to mine a next block for the given (initial) difficulty, see
+        target, by computing 
         the specified number of hashes.
         With the strategy used here the nonce is never very high, but that 
         doesn't matter. 
         The change in the timestamp in different calls will cause the hashes 
         to be different every time, even for the same nonces.
-        If no valid block is found in the given number of intents, None is 
-        returned.
+        If no valid block is found in the given number of intents, or the
+        (threading) Event stop is set, None is returned.
         """
-        if data is None:
-            return None
-        timestamp = datetime.datetime.utcnow().isoformat()
-        prev_hash = "" if len(self) == 0 else self.head().get_hash()
-        block = self.new_block(index=self.next_index(), timestamp=timestamp,
-                               data=data, prev_hash=prev_hash, nonce=0)
-    
-        for nonce in range(intents):
-            block.nonce = nonce
-            if block.satisfies_pow(difficulty):
-                return block
-            time.sleep(0.01)
-        return None
+        return BlockTemplate(self, data, difficulty).mine(intents, stop)
 
     def append(self, block):
         """Extend the blockchain with a new block. It is not checked that 
@@ -143,3 +296,64 @@ class BlockChain(object):
         else:
             return _forkpoint(self, other, 1)
 
+class BlockTemplate(object):
+    """The next block of a blockchain, that is mined for as long as the tip
+    of the blockchain doesn't change. Its target is computed once, its data
+    is only replaced when it changes (e.g. when transactions were added to
+    it) and its timestamp is refreshed whenever nonces are tried.
+
+    >>> chain = BlockChain()
+    >>> template = BlockTemplate(chain, "block 0", 0)
+    >>> chain.append(template.mine())
+    >>> template.extends(chain)
+    False
+    >>> template = BlockTemplate(chain, "block 1", 0)
+    >>> template.update("block 1, changed")
+    >>> template.extends(chain), template.mine().data
+    (True, 'block 1, changed')
+    """
+    def __init__(self, blockchain, data, difficulty):
+        self.blockchain = blockchain
+        self.block = blockchain.next_block(data)
+        self.target = blockchain.target(self.block.index, difficulty)
+
+    def extends(self, blockchain):
+        """Whether the block would be the next block of the blockchain"""
+        return self.block.index == blockchain.next_index() and \
+            (len(blockchain) == 0 or
+             self.block.prev_hash == blockchain.head().get_hash())
+
+    def update(self, data):
+        """Replace the data of the block, if it changed"""
+        if data != self.block.data:
+            self.block = self.blockchain.next_block(data)
+
+    def mine(self, intents=1000, stop=None):
+        """Try intents nonces with the current time as timestamp, see
+        BlockChain.mine. The block that is found is returned, and the
+        template continues with a copy of it."""
+        if self.block.data is None:
+            return None
+        block = self.block
+        block.timestamp = datetime.datetime.utcnow().isoformat()
+        for nonce in range(intents):
+            if stop is not None and stop.is_set():
+                HASHES.inc(nonce)
+                return None
+            block.nonce = nonce
+            if block.satisfies_pow(self.target):
+                HASHES.inc(nonce + 1)
+                self.block = copy.copy(block)
+                return block
+            time.sleep(0.01)
+        HASHES.inc(intents)
+        return None
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
@@ -0,0 +1,79 @@
+#! /usr/bin/env python3
+
+"""Bloom filters, to find out which blocks may contain a given address or
+transaction without looking at the blocks themselves.
+
+>>> bloom = BloomFilter.for_items(["a", "b", "c"])
+>>> "a" in bloom and "b" in bloom and "c" in bloom
+True
+>>> "d" in bloom # may be True for a fraction BLOOM_FALSE_POSITIVE_RATE
+False
+>>> BloomFilter.from_hex(bloom.as_hex()) == bloom
+True
+"""
+
+import math
+import hashlib
+from config import BLOOM_FALSE_POSITIVE_RATE
+
+class BloomFilter(object):
+    def __init__(self, size, hashes, bits=0):
+        """size: the number of bits
+        hashes: the number of bits that are set for every item
+        bits: the bits as an integer"""
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits
+
+    @classmethod
+    def for_items(cls, items, false_positive_rate=BLOOM_FALSE_POSITIVE_RATE):
+        """A filter containing the items (strings), with the optimal size and
+        number of hashes for the given rate of false positives."""
+        items = set(items)
+        n = max(len(items), 1)
+        size = math.ceil(-n * math.log(false_positive_rate) / math.log(2) ** 2)
+        size = 8 * math.ceil(size / 8)
+        hashes = max(1, round(size / n * math.log(2)))
+        bloom = cls(size, hashes)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def _positions(self, item):
+        # double hashing: the positions h1 + i * h2 for i < hashes
+        digest = hashlib.sha256(item.encode("utf8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits |= 1 << position
+
+    def __contains__(self, item):
+        """False if the item is not in the filter, True if it may be."""
+        return all(self.bits >> position & 1
+                   for position in self._positions(item))
+
+    def as_hex(self):
+        """A compact string representation: the number of hashes in two hex
+        digits followed by the bits."""
+        return "%02x%s" % (self.hashes,
+                           self.bits.to_bytes(self.size // 8, "big").hex())
+
+    @classmethod
+    def from_hex(cls, s):
+        return cls(size=4 * (len(s) - 2), hashes=int(s[:2], 16),
+                   bits=int(s[2:] or "0", 16))
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
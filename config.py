@@ -1,11 +1,47 @@
 from ecdsa import NIST192p as CURVE
 DATA_DIR = 'blockchaindata'
 NODE_ADDRESSES = ["localhost:5000", "localhost:5001", "localhost:5002", "localhost:5003"]
-DIFFICULTY = 3 # leading zeros
+DIFFICULTY = 3 # leading zeros of the initial (and easiest) target
+TARGET_BLOCK_INTERVAL = 30 # seconds between blocks the target is adjusted to
+RETARGET_WINDOW = 20 # blocks after which the target is adjusted
 CONFIRMATIONS = 6 # number of confirmations before considering a transaction final
+PRUNE_DEPTH = None # only keep the data of this many recent blocks (None: all)
 BLOCK_REWARD = 1
-MAX_TRANSACTIONS_PER_BLOCK = 5
+MAX_BLOCK_BYTES = 100000 # max total size of the transactions of a block
+BLOCK_VERSION = 2 # version of newly mined TransactionBlocks (2: merkle root)
+BLOCK_STORAGE = "binary" # format of stored blocks: "binary" or "json"
 NEW_ADDRESS_BALANCE = 1 # the amount that a newly created address gets assigned
+MEMPOOL_MAX_TRANSACTIONS = 10000 # max number of unprocessed transactions kept
+MEMPOOL_MAX_BYTES = 5000000 # max total size of unprocessed transactions kept
+MEMPOOL_EXPIRY = 24 * 3600 # seconds after which an unprocessed transaction is dropped
+MIN_RELAY_FEE = 0 # transactions with a lower fee are not accepted
+MAX_PUSH_BATCH = 1000 # transactions accepted in one request to /pushtxs
+MAX_HISTORY_PAGE = 1000 # max entries of a page of /history
+VERIFYING_KEY_CACHE = 1000 # addresses whose keys are kept for verification
+BLOOM_FALSE_POSITIVE_RATE = 0.01 # of the bloom filters of blocks
+SHARED_PEERS_BYTES = 1 << 16 # shared memory for each of the views of peers
+SHARED_DICT_BYTES = 1 << 12 # shared memory for the flags and miner status
+PEER_REFRESH_INTERVAL = 30 # seconds between updates of the active peers
+SYNC_INTERVAL = 10 # seconds between polls for a longer blockchain of a peer
+MEMPOOL_PULL_INTERVAL = 5 # seconds between pulls of unprocessed transactions
+BLOCK_TEMPLATE_INTERVAL = 10 # seconds after which the block being mined is
+                             # renewed, to include new transactions
+MINING_SLICE = 100 # nonces tried between checks whether to renew the block
+PEER_TIMEOUT = 5 # seconds after which a request to a peer fails
+PEER_BACKOFF = 5 # seconds a peer isn't contacted after a failure, doubling
+                 # with every further consecutive failure
+PEER_MAX_BACKOFF = 600 # longest time a peer isn't contacted after failures
+ACTIVE_VIEW_SIZE = 8 # peers a node registers with and syncs with
+PASSIVE_VIEW_SIZE = 32 # peers a node knows of, to replace active ones
+SHUFFLE_SIZE = 6 # peers exchanged with a random active peer every refresh
+DOWNLOAD_RANGE_SIZE = 50 # blocks requested at once when syncing
+DOWNLOAD_WORKERS = 4 # ranges of blocks downloaded concurrently
+METRICS_INTERVAL = 5 # seconds between updates of the metrics of the miner
+SHARED_METRICS_BYTES = 1 << 18 # shared memory for the metrics of the miner
+PROFILE = False # profile the requests and the phases of the miner (can also
+                # be switched at /profiling)
+PROFILE_INTERVAL = 60 # seconds of profiles added up in a file
+PROFILE_KEEP = 10 # profile files kept of every route or phase
 
 # Not used anymore - obsolete
 # LEASE_TIME = 60 # how long the tracker keeps you registered in seconds
@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+
+"""Download of a range of blocks from several peers at once. The range is
+split in pieces of DOWNLOAD_RANGE_SIZE blocks, that are requested from the
+peers (through /blocks) concurrently, the best peers first (see peers.py).
+Each piece is checked as it arrives: the indices, the proof of work, the
+validity of the blocks and the links between them. A piece that fails, or
+that a peer doesn't deliver, is requested again from another peer, and the
+peer isn't asked for other pieces. Finally the pieces are joined in order,
+checking the links between them.
+
+All peers should have the same blocks in the range, e.g. because they agree
+on the last one (see block_hash).
+"""
+
+import itertools
+import requests
+import encoding
+from block import difficulty_target
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics import REGISTRY
+from config import DOWNLOAD_RANGE_SIZE, DOWNLOAD_WORKERS
+
+PIECE_SECONDS = REGISTRY.histogram(
+    "block_download_seconds", "Time to download and check a piece of blocks")
+
+class DownloadError(ValueError):
+    """The blocks couldn't be obtained from any of the peers"""
+
+def block_hash(peer_table, peer, index, chainclass):
+    """The hash of block index of the peer, None if it doesn't have it"""
+    response = peer_table.get(peer, "/block", params={"index": index},
+                              headers={"Accept": encoding.ACCEPT})
+    if response.status_code != 200:
+        return None
+    return chainclass.new_block(**encoding.response_value(response)).get_hash()
+
+def check_blocks(blocks, start, end, difficulty):
+    """Raises ValueError unless the blocks are valid blocks start, ..., end-1
+    that each point to the previous one. Their proof of work is checked
+    against the easiest target of the difficulty only: their actual targets
+    depend on earlier blocks (see BlockChain.target), and are checked when
+    the blockchain is validated."""
+    if [block.index for block in blocks] != list(range(start, end)):
+        raise ValueError("Expected blocks %d to %d" % (start, end - 1))
+    target = difficulty_target(difficulty)
+    for (i, block) in enumerate(blocks):
+        if block.is_pruned():
+            raise ValueError("The data of block %d is pruned" % block.index)
+        if not block.satisfies_pow(target) or not block.is_valid():
+            raise ValueError("Block %d is invalid" % block.index)
+        if i > 0 and not blocks[i - 1].is_valid_predecessor(block):
+            raise ValueError("Block %d doesn't follow block %d" %
+                             (block.index, block.index - 1))
+
+def fetch_blocks(peer_table, peer, start, end, chainclass, difficulty):
+    """The blocks start, ..., end-1 of the peer, checked with check_blocks.
+    A response that is cut off or wrong counts as a failure of the peer."""
+    with PIECE_SECONDS.time(peer=peer):
+        response = peer_table.get(peer, "/blocks",
+                                  params={"start": start, "end": end},
+                                  headers={"Accept": encoding.ACCEPT},
+                                  stream=True)
+        try:
+            response.raise_for_status()
+            blocks = [chainclass.new_block(**blockdata) for blockdata in
+                      peer_table.iter_response(peer, "/blocks", response)]
+            check_blocks(blocks, start, end, difficulty)
+        except (requests.RequestException, ValueError, TypeError):
+            # TypeError: items that aren't blocks
+            peer_table.failed(peer)
+            raise
+    return blocks
+
+def download_blocks(peer_table, peers, start, end, chainclass, difficulty,
+                    range_size=DOWNLOAD_RANGE_SIZE, workers=DOWNLOAD_WORKERS):
+    """The blocks start, ..., end-1, downloaded from the peers (in order of
+    preference) and checked as described above. Raises DownloadError if
+    some piece couldn't be obtained from any peer."""
+    pieces = [(i, min(i + range_size, end))
+              for i in range(start, end, range_size)]
+    failed = set() # peers that failed during this download
+    received = {} # piece: blocks
+    turns = itertools.count() # to assign the pieces to the peers round robin
+
+    def next_peer():
+        candidates = [peer for peer in peers if peer not in failed]
+        if not candidates:
+            raise DownloadError("Blocks %d to %d couldn't be downloaded" %
+                                (start, end - 1))
+        return candidates[next(turns) % len(candidates)]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(peers)))) \
+         as executor:
+        def submit(piece):
+            peer = next_peer()
+            future = executor.submit(fetch_blocks, peer_table, peer,
+                                     piece[0], piece[1], chainclass,
+                                     difficulty)
+            running[future] = (piece, peer)
+
+        running = {} # future: (piece, peer)
+        for piece in pieces:
+            submit(piece)
+        while running:
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                piece, peer = running.pop(future)
+                try:
+                    received[piece] = future.result()
+                except (requests.RequestException, ValueError, TypeError) as e:
+                    print("Failed to obtain blocks %d to %d from %s: %s" %
+                          (piece[0], piece[1] - 1, peer, e))
+                    failed.add(peer)
+                    try:
+                        submit(piece)
+                    except DownloadError:
+                        for other in running:
+                            other.cancel()
+                        raise
+
+    blocks = []
+    for piece in pieces:
+        if blocks and not blocks[-1].is_valid_predecessor(received[piece][0]):
+            raise DownloadError("Block %d doesn't follow block %d" %
+                                (piece[0], piece[0] - 1))
+        blocks.extend(received[piece])
+    return blocks
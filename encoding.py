@@ -0,0 +1,425 @@
+#! /usr/bin/env python3
+
+"""A compact binary encoding of json-like values (None, booleans, numbers,
+strings, lists and dictionaries), used as an alternative to json for blocks
+and transactions on the wire and on disk. Compared to json:
+
+- hex strings (addresses, signatures, hashes, uuids) are stored as bytes
+- floats are stored as 8 byte doubles and integers as variable length ints
+- common dictionary keys are stored as a single byte
+- strings that contain json, like the data of a TransactionBlock, are stored
+  as the encoding of the value rather than as escaped text
+
+Decoding gives back exactly the value that was encoded (the same strings,
+the same int or float types, the same order of keys). Since hashes and
+signatures are computed over the strings obtained from those values, they
+are unaffected by the encoding.
+
+>>> value = {"index": 1, "amount": 0.1, "nonce": None, "ok": [True, False],
+...          "prev_hash": "00ab", "msg": "Hello", "data": '{"a": [1, 2.5]}'}
+>>> loads(dumps(value)) == value
+True
+>>> [type(v) for v in loads(dumps([1, 1.0]))]
+[<class 'int'>, <class 'float'>]
+>>> len(dumps({"signature": 48 * "ab"})) < len(json.dumps({"signature": 48 * "ab"}))
+True
+
+Large lists and dictionaries can be encoded (in json or binary) and decoded
+incrementally, a chunk at a time, so that neither the sender nor the
+receiver has to hold the whole encoding in memory:
+
+>>> items = [{"index": i, "data": "x" * i} for i in range(100)]
+>>> chunks = list(iter_dumps(items, binary=True))
+>>> loads(b"".join(chunks)) == items
+True
+>>> list(iter_loads(_rechunk(chunks, 7), binary=True)) == items
+True
+>>> chunks = list(iter_dumps(iter(items)))
+>>> json.loads(b"".join(chunks)) == items
+True
+>>> list(iter_loads(_rechunk(chunks, 7))) == items
+True
+>>> pairs = [("a", 1.5), ("b", [None, "c"])]
+>>> list(iter_loads(iter_dumps(pairs, pairs=True), pairs=True)) == pairs
+True
+>>> list(iter_loads(iter_dumps(pairs, binary=True, pairs=True), binary=True,
+...                 pairs=True)) == pairs
+True
+"""
+
+import json
+import struct
+import codecs
+
+MIMETYPE = "application/x-blockchain-binary"
+JSON_MIMETYPE = "application/json"
+# Accept header for clients that prefer the binary encoding
+ACCEPT = "%s, %s;q=0.5" % (MIMETYPE, JSON_MIMETYPE)
+
+MAGIC = b"BC"
+VERSION = 2
+# Versions that loads can decode. Version 2 adds lists and dictionaries of
+# unknown length, terminated by END, that can be written as a stream.
+VERSIONS = (1, 2)
+
+# tags
+NONE, FALSE, TRUE, INT, FLOAT, STR, HEX, LIST, DICT, KEY, JSON, \
+    BEGIN_LIST, BEGIN_DICT, END = range(14)
+
+# Dictionary keys that are encoded as a single byte. Only append to this
+# list: the index is part of the encoding.
+KEYS = ["index", "timestamp", "prev_hash", "hash", "data", "nonce", "version",
+        "merkle_root", "msg", "miner_address", "transactions", "from_addr",
+        "to_addr", "amount", "fee", "signature", "uuid"]
+KEY_CODES = dict((key, code) for (code, key) in enumerate(KEYS))
+
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+def _varint(n):
+    """Unsigned LEB128"""
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def _is_hex(s):
+    return s and len(s) % 2 == 0 and HEX_DIGITS.issuperset(s)
+
+def _embedded_json(s):
+    """The value of which s is the json encoding (as produced by json.dumps
+    with default arguments), or raises ValueError."""
+    if not s.startswith(("{", "[")):
+        raise ValueError("Not json")
+    value = json.loads(s)
+    if json.dumps(value) != s:
+        raise ValueError("Not in canonical form")
+    return value
+
+def _encode(value, out):
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        out.append(INT)
+        out += _varint(value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += struct.pack(">d", value)
+    elif isinstance(value, str):
+        if _is_hex(value):
+            out.append(HEX)
+            out += _varint(len(value) // 2)
+            out += bytes.fromhex(value)
+            return
+        try:
+            embedded = _embedded_json(value)
+        except ValueError:
+            encoded = value.encode("utf8")
+            out.append(STR)
+            out += _varint(len(encoded))
+            out += encoded
+        else:
+            out.append(JSON)
+            _encode(embedded, out)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        out += _varint(len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        out += _varint(len(value))
+        for key, item in value.items():
+            if key in KEY_CODES:
+                out.append(KEY)
+                out.append(KEY_CODES[key])
+            else:
+                _encode(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError("Can't encode %r" % (value,))
+
+class Truncated(ValueError):
+    """The data ends in the middle of a value"""
+
+# the deepest nesting of lists and dictionaries that is decoded, well
+# within the recursion limit of Python
+MAX_DEPTH = 100
+
+class _Decoder(object):
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+        self.depth = 0 # of the lists and dictionaries being decoded
+
+    def varint(self):
+        n, shift = 0, 0
+        while True:
+            byte = self.take(1)[0]
+            n |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return n
+
+    def take(self, n):
+        if self.pos + n > len(self.data):
+            raise Truncated("Truncated data")
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return chunk
+
+    def value(self):
+        tag = self.take(1)[0]
+        if tag == NONE:
+            return None
+        if tag == TRUE:
+            return True
+        if tag == FALSE:
+            return False
+        if tag == INT:
+            n = self.varint()
+            return n >> 1 if not n & 1 else -((n + 1) >> 1)
+        if tag == FLOAT:
+            return struct.unpack(">d", self.take(8))[0]
+        if tag == STR:
+            return self.take(self.varint()).decode("utf8")
+        if tag == HEX:
+            return self.take(self.varint()).hex()
+        if tag == KEY:
+            code = self.take(1)[0]
+            if code >= len(KEYS):
+                raise ValueError("Unknown key code %d" % code)
+            return KEYS[code]
+        if tag == END:
+            return _END
+        if self.depth >= MAX_DEPTH:
+            raise ValueError("Nested more than %d levels deep" % MAX_DEPTH)
+        self.depth += 1
+        try:
+            return self.container(tag)
+        finally:
+            self.depth -= 1
+
+    def container(self, tag):
+        if tag == LIST:
+            return [self.value() for _ in range(self.varint())]
+        if tag == DICT:
+            return dict(self.item() for _ in range(self.varint()))
+        if tag == JSON:
+            return json.dumps(self.value())
+        if tag == BEGIN_LIST:
+            return list(iter(self.value, _END))
+        if tag == BEGIN_DICT:
+            return dict(iter(self.item, (_END, _END)))
+        raise ValueError("Unknown tag %d" % tag)
+
+    def item(self):
+        key = self.value()
+        if key is _END:
+            return _END, _END
+        return key, self.value()
+
+# returned by _Decoder.value at the end of a list or dictionary of unknown
+# length
+_END = object()
+
+def _header(data):
+    """The position after the header of the binary encoding in data"""
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not binary encoded")
+    version = data[len(MAGIC)]
+    if version not in VERSIONS:
+        raise ValueError("Unsupported version %d of the encoding" % version)
+    return len(MAGIC) + 1
+
+def dumps(value):
+    """The binary encoding of value, preceded by a header with the version
+    of the encoding."""
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    _encode(value, out)
+    return bytes(out)
+
+def loads(data):
+    """The value encoded by dumps or iter_dumps"""
+    return _Decoder(data, _header(data)).value()
+
+def iter_dumps(items, binary=False, pairs=False):
+    """Generates the encoding (binary or json) of the list of the items in
+    chunks of bytes, one per item, so that it can be streamed. If pairs,
+    the items are (key, value) pairs and a dictionary is encoded."""
+    if binary:
+        out = bytearray(MAGIC)
+        out.append(VERSION)
+        out.append(BEGIN_DICT if pairs else BEGIN_LIST)
+        yield bytes(out)
+        for item in items:
+            out = bytearray()
+            if pairs:
+                _encode({item[0]: item[1]}, out)
+                del out[:2] # the tag and length of the dictionary
+            else:
+                _encode(item, out)
+            yield bytes(out)
+        yield bytes([END])
+    else:
+        separator = "{" if pairs else "["
+        for item in items:
+            if pairs:
+                chunk = json.dumps({item[0]: item[1]})[1:-1]
+            else:
+                chunk = json.dumps(item)
+            yield (separator + chunk).encode("utf8")
+            separator = ", "
+        if separator != ", ": # no items
+            yield separator.encode("utf8")
+        yield ("}" if pairs else "]").encode("utf8")
+
+def _iter_loads_binary(chunks, pairs):
+    chunks = iter(chunks)
+    data = b""
+    while len(data) < len(MAGIC) + 2: # the header and the first tag
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise Truncated("Truncated header")
+        data += chunk
+    pos = _header(data)
+    if data[pos] in (LIST, DICT):
+        # encoded by dumps rather than iter_dumps: decode all at once
+        value = loads(data + b"".join(chunks))
+        yield from value.items() if pairs else value
+        return
+    if data[pos] != (BEGIN_DICT if pairs else BEGIN_LIST):
+        raise ValueError("Not a %s" % ("dictionary" if pairs else "list"))
+    decoder = _Decoder(data, pos + 1)
+    while True:
+        start = decoder.pos
+        try:
+            item = decoder.item() if pairs else decoder.value()
+        except Truncated:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise
+            decoder = _Decoder(data[start:] + chunk)
+            data = decoder.data
+            continue
+        if item is _END or item == (_END, _END):
+            return
+        yield item
+
+def _skip_whitespace(text, pos):
+    while pos < len(text) and text[pos].isspace():
+        pos += 1
+    if pos == len(text):
+        raise Truncated("Truncated json")
+    return pos
+
+def _raw_decode(decoder, text, pos, final):
+    try:
+        return decoder.raw_decode(text, pos)
+    except json.JSONDecodeError:
+        if final:
+            raise
+        # can't tell an invalid value from one that isn't complete yet
+        raise Truncated("Truncated json")
+
+def _json_item(decoder, text, pos, first, pairs, final):
+    """The next item of a json list (pair of a json dictionary if pairs)
+    in text from pos, or _END, and the position after it."""
+    opening, closing = "{}" if pairs else "[]"
+    pos = _skip_whitespace(text, pos)
+    if first:
+        if text[pos] != opening:
+            raise ValueError("Expected %r" % opening)
+        pos = _skip_whitespace(text, pos + 1)
+    if text[pos] == closing:
+        return _END, pos + 1
+    if not first:
+        if text[pos] != ",":
+            raise ValueError("Expected ','")
+        pos = _skip_whitespace(text, pos + 1)
+    if pairs:
+        key, pos = _raw_decode(decoder, text, pos, final)
+        pos = _skip_whitespace(text, pos)
+        if text[pos] != ":":
+            raise ValueError("Expected ':'")
+        pos = _skip_whitespace(text, pos + 1)
+    value, pos = _raw_decode(decoder, text, pos, final)
+    if pos == len(text) and not final:
+        # a number may continue in the next chunk
+        raise Truncated("Truncated json")
+    return ((key, value) if pairs else value), pos
+
+def _iter_loads_json(chunks, pairs):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf8")()
+    text, pos, first = "", 0, True
+    chunks = iter(chunks)
+    while True:
+        chunk = next(chunks, None)
+        final = chunk is None
+        text = text[pos:] + text_decoder.decode(chunk or b"", final=final)
+        pos = 0
+        while True:
+            try:
+                item, end = _json_item(decoder, text, pos, first, pairs, final)
+            except Truncated:
+                if final:
+                    raise
+                break
+            if item is _END:
+                return
+            yield item
+            pos, first = end, False
+
+def iter_loads(chunks, binary=False, pairs=False):
+    """Generates the items of the list (the (key, value) pairs of the
+    dictionary if pairs) encoded by the chunks of bytes as soon as they have
+    arrived."""
+    if binary:
+        return _iter_loads_binary(chunks, pairs)
+    return _iter_loads_json(chunks, pairs)
+
+def _rechunk(chunks, size):
+    """The concatenation of the chunks, in chunks of the given size"""
+    data = b"".join(chunks)
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+def is_binary(response):
+    """Whether a response (from requests) is binary encoded"""
+    return response.headers.get("Content-Type", "").startswith(MIMETYPE)
+
+def response_value(response):
+    """The value in a response (from requests) to a request with the Accept
+    header ACCEPT, which is either binary encoded or json."""
+    if is_binary(response):
+        return loads(response.content)
+    return response.json()
+
+# the size of the chunks in which streamed responses are read
+CHUNK_SIZE = 64 * 1024
+
+def iter_response(response, pairs=False):
+    """Generates the items of the list (the (key, value) pairs of the
+    dictionary if pairs) in a response (from requests) to a request with the
+    Accept header ACCEPT, as they arrive. The request should be made with
+    stream=True."""
+    return iter_loads(response.iter_content(CHUNK_SIZE),
+                      binary=is_binary(response), pairs=pairs)
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+
+"""The ledger of a TransactionNode: the balances of all addresses and the
+history of the changes to them, including block rewards and fees, materialized
+in the transaction database (the tables are created in mempool.MIGRATIONS).
+
+The miner keeps it in sync with its blockchain: when the blockchain changes,
+the blocks that are no longer in it are disconnected and the new ones are
+connected. The column block of the transactions table is maintained along
+with it. This way the web server can answer balance queries with a lookup
+instead of replaying the blockchain. Along with every block its bloom filter
+is stored, so that the blocks concerning an address or transaction can be
+found without decoding the others.
+
+>>> from mempool import connect, migrate
+>>> from transaction import TransactionBlockChain, TransactionBundle
+>>> db = connect(":memory:")
+>>> migrate(db)
+>>> chain = TransactionBlockChain()
+>>> for i in range(3):
+...     chain.append(chain.mine(TransactionBundle("", "miner").as_json(), 0))
+>>> sync(db, chain)
+(0, 3)
+>>> get_balance(db, "miner") == NEW_ADDRESS_BALANCE + 3 * BLOCK_REWARD
+True
+>>> get_balance(db, "miner", confirmations=3) == \\
+...     NEW_ADDRESS_BALANCE + BLOCK_REWARD
+True
+>>> [entry["kind"] for entry in get_history(db, "miner")["history"]]
+['reward', 'reward', 'reward']
+>>> from bloom import BloomFilter
+>>> [index for index, _, bloom in get_filters(db)
+...  if "miner" in BloomFilter.from_hex(bloom)]
+[0, 1, 2]
+>>> chain.pop() and sync(db, chain)
+(1, 0)
+
+When the blockchain is pruned, so can the history be. Only the history of
+the blocks that aren't pruned is needed to disconnect them and to compute
+balances with several confirmations.
+
+>>> prune(db, 0)
+>>> get_balance(db, "miner", confirmations=2) == \\
+...     NEW_ADDRESS_BALANCE + BLOCK_REWARD
+True
+"""
+
+from collections import defaultdict
+from mempool import insert
+from config import BLOCK_REWARD, NEW_ADDRESS_BALANCE
+
+def block_entries(block):
+    """Generates (address, kind, uuid, delta) for every change in a balance
+    due to the transactions in the block and its reward."""
+    txs = block.get_transaction_bundle()
+    for tx in txs:
+        yield tx.from_addr, "sent", tx.uuid, -(tx.amount + tx.fee)
+        yield tx.to_addr, "received", tx.uuid, tx.amount
+        if tx.fee:
+            yield txs.miner_address, "fee", tx.uuid, tx.fee
+    yield txs.miner_address, "reward", None, BLOCK_REWARD
+
+def connect_block(db, block):
+    """Apply the block, which should be the successor of the last connected
+    one, to the ledger. Doesn't commit."""
+    db.execute("insert into blocks (idx, hash, bloom) values (?, ?, ?)",
+               (block.index, block.get_hash(), block.bloom_filter().as_hex()))
+    for tx in block.get_transaction_bundle():
+        insert(tx, db, block=block.index, ignore=True, commit=False)
+        db.execute("update transactions set block = ? where uuid = ?",
+                   (block.index, tx.uuid))
+    for address, kind, uuid, delta in block_entries(block):
+        db.execute(
+            """insert into address_history (address, block, kind, uuid, delta)
+               values (?, ?, ?, ?, ?)""",
+            (address, block.index, kind, uuid, delta))
+        db.execute(
+            """insert into balances (address, balance, first_block)
+               values (?, ?, ?)
+               on conflict (address) do update set balance = balance + ?""",
+            (address, NEW_ADDRESS_BALANCE + delta, block.index, delta))
+
+def disconnect_block(db, index):
+    """Undo the block with the given index, which should be the last
+    connected one. Doesn't commit."""
+    changes = db.execute(
+        """select address, total(delta) from address_history
+           where block = ? group by address""", (index,)).fetchall()
+    db.execute("delete from address_history where block = ?", (index,))
+    for address, delta in changes:
+        db.execute(
+            "update balances set balance = balance - ? where address = ?",
+            (delta, address))
+        # addresses that no longer appear in the blockchain
+        db.execute(
+            "delete from balances where address = ? and first_block = ?",
+            (address, index))
+    db.execute("update transactions set block = NULL where block = ?",
+               (index,))
+    db.execute("delete from blocks where idx = ?", (index,))
+
+def prune(db, index):
+    """Discard the history up to and including the block with the given
+    index. Those blocks can't be disconnected anymore."""
+    db.execute("delete from address_history where block <= ?", (index,))
+    db.commit()
+
+def reset(db):
+    """Disconnect all blocks at once, e.g. to connect them again from
+    scratch. Doesn't commit."""
+    for table in ["blocks", "balances", "address_history"]:
+        db.execute("delete from %s" % table)
+    db.execute("update transactions set block = NULL")
+
+def restore_snapshot(db, blockchain):
+    """Replace the ledger by the snapshot of the pruned blockchain, with the
+    pruned blocks connected. Their bloom filters and history are unknown.
+    Doesn't commit."""
+    snapshot = blockchain.snapshot
+    reset(db)
+    db.executemany(
+        "insert into blocks (idx, hash) values (?, ?)",
+        ((block.index, block.get_hash())
+         for block in blockchain[:snapshot["index"] + 1]))
+    db.executemany(
+        "insert into balances (address, balance, first_block) values (?, ?, ?)",
+        ((address, balance, snapshot["index"])
+         for address, balance in snapshot["balances"].items()))
+
+def tip(db):
+    """The index of the last connected block, -1 if there is none"""
+    return db.execute("select ifnull(max(idx), -1) from blocks").fetchone()[0]
+
+def tip_hash(db):
+    """The hash of the last connected block, None if there is none"""
+    row = db.execute(
+        "select hash from blocks order by idx desc limit 1").fetchone()
+    return None if row is None else row[0]
+
+def sync(db, blockchain):
+    """Disconnect the blocks that are not in the blockchain (anymore) and
+    connect the blocks of the blockchain that weren't connected yet.
+    Returns the number of disconnected and connected blocks."""
+    # the highest connected block that is still in the blockchain
+    forkpoint = min(tip(db), len(blockchain) - 1)
+    while forkpoint >= 0:
+        row = db.execute("select hash from blocks where idx = ?",
+                         (forkpoint,)).fetchone()
+        if row[0] == blockchain[forkpoint].get_hash():
+            break
+        forkpoint -= 1
+    disconnected = tip(db) - forkpoint
+    if forkpoint + 1 < len(blockchain) and \
+       blockchain[forkpoint + 1].is_pruned():
+        # the pruned blocks can't be connected one by one
+        restore_snapshot(db, blockchain)
+        forkpoint = blockchain.snapshot["index"]
+    for index in range(tip(db), forkpoint, -1):
+        disconnect_block(db, index)
+    for block in blockchain[forkpoint + 1:]:
+        connect_block(db, block)
+    db.commit()
+    return disconnected, len(blockchain) - forkpoint - 1
+
+def get_filters(db, start=0, end=None):
+    """A list of (index, hash, bloom filter in hex) of the blocks with
+    start <= index < end (or until the end)."""
+    return db.execute(
+        """select idx, hash, bloom from blocks where idx >= ? and idx < ?
+           order by idx""",
+        (start, 2**63 - 1 if end is None else end)).fetchall()
+
+def _confirmed_height(db, confirmations):
+    """The index of the last block with the given number of confirmations"""
+    return tip(db) - confirmations + 1
+
+def get_balance(db, address, confirmations=1):
+    """The balance of the address in the blocks with at least the given
+    number of confirmations (1 means anywhere in the blockchain)."""
+    if confirmations <= 1:
+        row = db.execute("select balance from balances where address = ?",
+                         (address,)).fetchone()
+        return NEW_ADDRESS_BALANCE if row is None else row[0]
+    height = _confirmed_height(db, confirmations)
+    row = db.execute(
+        """select balance - (select total(delta) from address_history
+                             where address = ? and block > ?)
+           from balances where address = ? and first_block <= ?""",
+        (address, height, address, height)).fetchone()
+    return NEW_ADDRESS_BALANCE if row is None else row[0]
+
+def _prefix_condition(prefix):
+    """An sql condition and its parameters for addresses starting with
+    prefix, expressed as a range so that it can use the index."""
+    if not prefix:
+        return "1", ()
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return "address >= ? and address < ?", (prefix, upper)
+
+def iter_balances(db, prefix="", after="", limit=None, confirmations=1):
+    """Generates (address, balance) of the addresses starting with prefix
+    that come after the given one, in order, at most limit of them, while
+    they are read. The balances are like in get_balance."""
+    condition, params = _prefix_condition(prefix)
+    if confirmations <= 1:
+        c = db.execute(
+            """select address, balance from balances
+               where address > ? and %s order by address limit ?""" % condition,
+            (after,) + params + (-1 if limit is None else limit,))
+    else:
+        height = _confirmed_height(db, confirmations)
+        c = db.execute(
+            """select address,
+                 balance - (select total(delta) from address_history
+                            where address_history.address = balances.address
+                              and block > ?)
+               from balances
+               where first_block <= ? and address > ? and %s
+               order by address limit ?""" % condition,
+            (height, height, after) + params + (-1 if limit is None else limit,))
+    return c
+
+def get_balances(db, prefix="", after="", limit=None, confirmations=1):
+    """Like iter_balances, as a list"""
+    return iter_balances(db, prefix, after, limit, confirmations).fetchall()
+
+def get_sender_balances(db):
+    """The balances of all addresses that send unprocessed transactions,
+    as a defaultdict like TransactionBlockChain.get_balances()."""
+    return defaultdict(lambda: NEW_ADDRESS_BALANCE, db.execute(
+        """select address, balance from balances where address in
+           (select from_addr from transactions where block is NULL)"""))
+
+def get_history(db, address, cursor=None, limit=100):
+    """The changes in the balance of the address, most recent first.
+    Returns a dictionary with at most limit entries under "history" and a
+    cursor to be passed to get the next page (None if there isn't any)."""
+    c = db.execute(
+        """select id, block, kind, uuid, delta from address_history
+           where address = ? and id < ? order by id desc limit ?""",
+        (address, 2**63 - 1 if cursor is None else cursor, limit))
+    history = [dict(zip(["id", "block", "kind", "uuid", "delta"], row))
+               for row in c]
+    return {"history": history,
+            "cursor": history[-1]["id"] if len(history) == limit else None}
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
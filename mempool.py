@@ -0,0 +1,389 @@
+#! /usr/bin/env python3
+
+"""The transaction database of a TransactionNode. It contains all transactions
+the node knows about, those that are included in a block of the local
+blockchain (block is not NULL) as well as the unprocessed ones, that together
+form the local view of the mempool.
+
+The unprocessed part is kept bounded:
+
+- transactions paying less than MIN_RELAY_FEE are not accepted
+- unprocessed transactions expire after MEMPOOL_EXPIRY seconds
+- when there are more than MEMPOOL_MAX_TRANSACTIONS unprocessed transactions,
+  or they take more than MEMPOOL_MAX_BYTES, the ones with the lowest fee per
+  byte are evicted
+- once a transaction of an address is mined, pending transactions of the same
+  address that can no longer be paid from its balance are dropped
+
+>>> from address import Address
+>>> db = connect(":memory:")
+>>> migrate(db)
+>>> addr = Address(seed="mempool")
+>>> tx = Transaction(addr.address, addr.address, 1.0, 0.01, "to myself")
+>>> tx.sign(addr)
+>>> insert(tx, db)
+>>> exists(tx, db)
+True
+>>> [t.uuid for t in get_unprocessed(db)] == [tx.uuid]
+True
+>>> sequence = mempool_sequence(db)
+>>> expire(db, now=time.time() + MEMPOOL_EXPIRY + 1)
+1
+>>> exists(tx, db)
+False
+>>> mempool_sequence(db) > sequence
+True
+"""
+
+import os
+import re
+import time
+import sqlite3
+import threading
+from transaction import Transaction
+from metrics import REGISTRY
+from config import MEMPOOL_MAX_TRANSACTIONS, MEMPOOL_MAX_BYTES, \
+    MEMPOOL_EXPIRY, MIN_RELAY_FEE
+
+QUERY_SECONDS = REGISTRY.histogram(
+    "db_query_seconds", "Time to execute a statement on the transaction "
+    "database (not including fetching the rows)")
+MEMPOOL_TRANSACTIONS = REGISTRY.gauge(
+    "mempool_transactions", "Number of unprocessed transactions")
+MEMPOOL_BYTES = REGISTRY.gauge(
+    "mempool_bytes", "Total size of the unprocessed transactions")
+
+# The columns that correspond to the Transaction constructor arguments
+FIELDS = ["uuid", "from_addr", "to_addr", "amount", "fee", "msg", "signature"]
+
+# Schema changes. The database stores how many of these have been applied in
+# its user_version, so that databases created by an earlier version of this
+# module are brought up to date when they are opened.
+MIGRATIONS = [
+    # 1: the original table
+    ["""create table if not exists transactions
+        (uuid      varchar primary key not null,
+         from_addr varchar             not null,
+         to_addr   varchar             not null,
+         amount    real                not null,
+         fee       real                not null,
+         msg       varchar             not null,
+         signature varchar             not null,
+         block     int);"""],
+    # 2: when a transaction was first seen and its size, for expiry and
+    # eviction. Existing transactions count as received now.
+    ["alter table transactions add column received real;",
+     "alter table transactions add column size int;",
+     """update transactions set
+        received = strftime('%s', 'now'),
+        size = length(uuid) + length(from_addr) + length(to_addr)
+               + length(msg) + length(signature) + 100;"""],
+    # 3: indexes for the lookups of unprocessed transactions (block is NULL),
+    # by fee for block templates and by address for pending balances
+    ["create index transactions_block_fee on transactions (block, fee);",
+     "create index transactions_from on transactions (from_addr, block);",
+     "create index transactions_to on transactions (to_addr, block);"],
+    # 4: the ledger (see ledger.py). The blocks of the transactions are set
+    # again as the blocks get connected to it.
+    ["""create table blocks
+        (idx  int     primary key not null,
+         hash varchar             not null);""",
+     """create table balances
+        (address varchar primary key not null,
+         balance real                not null) without rowid;""",
+     """create table address_history
+        (id      integer primary key autoincrement,
+         address varchar not null,
+         block   int     not null,
+         kind    varchar not null,
+         uuid    varchar,
+         delta   real    not null);""",
+     "create index address_history_address on address_history (address, id);",
+     "create index address_history_block on address_history (block);",
+     "update transactions set block = NULL;"],
+    # 5: the bloom filters of the blocks. As the ledger is only extended,
+    # blocks connected earlier are disconnected to have them recomputed.
+    ["alter table blocks add column bloom varchar;",
+     "delete from address_history;",
+     "delete from balances;",
+     "delete from blocks;",
+     "update transactions set block = NULL;"],
+    # 6: the first block in which an address appears, so that the balances
+    # with several confirmations don't need the history before that block,
+    # which is discarded when pruning.
+    ["alter table balances add column first_block int;",
+     """update balances set first_block =
+          (select min(block) from address_history
+           where address_history.address = balances.address);"""],
+    # 7: a sequence number that changes whenever the unprocessed
+    # transactions do, as a cheap version of the mempool for ETags.
+    ["""create table meta
+        (key   varchar primary key not null,
+         value int                 not null) without rowid;""",
+     "insert into meta (key, value) values ('mempool_sequence', 0);",
+     """create trigger mempool_insert after insert on transactions
+        when new.block is NULL begin
+          update meta set value = value + 1 where key = 'mempool_sequence';
+        end;""",
+     """create trigger mempool_delete after delete on transactions
+        when old.block is NULL begin
+          update meta set value = value + 1 where key = 'mempool_sequence';
+        end;""",
+     """create trigger mempool_update after update of block on transactions
+        when old.block is NULL or new.block is NULL begin
+          update meta set value = value + 1 where key = 'mempool_sequence';
+        end;"""],
+    # 8: a random identity of the database, so that the mempool sequence
+    # of a database created again can't be mistaken for that of the old one
+    ["insert into meta (key, value) values ('database_id', abs(random()));"],
+]
+
+# Applied to every connection. In write-ahead-log mode readers (the web
+# server) don't block the writer (the miner) and vice versa, and with
+# synchronous=normal a commit doesn't wait for an fsync. This can only lose
+# the last transactions on a power failure, which the mempool can recover
+# from peers.
+PRAGMAS = [
+    "pragma journal_mode = wal",
+    "pragma synchronous = normal",
+    "pragma busy_timeout = 5000",
+    "pragma temp_store = memory",
+    "pragma cache_size = -16000", # in KiB
+]
+
+# the first table that a statement names
+STATEMENT_TABLE = re.compile(
+    r"\b(?:from|into|update|table|index|trigger)\s+(?:if\s+not\s+exists\s+)?"
+    r"(\w+)", re.IGNORECASE)
+
+class TimedConnection(sqlite3.Connection):
+    """A connection that records the time to execute statements in the
+    metric db_query_seconds, by kind of statement, e.g. "select
+    transactions"."""
+    _kinds = {} # statement: kind
+
+    def _kind(self, statement):
+        kind = self._kinds.get(statement)
+        if kind is None:
+            words = statement.split(None, 1)
+            table = STATEMENT_TABLE.search(statement)
+            kind = " ".join(([words[0].lower()] if words else []) +
+                            ([table.group(1)] if table else []))
+            self._kinds[statement] = kind
+        return kind
+
+    def execute(self, statement, *args):
+        with QUERY_SECONDS.time(statement=self._kind(statement)):
+            return sqlite3.Connection.execute(self, statement, *args)
+
+    def executemany(self, statement, *args):
+        with QUERY_SECONDS.time(statement=self._kind(statement)):
+            return sqlite3.Connection.executemany(self, statement, *args)
+
+def connect(path):
+    """Open a connection to the database at path with the PRAGMAS applied."""
+    db = sqlite3.connect(path, factory=TimedConnection)
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+class Database(object):
+    """The transaction database at the given path.
+    sqlite connections must not be used by several threads (the web server
+    handles every request in a thread) or shared between the processes of
+    the node, so every thread of every process gets its own connection,
+    opened on first use."""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        pid, db = getattr(self._local, "connection", (None, None))
+        if pid != os.getpid(): # first use in this thread, or forked
+            db = connect(self.path)
+            self._local.connection = (os.getpid(), db)
+        return db
+
+def migrate(db):
+    """Create the tables, or bring them up to date if they were created by
+    an earlier version."""
+    version = db.execute("pragma user_version").fetchone()[0]
+    for n, statements in enumerate(MIGRATIONS[version:], version + 1):
+        for statement in statements:
+            db.execute(statement)
+        db.execute("pragma user_version = %d" % n)
+        db.commit()
+
+def transaction_size(tx):
+    """The size in bytes of a transaction, as it is stored and sent around."""
+    return tx.size()
+
+def is_relayable(tx):
+    """Whether the transaction pays enough to be accepted in the mempool."""
+    return float(tx.fee) >= MIN_RELAY_FEE
+
+def exists(tx, db):
+    c = db.execute(
+        "select count(*) from transactions where uuid=?;", (tx.uuid,))
+    return c.fetchone()[0] != 0
+
+def existing(uuids, db):
+    """The set of the uuids of transactions that exist, looked up together"""
+    uuids = list(uuids)
+    found = set()
+    # in pieces, as the number of parameters of a statement is limited
+    for i in range(0, len(uuids), 500):
+        piece = uuids[i:i + 500]
+        found.update(uuid for (uuid,) in db.execute(
+            "select uuid from transactions where uuid in (%s)"
+            % ", ".join("?" * len(piece)), piece))
+    return found
+
+INSERT = """insert %s into transactions
+            (uuid, from_addr, to_addr, amount, fee, msg, signature,
+             block, received, size)
+            values (:uuid, :from_addr, :to_addr, :amount, :fee, :msg,
+                    :signature, :block, :received, :size)"""
+
+def _row(tx, block, received):
+    return dict(tx.__dict__, block=block, received=received,
+                size=transaction_size(tx))
+
+def insert(tx, db, block=None, ignore=False, commit=True):
+    """Insert the transaction. With ignore=True, nothing happens if it
+    already exists."""
+    db.execute(INSERT % ("or ignore" if ignore else ""),
+               _row(tx, block, time.time()))
+    if commit:
+        db.commit()
+
+def insert_many(txs, db, block=None, ignore=False, commit=True):
+    """Insert the transactions with a single statement, as insert"""
+    received = time.time()
+    db.executemany(INSERT % ("or ignore" if ignore else ""),
+                   [_row(tx, block, received) for tx in txs])
+    if commit:
+        db.commit()
+
+def to_transaction(row):
+    """Convert a row with the columns in FIELDS to a Transaction"""
+    return Transaction(**dict(zip(FIELDS, row)))
+
+def iter_unprocessed(db):
+    """Generates the unprocessed transactions while they are read"""
+    c = db.execute(
+        """select uuid, from_addr, to_addr, amount, fee, msg, signature
+           from transactions where block is NULL""")
+    return (to_transaction(data) for data in c)
+
+def get_unprocessed(db):
+    return list(iter_unprocessed(db))
+
+def mempool_sequence(db):
+    """A number that changes whenever the unprocessed transactions change"""
+    return db.execute(
+        "select value from meta where key = 'mempool_sequence'").fetchone()[0]
+
+def mempool_etag(db):
+    """An ETag for responses derived from the unprocessed transactions: the
+    identity of the database and the mempool sequence"""
+    return "%x-%d" % db.execute(
+        """select (select value from meta where key = 'database_id'),
+                  (select value from meta where key = 'mempool_sequence')"""
+    ).fetchone()
+
+def pending_balance(db, address):
+    """The change in the balance of address due to unprocessed transactions"""
+    return db.execute(
+        """select
+             (select total(amount) from transactions
+              where to_addr = ? and block is NULL) -
+             (select total(amount + fee) from transactions
+              where from_addr = ? and block is NULL)""",
+        (address, address)).fetchone()[0]
+
+def pending_balances(db):
+    """A dictionary with the change in the balance due to unprocessed
+    transactions of all addresses that appear in them, computed in a single
+    pass."""
+    return dict(db.execute(
+        """select address, total(delta) from
+             (select to_addr as address, amount as delta
+              from transactions where block is NULL
+              union all
+              select from_addr, -(amount + fee)
+              from transactions where block is NULL)
+           group by address"""))
+
+def expire(db, now=None):
+    """Remove unprocessed transactions that have been waiting longer than
+    MEMPOOL_EXPIRY seconds. Returns the number of removed transactions."""
+    now = time.time() if now is None else now
+    c = db.execute(
+        "delete from transactions where block is NULL and received < ?",
+        (now - MEMPOOL_EXPIRY,))
+    db.commit()
+    return c.rowcount
+
+def evict(db, max_transactions=MEMPOOL_MAX_TRANSACTIONS,
+          max_bytes=MEMPOOL_MAX_BYTES):
+    """Remove the unprocessed transactions with the lowest fee per byte
+    until both limits are satisfied. Among equal fees the most recently
+    received ones go first. Returns the uuids of the removed transactions.
+    Only when the limits are exceeded are the transactions sorted, and
+    only those that are removed are read."""
+    count, total = db.execute(
+        """select count(*), total(size) from transactions
+           where block is NULL""").fetchone()
+    evicted = []
+    if count > max_transactions or total > max_bytes:
+        c = db.execute(
+            """select uuid, size from transactions where block is NULL
+               order by fee / size, received desc""")
+        for uuid, size in c:
+            if count <= max_transactions and total <= max_bytes:
+                break
+            evicted.append((uuid,))
+            count -= 1
+            total -= size
+        c.close()
+        db.executemany("delete from transactions where uuid = ?", evicted)
+        db.commit()
+    MEMPOOL_TRANSACTIONS.set(count)
+    MEMPOOL_BYTES.set(total)
+    return [uuid for (uuid,) in evicted]
+
+def drop_conflicting(db, balances):
+    """Remove unprocessed transactions that conflict with mined ones: for
+    every address that has spent in the blockchain, keep its pending
+    transactions (highest fee first) as long as its balance can pay for
+    them and drop the rest. Other addresses may still be waiting for
+    incoming funds, so their transactions are left alone.
+    balances are the balances in the blockchain.
+    Returns the number of removed transactions."""
+    c = db.execute(
+        """select uuid, from_addr, amount, fee from transactions
+           where block is NULL and from_addr in
+             (select from_addr from transactions where block is not NULL)
+           order by from_addr, fee desc""")
+    remaining = {}
+    dropped = []
+    for uuid, from_addr, amount, fee in c:
+        balance = remaining.get(from_addr, balances[from_addr])
+        if amount + fee > balance:
+            dropped.append((uuid,))
+        else:
+            remaining[from_addr] = balance - amount - fee
+    db.executemany("delete from transactions where uuid = ?", dropped)
+    db.commit()
+    return len(dropped)
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
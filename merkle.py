@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+
+"""Merkle trees over hex hashes, and proofs that a leaf is in a tree.
+Leaves and inner nodes are hashed with a different prefix, so that an inner
+node can't be passed off as a leaf. A node without a sibling is moved up
+unchanged (rather than paired with itself as in Bitcoin, which allows
+different lists of leaves to have the same root).
+
+>>> leaves = [leaf_hash(s) for s in ["a", "b", "c", "d", "e"]]
+>>> root = merkle_root(leaves)
+>>> proof = merkle_proof(leaves, 2)
+>>> len(proof)
+3
+>>> verify_proof(leaf_hash("c"), proof, root)
+True
+>>> verify_proof(leaf_hash("x"), proof, root)
+False
+>>> merkle_root([]) == leaf_hash("")
+True
+"""
+
+import hashlib
+
+def leaf_hash(s):
+    """The hash of a leaf with the (string) content s"""
+    return hashlib.sha256(b"\x00" + s.encode("utf8")).hexdigest()
+
+def node_hash(left, right):
+    """The hash of an inner node with the given children"""
+    return hashlib.sha256(
+        b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+def _next_level(level):
+    return [node_hash(*level[i:i+2]) if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)]
+
+def merkle_root(leaves):
+    """The root of the tree with the given leaf hashes"""
+    level = list(leaves) or [leaf_hash("")]
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+def merkle_proof(leaves, index):
+    """The list of [side, hash] of the siblings on the path from leaf number
+    index to the root, where side is "L" or "R" for a sibling on the left
+    or on the right."""
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(["L" if sibling < index else "R", level[sibling]])
+        level = _next_level(level)
+        index //= 2
+    return proof
+
+def verify_proof(leaf, proof, root):
+    """Whether the proof (as returned by merkle_proof) shows that the leaf
+    hash is in the tree with the given root."""
+    h = leaf
+    for side, sibling in proof:
+        h = node_hash(sibling, h) if side == "L" else node_hash(h, sibling)
+    return h == root
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
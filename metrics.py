@@ -0,0 +1,242 @@
+#! /usr/bin/env python3
+
+"""Runtime metrics of a node, exported at /metrics in the text format of
+Prometheus: counters, gauges and histograms, with labels.
+
+Every process records its metrics in a registry in its own memory, so that
+recording one costs no more than a dictionary update under an uncontended
+lock. The miner publishes a snapshot of its registry in shared memory every
+METRICS_INTERVAL seconds, and the web server exports it along with its
+own, distinguished by a label process.
+
+>>> registry = Registry()
+>>> requests_total = registry.counter("requests_total", "Requests handled")
+>>> latency = registry.histogram("latency_seconds", "Latency",
+...                              buckets=(0.1, 1))
+>>> requests_total.inc(route="/a"); requests_total.inc(2, route="/a")
+>>> latency.observe(0.25); latency.observe(0.5)
+>>> print(exposition({"web": registry.snapshot()}))
+# HELP latency_seconds Latency
+# TYPE latency_seconds histogram
+latency_seconds_bucket{process="web",le="0.1"} 0
+latency_seconds_bucket{process="web",le="1"} 2
+latency_seconds_bucket{process="web",le="+Inf"} 2
+latency_seconds_sum{process="web"} 0.75
+latency_seconds_count{process="web"} 2
+# HELP requests_total Requests handled
+# TYPE requests_total counter
+requests_total{process="web",route="/a"} 3
+"""
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# the default upper bounds of the buckets of histograms, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, lock):
+        self.name = name
+        self.help = help
+        self._lock = lock
+        self._values = {} # sorted tuple of label pairs: value
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def _sample(self, value):
+        return value
+
+    def snapshot(self):
+        """A json encodable description of the metric and its values"""
+        with self._lock:
+            return {"type": self.type, "help": self.help,
+                    "samples": [[dict(key), self._sample(value)]
+                                for key, value in self._values.items()]}
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, lock, buckets=BUCKETS):
+        Metric.__init__(self, name, help, lock)
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # the number of values in each bucket (the last one for
+                # values above all bounds), and their sum
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _sample(self, value):
+        return [list(value[0]), value[1]]
+
+    def snapshot(self):
+        snapshot = Metric.snapshot(self)
+        snapshot["buckets"] = self.buckets
+        return snapshot
+
+class Registry(object):
+    """The metrics of a process, by name"""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, cls, name, help, *args):
+        # a metric is created once, also if it is declared more than once
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, help, self._lock, *args)
+            return self._metrics[name]
+
+    def counter(self, name, help):
+        return self._add(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._add(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self._add(Histogram, name, help, buckets)
+
+    def snapshot(self):
+        """A json encodable dictionary {name: snapshot of the metric}"""
+        return dict((name, metric.snapshot())
+                    for name, metric in list(self._metrics.items()))
+
+    def clear(self):
+        """Forget all values, e.g. those recorded before a fork"""
+        for metric in list(self._metrics.values()):
+            metric.clear()
+
+# the registry of this process
+REGISTRY = Registry()
+
+def without_label(snapshot, label):
+    """The snapshot of a registry with the samples that differ only in the
+    given label added up, e.g. to keep it small
+
+    >>> registry = Registry()
+    >>> received = registry.counter("received_bytes_total", "Received")
+    >>> received.inc(10, peer="a", path="/x")
+    >>> received.inc(5, peer="b", path="/x")
+    >>> snapshot = without_label(registry.snapshot(), "peer")
+    >>> snapshot["received_bytes_total"]["samples"]
+    [[{'path': '/x'}, 15]]
+    """
+    result = {}
+    for name, metric in snapshot.items():
+        samples = {} # sorted tuple of the other label pairs: value
+        for labels, value in metric["samples"]:
+            key = tuple(sorted((k, v) for k, v in labels.items() if k != label))
+            if key not in samples:
+                samples[key] = value
+            elif metric["type"] == "histogram":
+                counts, total = samples[key]
+                samples[key] = [[a + b for a, b in zip(counts, value[0])],
+                                total + value[1]]
+            else:
+                samples[key] = samples[key] + value
+        result[name] = dict(metric, samples=[[dict(key), value] for key, value
+                                             in samples.items()])
+    return result
+
+def _format_value(value):
+    return "+Inf" if value == float("inf") else str(value)
+
+def _format_labels(labels):
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels)
+
+def _lines(name, snapshot, labels):
+    """The lines of the text format of the sample of metric name with the
+    labels (a list of pairs)"""
+    if snapshot["type"] != "histogram":
+        yield "%s%s %s" % (name, _format_labels(labels),
+                           _format_value(snapshot["value"]))
+        return
+    counts, total = snapshot["value"]
+    cumulative = 0
+    for bound, count in zip(snapshot["buckets"] + [float("inf")], counts):
+        cumulative += count
+        yield "%s_bucket%s %d" % (
+            name, _format_labels(labels + [("le", _format_value(bound))]),
+            cumulative)
+    yield "%s_sum%s %s" % (name, _format_labels(labels), _format_value(total))
+    yield "%s_count%s %d" % (name, _format_labels(labels), cumulative)
+
+def exposition(snapshots):
+    """The text format of Prometheus of the snapshots of the registries of
+    processes, given as a dictionary {process: snapshot}"""
+    lines = []
+    names = sorted(set(name for snapshot in snapshots.values()
+                       for name in snapshot))
+    for name in names:
+        described = False
+        for process in sorted(snapshots):
+            metric = snapshots[process].get(name)
+            if metric is None:
+                continue
+            if not described:
+                lines.append("# HELP %s %s" % (name, metric["help"]))
+                lines.append("# TYPE %s %s" % (name, metric["type"]))
+                described = True
+            for labels, value in sorted(metric["samples"],
+                                        key=lambda sample:
+                                        sorted(sample[0].items())):
+                lines.extend(_lines(
+                    name, dict(metric, value=value),
+                    [("process", process)] + sorted(labels.items())))
+    return "\n".join(lines) + "\n"
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
@@ -9,12 +9,33 @@ In parallel it runs an http server that operates a full node:
 
 /blockchain    - returns the current blockchain in json format
 /chainlength   - returns the length of the chain of this miner
+/chainwork     - returns its length and its cumulative work (the expected
+                 number of hashes needed to mine it) as json
 /block?index=n - returns block n in json format, or 400 if doesn't exist
+                 and 410 if its data has been pruned
+/blocks?start=n&end=m
+               - returns blocks n, ..., m-1 (as far as they exist) like
+                 /blockchain
+
+/blockchain and /block are served in the binary encoding of encoding.py
+instead when the Accept header prefers encoding.MIMETYPE, and compressed with
+zstd (if the zstandard package is installed) or gzip when the Accept-Encoding
+header allows it. /blockchain is streamed, one block at a time. It has an
+ETag (the hash of the last block) so that peers can poll it with
+If-None-Match, and get an empty 304 response if it didn't change.
+/capabilities  - what this node can serve
+/metrics       - runtime metrics of the web server and the miner, in the
+                 text format of Prometheus (see metrics.py)
+/profiling     - switch profiling on or off (only from this host)
+/profiles      - the profiles of the routes and the phases of the miner
+                 (see profiling.py)
 
 provides tracking services:
 
-/nodes         - return a list of registered nodes
+/nodes         - return a list of registered nodes (the active view)
 /register      - register as a peer
+/shuffle       - exchange a sample of known peers (see peers.py)
+/announce      - announce a new block
 
 Later (if needed) /whichblock(txid)
 
@@ -24,26 +45,96 @@ and
 
 """
 
-from blockchain import BlockChain
-from config import DIFFICULTY, DATA_DIR, NODE_ADDRESSES
+from blockchain import BlockChain, BlockTemplate, HASHES
+from block import block_filenames, block_filename, read_block_file
+import encoding
+from config import DIFFICULTY, DATA_DIR, NODE_ADDRESSES, CONFIRMATIONS, \
+    PRUNE_DEPTH, SHARED_PEERS_BYTES, SHARED_DICT_BYTES, PEER_REFRESH_INTERVAL, \
+    SYNC_INTERVAL, MEMPOOL_PULL_INTERVAL, BLOCK_TEMPLATE_INTERVAL, \
+    MINING_SLICE, ACTIVE_VIEW_SIZE, PASSIVE_VIEW_SIZE, SHUFFLE_SIZE, \
+    METRICS_INTERVAL, SHARED_METRICS_BYTES, PROFILE
 from util import port_is_free
-from flask import Flask, request, abort, escape
+from peers import PeerTable, add_to_view, sample_view
+from download import download_blocks, block_hash
+from metrics import REGISTRY, exposition, without_label
+from profiling import Profiler, list_profiles, profile_text
+from flask import Flask, Response, request, abort, escape, g, \
+    send_from_directory
 import requests
 import os
 import json
+import zlib
+import random
 import sys
 import time
 import getopt
-from multiprocessing import Process, Manager
+from multiprocessing import Process
+from sharedstate import SharedDict
+from scheduler import Activity
+import threading
+from contextlib import contextmanager
+try:
+    import zstandard
+except ImportError: # optional, responses are then only compressed with gzip
+    zstandard = None
+
+# content codings (compression methods) of responses, in order of preference
+CONTENT_CODINGS = ["gzip"] if zstandard is None else ["zstd", "gzip"]
 
-process_manager = Manager()
 node = Flask(__name__)
+node.prune_depth = None # set in start(...)
+node.address = None # set in start(...)
 # dictionary (peer, time) of peers and the last time at which they were seen
 # to be active. This node itself shouldn't be in the set, dictionary, though
-# this is not assumed.
-active_peers = process_manager.dict()
-# Generic dictionary to be shared between processes
-shared_dict = process_manager.dict()
+# this is not assumed. This is the active view of the gossip membership: at
+# most ACTIVE_VIEW_SIZE peers.
+active_peers = SharedDict(SHARED_PEERS_BYTES)
+# dictionary (peer, time) of the passive view: at most PASSIVE_VIEW_SIZE
+# other peers that this node heard of, from which the active view is refilled
+passive_peers = SharedDict(SHARED_PEERS_BYTES)
+# Generic dictionary to be shared between processes: the running flag and
+# the status of the miner
+shared_dict = SharedDict(SHARED_DICT_BYTES)
+# the last snapshot of the metrics of the miner, published for /metrics
+shared_metrics = SharedDict(SHARED_METRICS_BYTES)
+# profiles the routes and the phases of the miner while the shared flag
+# "profiling" is set; its directory is set in start(...)
+profiler = Profiler(lambda: shared_dict.get("profiling", PROFILE),
+                    process="web")
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_seconds", "Time to handle a request (until the response "
+    "starts, for streamed responses)")
+PHASE_SECONDS = REGISTRY.histogram(
+    "miner_phase_seconds", "Time spent in each phase of the miner")
+CHAIN_LENGTH = REGISTRY.gauge("chain_length", "Length of the blockchain")
+HASHRATE = REGISTRY.gauge(
+    "miner_hashrate", "Nonces tried per second since the last update")
+HASHING = REGISTRY.gauge(
+    "miner_hashing_ratio", "Fraction of the time spent mining")
+PEERS = REGISTRY.gauge("peers", "Number of peers in each view")
+
+def route():
+    return request.url_rule.rule if request.url_rule else "unknown"
+
+@node.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+    g.profile = profiler.start("route", route())
+
+@node.after_request
+def record_request_time(response):
+    profiler.stop(g.profile)
+    REQUEST_SECONDS.observe(time.perf_counter() - g.start_time, route=route(),
+                            method=request.method,
+                            status=str(response.status_code))
+    return response
+
+@contextmanager
+def phase(name):
+    """Time (see /metrics) and, if enabled, profile a phase of the miner"""
+    with PHASE_SECONDS.time(phase=name), profiler.profile("phase", name):
+        yield
 
 def timeout_peers():
     """Remove stale peers from the list of active peers"""
@@ -74,9 +165,40 @@ def nodes():
 
 @node.route('/register', methods=['GET'])
 def register():
+    """Adds the peer to the active view. If that is full, a random other
+    peer is moved to the passive view to make room."""
     address = request.args.get('url')
-    active_peers[address] = time.time()
+    passive_peers.pop(address, None)
+    evicted = add_to_view(active_peers, [address], ACTIVE_VIEW_SIZE)
+    add_to_view(passive_peers, evicted, PASSIVE_VIEW_SIZE)
     return "registered %s" % escape(address)
+
+@node.route('/shuffle', methods=['GET'])
+def shuffle():
+    """A peer sends a sample of the peers it knows (peers, repeated), and
+    gets a sample of those this node knows in return, as a json list. The
+    peers received are added to the passive view."""
+    address = request.args.get('url')
+    received = request.args.getlist('peers')
+    sample = sample_view([active_peers, passive_peers], SHUFFLE_SIZE,
+                         exclude=received + [address, node.address])
+    add_to_view(passive_peers, received, PASSIVE_VIEW_SIZE,
+                exclude=active_peers.keys() + [node.address])
+    return json.dumps(sample)
+
+@node.route('/announce', methods=['GET'])
+def announce():
+    """A peer announces that it has a blockchain of the given length. The
+    miner then syncs right away instead of at its next poll."""
+    address = request.args.get('url')
+    try:
+        length = int(request.args.get('length', ''))
+    except ValueError:
+        abort(400)
+    if not address or length < 0:
+        abort(400)
+    shared_dict["announced"] = [address, length, time.time()]
+    return "announced %s" % escape(address)
     
 # @node.route('/unregister', methods=['GET'])
 # def unregister():
@@ -100,27 +222,202 @@ def get_nodedata_dir(port, dirname, blockchain_class, create=False):
 
 def get_chaindata_dir(port, blockchain_class, create=False):
     return get_nodedata_dir(port, "chaindata", blockchain_class, create)
+
+def stored_chainlength(chaindata_dir):
+    """The number of blocks stored in chaindata_dir"""
+    return len(block_filenames(chaindata_dir))
+
+def _compressor(coding):
+    if coding == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj(wbits=16 + zlib.MAX_WBITS) # gzip
+
+def _compress(chunks, compressor):
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def compressed_response(chunks, mimetype):
+    """A response that streams the chunks (bytes), compressed with one of
+    CONTENT_CODINGS if the client accepts it."""
+    coding = request.accept_encodings.best_match(CONTENT_CODINGS)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if coding is not None:
+        chunks = _compress(chunks, _compressor(coding))
+        headers["Content-Encoding"] = coding
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+def _binary_preferred():
+    best = request.accept_mimetypes.best_match(
+        [encoding.JSON_MIMETYPE, encoding.MIMETYPE])
+    return best == encoding.MIMETYPE
+
+def encoded_response(value):
+    """A response with the value in the binary encoding of encoding.py if
+    the client prefers it, and in json otherwise."""
+    if _binary_preferred():
+        return compressed_response([encoding.dumps(value)], encoding.MIMETYPE)
+    return compressed_response([json.dumps(value).encode("utf8")],
+                               encoding.JSON_MIMETYPE)
+
+def streamed_response(items, pairs=False):
+    """Like encoded_response for the list of items (the dictionary of
+    (key, value) pairs if pairs), but the items are encoded one at a time
+    while the response is sent, so that they can come from a generator."""
+    binary = _binary_preferred()
+    return compressed_response(
+        encoding.iter_dumps(items, binary=binary, pairs=pairs),
+        encoding.MIMETYPE if binary else encoding.JSON_MIMETYPE)
+    
+def conditional_response(etag, make_response):
+    """Honors If-None-Match: an empty 304 (Not Modified) response if the
+    client already has the version of the resource with the (weak) ETag,
+    and otherwise the response returned by make_response(), which isn't
+    called for a 304."""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304,
+                            headers={"Vary": "Accept, Accept-Encoding"})
+    else:
+        response = make_response()
+    response.set_etag(etag, weak=True)
+    return response
+
+def chain_etag(chaindata_dir):
+    """The ETag of the blockchain stored in chaindata_dir: the hash of its
+    last block"""
+    filenames = block_filenames(chaindata_dir)
+    if not filenames:
+        return "empty"
+    return node.chainclass.new_block(
+        **read_block_file(filenames[-1])).get_hash()
     
 @node.route('/blockchain', methods=['GET'])
 def blockchain():
     """
     Loads the blockchain from disk and serves it as a json list of dictionaries.
+    Supports conditional requests, with the hash of the last block as ETag.
     """
     port = request.environ["SERVER_PORT"] # already is a string
-    ret = node.chainclass.load(get_chaindata_dir(port, node.chainclass)).as_json()
-    return ret
+    chaindata_dir = get_chaindata_dir(port, node.chainclass)
+    # the blocks are read from disk one at a time while they are sent
+    return conditional_response(
+        chain_etag(chaindata_dir),
+        lambda: streamed_response(
+            read_block_file(filename)
+            for filename in block_filenames(chaindata_dir)))
+
+@node.route('/blocks', methods=['GET'])
+def blocks():
+    """
+    Serves the blocks start, ..., end-1 (by default up to the last one) like
+    /blockchain, so that a node can download a blockchain in pieces from
+    several peers. The list ends early if there are fewer blocks.
+    """
+    try:
+        start = int(request.args.get('start', 0))
+        end = request.args.get('end')
+        end = None if end is None else int(end)
+    except ValueError:
+        abort(400)
+    port = request.environ["SERVER_PORT"]
+    chaindata_dir = get_chaindata_dir(port, node.chainclass)
+    def iter_blocks():
+        index = start
+        while end is None or index < end:
+            filename = block_filename(chaindata_dir, index)
+            if filename is None:
+                return
+            yield read_block_file(filename)
+            index += 1
+    return streamed_response(iter_blocks())
 
 @node.route('/chainlength', methods=['GET'])
 def chainlength():
     """Note that the indexing starts at 0, so if the length is n, the next
     block to mine is block n."""
+    # published by the miner once it has saved the blockchain
+    length = shared_dict.get("chainlength")
+    if length is None: # the miner didn't start yet
+        port = request.environ["SERVER_PORT"]
+        length = stored_chainlength(get_chaindata_dir(port, node.chainclass))
+    return str(length)
+
+@node.route('/chainwork', methods=['GET'])
+def chainwork():
+    """The length and the cumulative work of the blockchain of the miner, as
+    a json dictionary {"length": ..., "work": ...}. The blockchain with the
+    most work wins, which need not be the longest one, as the target of the
+    proof of work is adjusted to the time blocks take (see
+    BlockChain.target)."""
+    # published by the miner once it has loaded or saved the blockchain
+    chainwork = shared_dict.get("chainwork")
+    if chainwork is None: # the miner didn't start yet
+        abort(503)
+    return json.dumps(chainwork)
+
+@node.route('/metrics', methods=['GET'])
+def metrics():
+    """The metrics of the web server and the last ones published by the
+    miner, in the text format of Prometheus"""
+    PEERS.set(len(active_peers), view="active")
+    PEERS.set(len(passive_peers), view="passive")
+    snapshots = dict(shared_metrics.items())
+    snapshots["web"] = REGISTRY.snapshot()
+    return Response(exposition(snapshots),
+                    mimetype="text/plain; version=0.0.4")
+
+@node.route('/profiling', methods=['GET'])
+def profiling():
+    """Switches profiling on (enable=1) or off (enable=0), and returns
+    whether it is on. Only for requests from this host."""
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(403)
+    if "enable" in request.args:
+        shared_dict["profiling"] = request.args.get("enable") == "1"
+    return json.dumps(shared_dict.get("profiling", PROFILE))
+
+@node.route('/profiles', methods=['GET'])
+def profiles():
+    """The names of the profile files as a json list, the most recent
+    first, or the file with the given name, as a pstats file or with
+    format=text as text"""
+    profiler.flush(profiler.interval)
+    name = request.args.get('name')
+    if name is None:
+        return json.dumps(list_profiles(profiler.directory))
+    if name not in list_profiles(profiler.directory):
+        abort(404)
+    if request.args.get('format') == "text":
+        return Response(profile_text(os.path.join(profiler.directory, name)),
+                        mimetype="text/plain")
+    return send_from_directory(profiler.directory, name,
+                               mimetype="application/octet-stream")
+
+@node.route('/capabilities', methods=['GET'])
+def capabilities():
+    """A json dictionary describing what this node can serve:
+    chainclass    - the name of the blockchain class, as for /running
+    pruned        - whether the data of old blocks is discarded
+    prune_depth   - the number of recent blocks whose data is kept (null
+                    if the node is not pruned)
+    first_block   - the index of the first block whose data this node has
+    """
     port = request.environ["SERVER_PORT"]
-    return str(len(os.listdir(get_chaindata_dir(port, node.chainclass))))
+    length = stored_chainlength(get_chaindata_dir(port, node.chainclass))
+    return json.dumps({
+        "chainclass": node.chainclass.__name__,
+        "pruned": node.prune_depth is not None,
+        "prune_depth": node.prune_depth,
+        "first_block": 0 if node.prune_depth is None else
+                       max(length - node.prune_depth, 0)})
     
 @node.route('/block', methods=['GET'])
 def block():
     """
     Loads the specified block from disk and serves it as a json dictionary.
+    Supports conditional requests, with the hash of the block as ETag.
     """
     # trick to inspect request:
     # def unknown_type_handler(x):
@@ -132,117 +429,257 @@ def block():
     index = int(request.args.get('index'))
     # find out what port you are running on: that is the directory name
     port = request.environ["SERVER_PORT"]
-    filename = os.path.join(get_chaindata_dir(port, node.chainclass),
-                            "%06d.json" % index)
-    if not os.path.isfile(filename):
+    filename = block_filename(get_chaindata_dir(port, node.chainclass), index)
+    if filename is None:
         abort(400)
-    with open(filename, 'r') as block_file:
-        return block_file.read()
-
-def chainlength(url):
-    address = "http://%s/chainlength" % url
-    try:
-        return int(requests.get(address).text)
-    except:
-        return -1
+    block_info = read_block_file(filename)
+    if block_info["data"] is None:
+        abort(410) # Gone: pruned
+    return conditional_response(
+        node.chainclass.new_block(**block_info).get_hash(),
+        lambda: encoded_response(block_info))
 
 class Synchronizer(object):
     """
     In the main process an instance of the Synchronizer is passed. At the beginning
-    init(...) will be called once. Then in every mining iteration:
-
-    update_peers(...)
-    get_longest_blockchain(...)
-    next_block_data(...)
+    init(...) will be called once. Then the Miner calls, each in its own
+    thread and at its own pace:
+
+    update_peers(...)            every PEER_REFRESH_INTERVAL
+    get_longest_blockchain(...)  every SYNC_INTERVAL or when a peer announces
+                                 a new block
+    pull_mempool(...)            every MEMPOOL_PULL_INTERVAL
+    announce(...)                after a block was mined or received
+    update(...), next_block_data(...)
+                                 when the tip changes or every
+                                 BLOCK_TEMPLATE_INTERVAL, before mining
     """
     chainclass = BlockChain
     
-    def init(self, host, port, shared_dict, active_peers):
+    def init(self, host, port, shared_dict, active_peers, prune_depth=None,
+             reindex=False):
         self.host = host
         self.port = port
         self.shared_dict = shared_dict
         self.active_peers = active_peers    
+        self.passive_peers = passive_peers
+        # keep the data of only this number of blocks (None: all)
+        self.prune_depth = prune_depth
+        # validate all blocks on loading, also those validated before
+        self.reindex = reindex
+        # the ETag of the last response handled for every url polled with a
+        # conditional request
+        self.etags = {}
+        # the hash of the last block of an invalid blockchain, for every
+        # peer that offered one, so that it isn't downloaded again
+        self.rejected = {}
+        # the health of the peers, to contact the best ones first and to
+        # back off from those that fail
+        self.peer_table = PeerTable()
         
     @property
     def node_address(self):
         return "%s:%d" % (self.host, self.port)
         
-    # def update(self, blockchain):
-    #     return
+    def update(self, blockchain):
+        """Called with the current blockchain before the data of the next
+        block is requested, to keep state derived from it up to date."""
+        return
 
-    @classmethod
-    def running(cls, url):
+    def running(self, url):
         """Returns whether a compatible node is running at this address."""
-        address = "http://%s/running" % url
         try:
-            return requests.get(address).text == cls.chainclass.__name__
-        except:
+            return self.peer_table.get(url, "/running").text == \
+                self.chainclass.__name__
+        except requests.RequestException:
             return False
-    
+
+    def chainwork(self, url):
+        """The length and the cumulative work of the blockchain of the node
+        at this address, (-1, -1) if they can't be obtained."""
+        try:
+            chainwork = self.peer_table.get(url, "/chainwork").json()
+            return int(chainwork["length"]), int(chainwork["work"])
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return -1, -1
+
+    def is_pruned(self, url):
+        """Returns whether the node at this address discards the data of
+        old blocks, according to its /capabilities. Nodes that don't
+        provide them are assumed not to; None if they can't be obtained."""
+        try:
+            return bool(
+                self.peer_table.get(url, "/capabilities").json()["pruned"])
+        except ValueError: # not json
+            return False
+        except (requests.RequestException, KeyError, TypeError):
+            return None
+
     def update_peers(self, active_peers, addresses=None):
-        """Add the addresses to the known peers (if specified), obtain all peers 
-        of known peers, check their status, register with the live ones, and 
-        update the set of known active peers.
+        """A round of the gossip membership (see peers.py): add the
+        addresses (if specified) to the passive view, move active peers
+        that stopped responding to the passive view, refill the active view
+        from the passive view, registering with the peers that are added,
+        and shuffle with a random active peer. Peers that failed recently
+        are skipped until their backoff expires (see peers.PeerTable).
+        Every round contacts at most the active peers and those added.
         """
-        now = time.time()
-    
-        # candidate first level peers
-        peers1 = set(active_peers.keys())
+        passive_peers = self.passive_peers
         if addresses:
-            peers1.update(addresses)
-        if self.node_address in peers1:
-            peers1.remove(self.node_address)
-    
-        # candidate 2nd level peers
-        peers2 = set()
-        for peer1 in peers1:
-            if not self.running(peer1):
+            add_to_view(passive_peers, addresses, PASSIVE_VIEW_SIZE,
+                        exclude=active_peers.keys() + [self.node_address])
+
+        for peer in active_peers.keys():
+            if not self.peer_table.available(peer) or not self.running(peer):
+                print("%s not running" % peer)
+                active_peers.pop(peer, None)
+                add_to_view(passive_peers, [peer], PASSIVE_VIEW_SIZE)
+
+        self.fill_active_view(active_peers)
+        self.shuffle(active_peers)
+        print("known peers: %s" % (active_peers.keys()))
+
+    def fill_active_view(self, active_peers):
+        """Register with random responding peers of the passive view until
+        the active view is full (or the passive view exhausted)."""
+        candidates = [peer for peer in self.passive_peers.keys()
+                      if peer not in active_peers and peer != self.node_address]
+        random.shuffle(candidates) # the best first, random among equals
+        for peer in self.peer_table.best(candidates):
+            if len(active_peers) >= ACTIVE_VIEW_SIZE:
+                break
+            if not self.running(peer):
                 continue
             try:
-                peers2.update(requests.get("http://%s/nodes" % peer1).json())
-                peers2.add(peer1)
-            except requests.ConnectionError:
-                print("%s not running" % peer1)
-                if peer1 in active_peers:
-                    active_peers.pop(peer1)
-            except BaseException as e:
-                print("Unknown problem with %s: %s" % (peer1, e))
-                if peer1 in active_peers:
-                    active_peers.pop(peer1)
-        if self.node_address in peers2:
-            peers2.remove(self.node_address)
-    
-        for peer in peers2:
-            # if refreshed < 10 seconds ago, state is assumed to be unchanged
-            #if now - active_peers.get(peer,0) < 10 or running(peer):
-            try:
-                requests.get("http://%s/register" % peer,
-                             params={"url": self.node_address})
-                active_peers[peer] = now
-            except requests.ConnectionError:
+                self.peer_table.get(peer, "/register",
+                                    params={"url": self.node_address})
+            except requests.RequestException:
                 print("Couldn't register with %s" % peer)
-                if peer in active_peers:
-                    active_peers.pop(peer)
-    
-        print("known peers: %s" % (active_peers.keys()))
+                continue
+            self.passive_peers.pop(peer, None)
+            add_to_view(active_peers, [peer], ACTIVE_VIEW_SIZE)
+
+    def shuffle(self, active_peers):
+        """Exchange a random sample of the known peers with a random active
+        peer, and add the peers received to the passive view."""
+        peers = self.peer_table.best(active_peers.keys())
+        if not peers:
+            return
+        peer = random.choice(peers)
+        sample = sample_view([active_peers, self.passive_peers],
+                             SHUFFLE_SIZE - 1, exclude=[peer])
+        try:
+            received = self.peer_table.get(peer, "/shuffle", params={
+                "url": self.node_address,
+                "peers": sample + [self.node_address]}).json()
+        except (requests.RequestException, ValueError):
+            return
+        add_to_view(self.passive_peers, received, PASSIVE_VIEW_SIZE,
+                    exclude=active_peers.keys() + [self.node_address])
 
     def get_longest_blockchain(self, blockchain, active_peers):
-        longest_blockchain = blockchain
-        for peer_address in active_peers.keys():
-            if peer_address == self.node_address: # the current node itself
+        """The valid blockchain with the most work (see BlockChain.work)
+        among this one and those of the peers. Those with the most work
+        are tried first, each downloaded in pieces from all peers that have
+        the same last block at once (see download.py)."""
+        # the lengths of the blockchains of the peers with more work; a
+        # pruned peer can't provide the data needed for validation
+        own_work = blockchain.work(DIFFICULTY)
+        lengths, works = {}, {}
+        for peer in self.peer_table.best(active_peers.keys()):
+            if peer == self.node_address: # the current node itself
+                continue
+            length, work = self.chainwork(peer)
+            # a peer whose capabilities are unknown isn't used this round
+            if work > own_work and self.is_pruned(peer) is False:
+                lengths[peer], works[peer] = length, work
+        tried = set()
+        # the best peers first among those with the same work
+        for peer in sorted(works, key=works.get, reverse=True):
+            if peer in tried:
                 continue
+            length = lengths[peer]
+            try:
+                tip = block_hash(self.peer_table, peer, length - 1,
+                                 self.chainclass)
+                if tip is None or self.rejected.get(peer) == tip:
+                    continue
+                # the peers with the same last block have the same blocks
+                sources = [peer] + [
+                    other for other in lengths if other not in tried
+                    and other != peer and lengths[other] >= length
+                    and self.has_block(other, length - 1, tip)]
+                tried.update(sources)
+                start, peer_blockchain = self.download_blockchain(
+                    blockchain, sources, length)
+            except (requests.RequestException, ValueError) as e:
+                # ValueError: a piece was cut off or is invalid
+                print("Failed to obtain blockchain from %s: %s" % (peer, e))
+                continue
+            try:
+                # the blocks in common were validated before; the work
+                # announced by the peers is only a hint
+                if peer_blockchain.is_valid(DIFFICULTY, start) and \
+                   peer_blockchain.work(DIFFICULTY) > own_work:
+                    return peer_blockchain
+            except ValueError as e: # e.g. a malformed timestamp
+                print("Invalid block from %s: %s" % (peer, e))
+            print("Invalid blockchain, or no more work, from %s" %
+                  ", ".join(sources))
+            for source in sources:
+                self.rejected[source] = tip
+        return blockchain
+
+    def has_block(self, peer, index, hash):
+        """Whether block index of the peer has the given hash"""
+        try:
+            return block_hash(self.peer_table, peer, index,
+                              self.chainclass) == hash
+        except (requests.RequestException, ValueError):
+            return False
+
+    def fork_point(self, blockchain, peer):
+        """A number of blocks at the start of the blockchain that the peer
+        has too. The last block is compared first, then blocks further back
+        at doubling distances, so there may be more blocks in common."""
+        index, step = len(blockchain) - 1, 1
+        while index >= 0:
+            if self.has_block(peer, index, blockchain[index].get_hash()):
+                return index + 1
+            index, step = index - step, 2 * step
+        return 0
+
+    def download_blockchain(self, blockchain, peers, length):
+        """The number of blocks that this blockchain has in common with
+        that of the given length of the peers (that all have the same
+        blocks), and the latter, consisting of the blocks in common and the
+        other ones, downloaded from the peers in parallel."""
+        start = self.fork_point(blockchain, peers[0])
+        if start < len(blockchain) and blockchain[start].is_pruned():
+            # the state after the pruned blocks that would be replaced is
+            # lost: all blocks are needed to validate the blockchain, which
+            # is built anew
+            blocks = download_blocks(self.peer_table, peers, 0, length,
+                                     self.chainclass, DIFFICULTY)
+            return 0, self.chainclass(blocks)
+        blocks = download_blocks(self.peer_table, peers, start, length,
+                                 self.chainclass, DIFFICULTY)
+        return start, blockchain.extended(start, blocks)
+
+    def pull_mempool(self, active_peers):
+        """Obtains the data for the next blocks from the peers."""
+        return
+
+    def announce(self, length, active_peers):
+        """Lets the peers know that this node has a blockchain of the given
+        length, so that they don't have to wait for their next poll."""
+        for peer in self.peer_table.best(active_peers.keys()):
             try:
-                if chainlength(peer_address) > len(longest_blockchain):
-                    peer_blockchain = blockchain.from_url(
-                        "http://%s/blockchain" % (peer_address))
-                    if peer_blockchain.is_valid(DIFFICULTY) and \
-                       len(peer_blockchain) > len(longest_blockchain):
-                        longest_blockchain = peer_blockchain
-            except requests.ConnectionError:
-                print("Failed to obtain blockchain from %s" % peer_address)
+                self.peer_table.get(peer, "/announce", params={
+                    "url": self.node_address, "length": length})
+            except requests.RequestException:
                 pass
-        return longest_blockchain
-    
+
     def next_block_data(self, blockchain, active_peers):
         """Does all kind of node synchronization and other updates that
         are needed, and finally returns a data object that is directly
@@ -251,41 +688,186 @@ class Synchronizer(object):
 
     def load_blockchain(self, chaindata_dir):
         """Loads the blockchain and returns it. Raises exception if it
-        isn't valid."""
+        isn't valid. The blocks that were validated when they were saved
+        (see BlockChain.validated) are only checked to be linked to each
+        other, unless the node is reindexing."""
         blockchain = self.chainclass.load(data_dir=chaindata_dir)
-        assert blockchain.is_valid(DIFFICULTY)
+        assumed = 0 if self.reindex else blockchain.validated(chaindata_dir)
+        assert blockchain.is_valid(DIFFICULTY, assumed)
+        if len(blockchain):
+            blockchain.mark_validated(chaindata_dir)
         return blockchain
+
+    def save_blockchain(self, blockchain, chaindata_dir):
+        """Prunes the blockchain if this node is pruned, and saves it. Only
+        valid blockchains are saved, so it is recorded that it is valid."""
+        if self.prune_depth is not None:
+            blockchain.prune(self.prune_depth)
+        blockchain.save(chaindata_dir)
+        blockchain.mark_validated(chaindata_dir)
     
-def main_process(host, port, shared_dict, active_peers, synchronizer):
-    """This is the main function, that executes in an infinite loop as long
+class Miner(object):
+    """The mining process. The blockchain is mined in its main thread, while
+    the peers, the longest blockchain and the mempool are kept up to date in
+    threads of their own (see scheduler.py), so that mining doesn't stop
+    for them. The block being mined is kept in a BlockTemplate, whose data
+    is renewed every BLOCK_TEMPLATE_INTERVAL; when the tip changes, e.g.
+    because the blockchain is replaced by one of a peer with more work, it
+    is abandoned."""
+    def __init__(self, chaindata_dir, shared_dict, active_peers, synchronizer,
+                 shared_metrics):
+        self.chaindata_dir = chaindata_dir
+        self.shared_dict = shared_dict
+        self.shared_metrics = shared_metrics
+        self.active_peers = active_peers
+        self.synchronizer = synchronizer
+        self.blockchain = synchronizer.load_blockchain(chaindata_dir)
+        self.lock = threading.Lock() # to change or replace the blockchain
+        self.new_tip = threading.Event() # set when the blockchain changes
+        self.last_announcement = shared_dict.get("announced")
+        self.activities = [
+            Activity("peers", self.update_peers, PEER_REFRESH_INTERVAL,
+                     self.running),
+            Activity("sync", self.sync, SYNC_INTERVAL, self.running,
+                     condition=self.announced),
+            Activity("mempool", self.pull_mempool, MEMPOOL_PULL_INTERVAL,
+                     self.running),
+        ]
+        self.announcer = Activity("announce", self.announce, None, self.running)
+        self.activities.append(self.announcer)
+        self.activities.append(Activity(
+            "metrics", self.publish_metrics, METRICS_INTERVAL, self.running))
+        self.hashes = (time.time(), HASHES.value())
+
+    def running(self):
+        return self.shared_dict["running"]
+
+    def update_peers(self):
+        with phase("peers"):
+            self.synchronizer.update_peers(self.active_peers)
+
+    def pull_mempool(self):
+        with phase("mempool"):
+            self.synchronizer.pull_mempool(self.active_peers)
+
+    def announce(self):
+        with phase("announce"):
+            self.synchronizer.announce(len(self.blockchain), self.active_peers)
+
+    def publish_metrics(self):
+        """Publish the metrics of the miner for /metrics"""
+        now, hashes = time.time(), HASHES.value()
+        HASHRATE.set((hashes - self.hashes[1]) / (now - self.hashes[0]))
+        self.hashes = (now, hashes)
+        snapshot = REGISTRY.snapshot()
+        try:
+            self.shared_metrics["miner"] = snapshot
+        except ValueError:
+            # too many peers were seen to publish their series one by one
+            self.shared_metrics["miner"] = without_label(snapshot, "peer")
+        # also when profiling was switched off meanwhile
+        profiler.flush(profiler.interval)
+
+    def announced(self):
+        """Whether a peer announced a new block since the last sync"""
+        return self.shared_dict.get("announced") != self.last_announcement
+
+    def sync(self):
+        self.last_announcement = self.shared_dict.get("announced")
+        blockchain = self.blockchain
+        with phase("sync"):
+            longest_blockchain = self.synchronizer.get_longest_blockchain(
+                blockchain, self.active_peers)
+        if longest_blockchain is blockchain:
+            return
+        with self.lock:
+            # unless a block was mined meanwhile, adding as much work
+            if longest_blockchain.work(DIFFICULTY) > \
+               self.blockchain.work(DIFFICULTY):
+                self.blockchain = longest_blockchain
+                self.saved()
+                # pass it on: with bounded views not all nodes are peers of
+                # the one that mined the block
+                self.announcer.trigger()
+
+    def saved(self):
+        """Save the blockchain after it changed and have the miner start
+        over on the new tip. Only while holding the lock."""
+        with phase("save"):
+            self.synchronizer.save_blockchain(self.blockchain,
+                                              self.chaindata_dir)
+        self.publish_length()
+        self.new_tip.set()
+        print("Chain length = %d" % len(self.blockchain))
+
+    def publish_length(self):
+        """Publish the length and the work of the blockchain for
+        /chainlength and /chainwork"""
+        self.shared_dict["chainlength"] = len(self.blockchain)
+        self.shared_dict["chainwork"] = {
+            "length": len(self.blockchain),
+            "work": self.blockchain.work(DIFFICULTY)}
+        CHAIN_LENGTH.set(len(self.blockchain))
+
+    def mine(self):
+        """Mine blocks until the node stops"""
+        start = time.time()
+        hashing = 0 # time spent in blockchain.mine
+        template = None
+        while self.running():
+            self.new_tip.clear()
+            blockchain = self.blockchain
+            with phase("template"):
+                self.synchronizer.update(blockchain)
+                data = self.synchronizer.next_block_data(
+                    blockchain, self.active_peers)
+                # kept as long as the tip doesn't change
+                if template is None or not template.extends(blockchain):
+                    template = BlockTemplate(blockchain, data, DIFFICULTY)
+                else:
+                    template.update(data)
+            template_time = time.time()
+            while self.running() and not self.new_tip.is_set() and \
+                  time.time() - template_time < BLOCK_TEMPLATE_INTERVAL:
+                before = time.time()
+                with phase("mining"):
+                    nextblock = template.mine(intents=MINING_SLICE,
+                                              stop=self.new_tip)
+                hashing += time.time() - before
+                if nextblock is None:
+                    continue
+                with self.lock:
+                    if self.blockchain is not blockchain: # replaced meanwhile
+                        break
+                    blockchain.append(nextblock)
+                    self.saved()
+                print("New block found: %s" % nextblock)
+                self.announcer.trigger()
+            self.shared_dict["hashing"] = hashing / (time.time() - start)
+            HASHING.set(self.shared_dict["hashing"])
+
+    def run(self):
+        self.publish_length()
+        for activity in self.activities:
+            activity.start()
+        self.mine()
+        for activity in self.activities:
+            activity.join()
+
+def main_process(host, port, shared_dict, active_peers, synchronizer,
+                 shared_metrics):
+    """This is the main function of the mining process, that runs as long
     as this node is running.
-    The synchronizer is any callable that will take care of updating 
-    everything before each call to the mining process 
-    (blockchain.next_block_data and blockchain.mine).
+    The synchronizer takes care of updating everything the mining depends
+    on (see Synchronizer).
     """
     chaindata_dir = get_chaindata_dir(port, synchronizer.chainclass, create=True)
-    blockchain = synchronizer.load_blockchain(chaindata_dir)
-
-    # Already called in start(...)
-    # synchronizer.init(host, port, shared_dict, active_peers)
-    
-    while shared_dict["running"]: # stop mining when webserver is stopped
-        synchronizer.update_peers(active_peers)
-
-        longest_blockchain = synchronizer.get_longest_blockchain(
-            blockchain, active_peers)
-        if not longest_blockchain is blockchain:
-            blockchain = longest_blockchain
-            blockchain.save(chaindata_dir)
-            
-        print("Chain length = %d" % len(blockchain))
-        # synchronizer.update(blockchain)
-        data = synchronizer.next_block_data(blockchain, active_peers)
-        nextblock = blockchain.mine(data, DIFFICULTY, intents=1000)
-        if nextblock is not None:
-            blockchain.append(nextblock)
-            blockchain.save(chaindata_dir)
-            print("New block found: %s" % nextblock)
+    # the metrics and profiles recorded before the fork are the web server's
+    REGISTRY.clear()
+    profiler.clear()
+    profiler.process = "miner"
+    Miner(chaindata_dir, shared_dict, active_peers, synchronizer,
+          shared_metrics).run()
     # This shouldn't be public, otherwise you could eliminate other nodes
     # requests.get("%s/unregister" % tracker_url, params={"url", str(port)})
     print("exiting")
@@ -302,6 +884,11 @@ def helptext(filename):
         -H <host>     the host on which to run (default localhost)
         -p <port>     the port on which to listen (default the first available 
                       one starting at 5000)        
+        -P <depth>    run a pruned node, that only keeps the data of the last
+                      depth blocks (default PRUNE_DEPTH from the configuration)
+        --reindex     validate all stored blocks on startup, also those that
+                      were validated before (of which by default only the
+                      links are checked)
         """ % (filename)
 
 def get_host_port(opt):
@@ -327,15 +914,27 @@ def find_peers(opt, peer_urls, active_peers, synchronizer):
 # Run mining node at specified port, or, if no port is specified, look for
 # port that is free, probably one that has run before if available.
 # It will at the same time start mining and start broadcasting.
+def get_prune_depth(opt):
+    prune_depth = int(opt["-P"]) if "-P" in opt else PRUNE_DEPTH
+    if prune_depth is not None and prune_depth < CONFIRMATIONS:
+        raise RuntimeError("The prune depth must be at least %d" % CONFIRMATIONS)
+    return prune_depth
+
 def start(opt, peer_urls, host, port, active_peers, synchronizer):
-    synchronizer.init(host, port, shared_dict, active_peers)
+    node.prune_depth = get_prune_depth(opt)
+    node.address = "%s:%d" % (host, port)
+    profiler.directory = get_nodedata_dir(port, "profiles", node.chainclass,
+                                          create=True)
+    synchronizer.init(host, port, shared_dict, active_peers, node.prune_depth,
+                      "--reindex" in opt)
     find_peers(opt, peer_urls, active_peers, synchronizer)
     
     shared_dict["running"] = True
     
     miner = Process(
         target=main_process,
-        args=(host, port, shared_dict, active_peers, synchronizer))
+        args=(host, port, shared_dict, active_peers, synchronizer,
+              shared_metrics))
     miner.start()
     
     print ("running node on %s" % (synchronizer.node_address))
@@ -346,7 +945,7 @@ def start(opt, peer_urls, host, port, active_peers, synchronizer):
 
 if __name__ == '__main__':
     import sys
-    opt, peer_urls = getopt.getopt(sys.argv[1:], "hH:p:")
+    opt, peer_urls = getopt.getopt(sys.argv[1:], "hH:p:P:", ["reindex"])
     opt = dict(opt)    
     if "-h" in opt:
         print(helptext(os.path.basename(sys.argv[0])))
@@ -0,0 +1,184 @@
+#! /usr/bin/env python3
+
+"""The health of the peers of a node, as observed by the requests it makes
+to them: an estimate of the round trip time and of the rate of failures of
+every peer, from which it gets a score, and a window after failures in which
+the peer isn't contacted, that doubles with every consecutive failure. The
+peers with the highest score are contacted first, and one that fails
+repeatedly costs only a request every now and then.
+
+>>> now = [0.0]
+>>> table = PeerTable(clock=lambda: now[0])
+>>> table.succeeded("fast:5000", 0.05)
+>>> table.succeeded("slow:5000", 0.5)
+>>> table.failed("dead:5000"); table.failed("dead:5000")
+>>> table.best(["dead:5000", "slow:5000", "new:5000", "fast:5000"])
+['fast:5000', 'slow:5000', 'new:5000']
+>>> table.available("dead:5000")
+False
+>>> now[0] += 2 * PEER_BACKOFF
+>>> table.available("dead:5000")
+True
+
+Membership is gossiped, as in HyParView: a node keeps a small active view of
+peers that it registered with and syncs with, and a larger passive view of
+peers it heard of, from which the active view is refilled. Both are bounded,
+peers that don't fit push out random others, and every round a node
+exchanges a random sample of its views with one active peer (a shuffle), so
+the traffic per node doesn't grow with the size of the network.
+
+>>> view = {"a": 0, "b": 0, "c": 0}
+>>> evicted = add_to_view(view, ["d", "e", "self"], 4, exclude=["self"])
+>>> len(view), len(evicted), "d" in view and "e" in view, "self" in view
+(4, 1, True, False)
+>>> sorted(sample_view([view, {"x": 0}], 10, exclude=["a", "b", "c"]))
+['d', 'e', 'x']
+"""
+
+import time
+import random
+import threading
+import requests
+import encoding
+from util import conditional_get
+from metrics import REGISTRY
+from config import PEER_TIMEOUT, PEER_BACKOFF, PEER_MAX_BACKOFF
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "peer_request_seconds", "Time until the response of a peer arrived")
+REQUEST_FAILURES = REGISTRY.counter(
+    "peer_request_failures_total", "Requests to a peer that failed")
+RECEIVED_BYTES = REGISTRY.counter(
+    "peer_received_bytes_total", "Bytes of the responses of a peer "
+    "(decompressed)")
+
+# weight of a new measurement in the moving averages of the round trip time
+# (as for TCP) and of the failure rate
+RTT_WEIGHT = 0.125
+FAILURE_WEIGHT = 0.25
+# the round trip time assumed for a peer that hasn't responded yet
+UNKNOWN_RTT = 1.0
+
+class PeerStats(object):
+    def __init__(self):
+        self.rtt = None # moving average of the round trip time
+        self.failure_rate = 0.0 # moving average of 1 for a failure, 0 else
+        self.failures = 0 # consecutive failures
+        self.retry_time = 0 # when it may be contacted again
+
+    def score(self):
+        """The expected number of successful responses per second"""
+        rtt = UNKNOWN_RTT if self.rtt is None else self.rtt
+        return (1 - self.failure_rate) / rtt
+
+class PeerTable(object):
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.stats = {} # peer: PeerStats
+        self._lock = threading.Lock() # used by the threads of the miner
+
+    def _stats(self, peer):
+        if peer not in self.stats:
+            self.stats[peer] = PeerStats()
+        return self.stats[peer]
+
+    def succeeded(self, peer, rtt):
+        """Record a response of the peer after rtt seconds"""
+        with self._lock:
+            stats = self._stats(peer)
+            stats.rtt = rtt if stats.rtt is None else \
+                (1 - RTT_WEIGHT) * stats.rtt + RTT_WEIGHT * rtt
+            stats.failure_rate *= 1 - FAILURE_WEIGHT
+            stats.failures = 0
+            stats.retry_time = 0
+
+    def failed(self, peer):
+        """Record a request to the peer that failed, and don't contact it
+        for a while"""
+        with self._lock:
+            stats = self._stats(peer)
+            stats.failure_rate = \
+                (1 - FAILURE_WEIGHT) * stats.failure_rate + FAILURE_WEIGHT
+            stats.failures += 1
+            stats.retry_time = self.clock() + min(
+                PEER_BACKOFF * 2 ** (stats.failures - 1), PEER_MAX_BACKOFF)
+
+    def available(self, peer):
+        """Whether the peer may be contacted (isn't backing off)"""
+        stats = self.stats.get(peer)
+        return stats is None or self.clock() >= stats.retry_time
+
+    def score(self, peer):
+        stats = self.stats.get(peer)
+        return PeerStats().score() if stats is None else stats.score()
+
+    def best(self, peers):
+        """The available peers, the one with the highest score first"""
+        return sorted((peer for peer in peers if self.available(peer)),
+                      key=self.score, reverse=True)
+
+    def get(self, peer, path, etag=None, **kwargs):
+        """requests.get of the path at the peer (with an If-None-Match
+        header if etag is given, see util.conditional_get), timed out after
+        PEER_TIMEOUT seconds. The outcome is recorded: a response counts as
+        a success, a requests.RequestException as a failure."""
+        kwargs.setdefault("timeout", PEER_TIMEOUT)
+        start = self.clock()
+        try:
+            response = conditional_get("http://%s%s" % (peer, path), etag,
+                                       **kwargs)
+        except requests.RequestException:
+            self.failed(peer)
+            REQUEST_FAILURES.inc(peer=peer, path=path)
+            raise
+        rtt = self.clock() - start
+        self.succeeded(peer, rtt)
+        REQUEST_SECONDS.observe(rtt, peer=peer, path=path)
+        if not kwargs.get("stream"):
+            RECEIVED_BYTES.inc(len(response.content), peer=peer, path=path)
+        return response
+
+    def iter_response(self, peer, path, response, pairs=False):
+        """encoding.iter_response of a streamed response of get, counting
+        the bytes received"""
+        def chunks():
+            for chunk in response.iter_content(encoding.CHUNK_SIZE):
+                RECEIVED_BYTES.inc(len(chunk), peer=peer, path=path)
+                yield chunk
+        return encoding.iter_loads(
+            chunks(), binary=encoding.is_binary(response), pairs=pairs)
+
+def add_to_view(view, peers, size, exclude=()):
+    """Add the peers (except those in exclude) to the view, a dictionary
+    (peer, time) such as a SharedDict, evicting random other peers as needed
+    to keep at most size. Returns the list of evicted peers."""
+    now = time.time()
+    peers = [peer for peer in dict.fromkeys(peers) if peer not in exclude]
+    peers = peers[:size]
+    new = [peer for peer in peers if peer not in view]
+    others = [peer for peer in view.keys() if peer not in peers]
+    excess = len(others) + len(peers) - size
+    evicted = random.sample(others, excess) if excess > 0 else []
+    for peer in evicted:
+        view.pop(peer, None)
+    for peer in new:
+        view[peer] = now
+    return evicted
+
+def sample_view(views, n, exclude=()):
+    """A random sample of at most n of the peers in the views (dictionaries
+    or lists of peers), except those in exclude"""
+    peers = set()
+    for view in views:
+        peers.update(view)
+    peers.difference_update(exclude)
+    return random.sample(sorted(peers), min(n, len(peers)))
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
@@ -0,0 +1,143 @@
+#! /usr/bin/env python3
+
+"""Opt-in profiling of the requests (by route) and of the phases of the
+miner with cProfile. It is enabled by PROFILE in the configuration or at
+/profiling, through a flag in shared memory, so that it applies to the web
+server and to the miner alike.
+
+The profiles of the same route or phase are added up, and written to a file
+every PROFILE_INTERVAL seconds, named after the process, the route or phase
+and the time, e.g. miner-phase-sync-20240101T120000.prof. Only the last
+PROFILE_KEEP files of every route or phase are kept. The files can be read
+with pstats (python -m pstats <file>), and are served at /profiles.
+
+>>> import tempfile
+>>> directory = tempfile.mkdtemp()
+>>> profiler = Profiler(lambda: True, directory, "web", interval=0, keep=2)
+>>> for i in range(3):
+...     with profiler.profile("phase", "sum"):
+...         _ = sum(range(1000))
+>>> len(list_profiles(directory))
+2
+>>> "sum" in profile_text(os.path.join(directory, list_profiles(directory)[0]))
+True
+"""
+
+import io
+import os
+import re
+import time
+import pstats
+import cProfile
+import datetime
+import threading
+from contextlib import contextmanager
+from config import PROFILE_INTERVAL, PROFILE_KEEP
+
+EXTENSION = ".prof"
+
+class Profiler(object):
+    def __init__(self, enabled, directory=None, process="",
+                 interval=PROFILE_INTERVAL, keep=PROFILE_KEEP):
+        """Profiles while enabled() is true, writing the profiles to
+        directory (nothing is profiled while it is None) with the name of
+        the process in the file names"""
+        self.enabled = enabled
+        self.directory = directory
+        self.process = process
+        self.interval = interval
+        self.keep = keep
+        self._stats = {} # (kind, name): [pstats.Stats, when started]
+        self._lock = threading.Lock()
+        self._local = threading.local() # the profile of the thread, if any
+
+    def start(self, kind, name):
+        """Start profiling the current thread as the route or phase (kind)
+        name, unless profiling is disabled or the thread is profiled
+        already. Returns what stop should be called with."""
+        if self.directory is None or getattr(self._local, "active", False) \
+           or not self.enabled():
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # from Python 3.12 only one thread can be profiled at a time
+            return None
+        self._local.active = True
+        return (kind, name, profile)
+
+    def stop(self, token):
+        """Stop the profiling started by start and add up the profile"""
+        if token is None:
+            return
+        kind, name, profile = token
+        profile.disable()
+        self._local.active = False
+        with self._lock:
+            stats = self._stats.get((kind, name))
+            if stats is None:
+                self._stats[(kind, name)] = [pstats.Stats(profile), time.time()]
+            else:
+                stats[0].add(profile)
+        self.flush(self.interval)
+
+    @contextmanager
+    def profile(self, kind, name):
+        """Profile the with block, see start"""
+        token = self.start(kind, name)
+        try:
+            yield
+        finally:
+            self.stop(token)
+
+    def flush(self, age=0):
+        """Write the profiles that were started at least age seconds ago"""
+        now = time.time()
+        with self._lock:
+            for key, (stats, started) in list(self._stats.items()):
+                if now - started >= age:
+                    del self._stats[key]
+                    self._write(key, stats)
+
+    def clear(self):
+        """Forget the profiles that weren't written, e.g. after a fork"""
+        with self._lock:
+            self._stats.clear()
+
+    def _write(self, key, stats):
+        kind, name = key
+        prefix = "%s-%s-%s-" % (self.process, kind,
+                                re.sub(r"[^A-Za-z0-9_]+", "_", name).strip("_"))
+        timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S.%f")
+        stats.dump_stats(os.path.join(self.directory,
+                                      prefix + timestamp + EXTENSION))
+        for filename in list_profiles(self.directory, prefix)[self.keep:]:
+            os.remove(os.path.join(self.directory, filename))
+
+def list_profiles(directory, prefix=""):
+    """The profile files in the directory (whose names start with prefix),
+    the most recent first"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted((filename for filename in os.listdir(directory)
+                   if filename.startswith(prefix) and
+                   filename.endswith(EXTENSION)),
+                  key=lambda filename: filename.rsplit("-", 1)[-1],
+                  reverse=True)
+
+def profile_text(filename, limit=30, sort="cumulative"):
+    """The limit functions of the profile in the file with the highest
+    sort key, as printed by pstats"""
+    out = io.StringIO()
+    pstats.Stats(filename, stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
@@ -0,0 +1,68 @@
+#! /usr/bin/env python3
+
+"""Activities of a node that run concurrently, each in its own thread and at
+its own pace: every interval seconds, and sooner when triggered, either
+explicitly or by a condition that is polled.
+
+>>> import time
+>>> calls = []
+>>> activity = Activity("test", lambda: calls.append(time.time()),
+...                     interval=None, running=lambda: len(calls) < 2)
+>>> activity.start()
+>>> activity.trigger(); time.sleep(0.3); activity.trigger()
+>>> activity.join(1)
+>>> len(calls), activity.is_alive()
+(2, False)
+"""
+
+import time
+import threading
+import traceback
+
+# seconds between checks of the running flag and the condition
+POLL_INTERVAL = 0.1
+
+class Activity(threading.Thread):
+    def __init__(self, name, f, interval, running, condition=None):
+        """Calls f every interval seconds (None: only when triggered) as
+        long as running() is true. If condition is given, f is also called
+        as soon as condition() is true. An exception raised by f is printed
+        and doesn't stop the activity."""
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.f = f
+        self.interval = interval
+        self.running = running
+        self.condition = condition
+        self._triggered = threading.Event()
+
+    def trigger(self):
+        """Call f as soon as possible"""
+        self._triggered.set()
+
+    def _due(self, next_time):
+        return self._triggered.is_set() or \
+            next_time is not None and time.time() >= next_time or \
+            self.condition is not None and self.condition()
+
+    def run(self):
+        next_time = time.time() if self.interval is not None else None
+        while self.running():
+            if self._due(next_time):
+                self._triggered.clear()
+                if self.interval is not None:
+                    next_time = time.time() + self.interval
+                try:
+                    self.f()
+                except Exception:
+                    print("%s failed:" % self.name)
+                    traceback.print_exc()
+            self._triggered.wait(POLL_INTERVAL)
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
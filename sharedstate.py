@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+
+"""State shared between the processes of a node (the web server and the
+miner) in shared memory, as a replacement of multiprocessing.Manager
+dictionaries. Every operation on those is a round trip to the process of
+the manager, also when nothing changed.
+
+A SharedDict keeps the json encoding of a dictionary in a shared array,
+along with a sequence number that is incremented before and after every
+change (a seqlock). Readers don't take a lock: they only look at
+the sequence number, and decode the dictionary again only if it changed
+since they last did, retrying if it changed while they did. Writers take a
+lock, so changes are applied one at a time. A reader that keeps finding the
+dictionary being written, e.g. because the writer died halfway, gives up
+after READ_TIMEOUT seconds. (json rather than encoding.py,
+as the json module encodes and decodes several times faster.)
+
+>>> d = SharedDict(1024)
+>>> d["a"] = 1.5
+>>> d["b"] = 2
+>>> sorted(d.keys()), d["a"], d.get("c"), "b" in d, len(d)
+(['a', 'b'], 1.5, None, True, 2)
+>>> d.pop("a")
+1.5
+>>> d.update({"c": [1, 2]})
+>>> sorted(d.items())
+[('b', 2), ('c', [1, 2])]
+>>> d["big"] = "x" * 2000
+Traceback (most recent call last):
+ValueError: The shared dictionary is full (1024 bytes)
+"""
+
+import copy
+import time
+import ctypes
+import multiprocessing
+import json
+
+READ_TIMEOUT = 5 # seconds a reader waits for a write to complete
+
+def _copy(value):
+    """A copy of the value if it can be changed, so that the cache can't"""
+    return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+class SharedDict(object):
+    """A dictionary with json values that can be read and changed by all
+    processes that are forked (or spawned with it as an argument) after it
+    is created, with at most size bytes of encoding.
+    The methods of dict that are supported return copies, also of the
+    lists and dictionaries in it."""
+    def __init__(self, size):
+        self.size = size
+        self._data = multiprocessing.RawArray(ctypes.c_ubyte, size)
+        self._length = multiprocessing.RawValue(ctypes.c_uint32, 0)
+        self._sequence = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._lock = multiprocessing.Lock()
+        self._cache = (None, {}) # (sequence, dictionary) last read
+        self._write({})
+
+    def __getstate__(self):
+        # the cache is local to every process
+        state = self.__dict__.copy()
+        state["_cache"] = (None, {})
+        return state
+
+    def _read(self):
+        """The dictionary, decoded again only if it changed. It is the
+        cache, that must not be changed. Raises TimeoutError if it is being
+        written for more than READ_TIMEOUT seconds."""
+        deadline = None
+        while True:
+            sequence = self._sequence.value
+            if sequence == self._cache[0]:
+                return self._cache[1]
+            if not sequence % 2: # not being written
+                data = ctypes.string_at(self._data, self._length.value)
+                if self._sequence.value == sequence: # didn't change meanwhile
+                    value = json.loads(data)
+                    self._cache = (sequence, value)
+                    return value
+            # let the writer go on
+            if deadline is None:
+                deadline = time.time() + READ_TIMEOUT
+                time.sleep(0)
+            elif time.time() < deadline:
+                time.sleep(0.001)
+            else:
+                raise TimeoutError("The shared dictionary is being written "
+                                   "for more than %d seconds" % READ_TIMEOUT)
+
+    def _write(self, value):
+        """Replace the dictionary; only while holding the lock"""
+        data = json.dumps(value).encode("utf8")
+        if len(data) > self.size:
+            raise ValueError("The shared dictionary is full (%d bytes)"
+                             % self.size)
+        sequence = self._sequence.value
+        self._sequence.value = sequence + 1
+        ctypes.memmove(self._data, data, len(data))
+        self._length.value = len(data)
+        self._sequence.value = sequence + 2
+        # no need to decode what was just encoded
+        self._cache = (sequence + 2, value)
+
+    def _change(self, change):
+        """Apply change to a copy of the dictionary and store it. Returns
+        what change returns."""
+        with self._lock:
+            value = dict(self._read())
+            result = change(value)
+            self._write(value)
+            return result
+
+    def __getitem__(self, key):
+        return _copy(self._read()[key])
+
+    def get(self, key, default=None):
+        return _copy(self._read().get(key, default))
+
+    def __contains__(self, key):
+        return key in self._read()
+
+    def __len__(self):
+        return len(self._read())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return list(self._read().keys())
+
+    def values(self):
+        return [_copy(value) for value in self._read().values()]
+
+    def items(self):
+        return [(key, _copy(value)) for key, value in self._read().items()]
+
+    def copy(self):
+        return _copy(self._read())
+
+    def __setitem__(self, key, value):
+        self._change(lambda d: d.__setitem__(key, value))
+
+    def __delitem__(self, key):
+        self._change(lambda d: d.__delitem__(key))
+
+    def pop(self, key, *default):
+        return self._change(lambda d: d.pop(key, *default))
+
+    def update(self, *args, **kwargs):
+        self._change(lambda d: d.update(*args, **kwargs))
+
+    def __repr__(self):
+        return "SharedDict(%r)" % (self._read(),)
+
+# execute doctest when executed as a script
+# Displays output when passed -v or when a test fails
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=
+                    doctest.ELLIPSIS |
+                    doctest.NORMALIZE_WHITESPACE |
+                    doctest.IGNORE_EXCEPTION_DETAIL)
@@ -0,0 +1,452 @@
+#! /usr/bin/env python3
+
+"""A deterministic simulation of a network of transaction nodes in a single
+process, to see how changes to syncing or to the mempool affect the network
+before they are rolled out: how fast blocks propagate, how many of them are
+orphaned and how long transactions wait to be included.
+
+The simulated nodes use the code of the real ones wherever it doesn't
+depend on HTTP: the blockchain classes, the checks of downloaded blocks
+(download.py), the mempool and the ledger in a database in memory, and
+TransactionSynchronizer.next_block_data for the blocks they mine. Their
+protocol follows node.py, in messages over a Transport that models the
+latency, bandwidth and loss of the links:
+
+- a node with a new tip (mined or received) announces its length to its
+  peers, and every SYNC_INTERVAL it asks its peers for theirs
+- a node that learns of a longer blockchain requests the blocks after the
+  fork point from that peer (in one round trip, where node.py needs a few)
+  and switches to it if it is valid and still longer
+- every MEMPOOL_PULL_INTERVAL a node pulls the unprocessed transactions of
+  its peers, which only costs a short reply if they didn't change
+- the data of the next block is renewed when the tip changes and every
+  BLOCK_TEMPLATE_INTERVAL
+
+Time is virtual: the events are processed in order of time, and processing
+them takes no time. Mining is a Poisson process instead of hashing: a block
+is found every block_interval seconds on average, by a node chosen with
+probability proportional to its hash rate. All randomness comes from a
+random generator with the given seed, so that the same parameters give the
+same results. Transactions are submitted according to a load: a list of
+(time, node, transaction), e.g. from poisson_load. The real time a
+simulation takes is mostly spent verifying signatures, as every node
+verifies every transaction.
+
+Usage: python simulation.py [-n <nodes>] [-t <seconds>] [-s <seed>]
+           [-i <block interval>] [-r <transactions per second>]
+           [-d <degree>] [-l <latency>] [-j <jitter>]
+           [-b <bytes per second>] [-p <loss>]
+
+>>> def simulate(seed):
+...     simulation = Simulation(4, seed=seed, block_interval=30)
+...     simulation.add_load(poisson_load(simulation, rate=0.05, end=300))
+...     return simulation.run(600)
+>>> report = simulate(1)
+>>> report["nodes_in_sync"], report["transactions_pending"]
+(True, 0)
+>>> list(report["block_propagation_s"])
+['p50', 'p90', 'p99', 'max']
+>>> simulate(1) == report
+True
+"""
+
+import sys
+import heapq
+import random
+import getopt
+import datetime
+import itertools
+import uuid as uuid_module
+from collections import OrderedDict
+import encoding
+from address import Address
+from download import check_blocks
+from mempool import Database, migrate, exists, insert, evict, \
+    get_unprocessed, mempool_sequence, is_relayable, transaction_size
+from transaction import Transaction, TransactionBlockChain
+from transactionnode import TransactionSynchronizer
+from util import percentiles
+from config import SYNC_INTERVAL, MEMPOOL_PULL_INTERVAL, \
+    BLOCK_TEMPLATE_INTERVAL, PEER_TIMEOUT, ACTIVE_VIEW_SIZE
+
+CONTROL_BYTES = 100 # size of the messages without blocks or transactions
+EPOCH = datetime.datetime(2000, 1, 1) # the timestamp of virtual time 0
+
+class Clock(object):
+    """Virtual time, and the actions scheduled at future times"""
+    def __init__(self):
+        self.now = 0.0
+        self._events = [] # heap of (time, sequence number, action, args)
+        self._sequence = itertools.count() # orders events at the same time
+
+    def at(self, time, action, *args):
+        heapq.heappush(self._events,
+                       (time, next(self._sequence), action, args))
+
+    def after(self, delay, action, *args):
+        self.at(self.now + delay, action, *args)
+
+    def every(self, interval, action, start=0.0):
+        """Call action every interval seconds from time start on"""
+        def repeat():
+            action()
+            self.after(interval, repeat)
+        self.at(start, repeat)
+
+    def run(self, until):
+        """Process the events up to time until, in order of time"""
+        while self._events and self._events[0][0] <= until:
+            self.now, _, action, args = heapq.heappop(self._events)
+            action(*args)
+        self.now = until
+
+class Transport(object):
+    """Links with a latency plus a random jitter, an uplink bandwidth
+    (bytes per second, None: unlimited) for every node, over which messages
+    are sent one after the other, and a probability that a message is lost.
+    Subclasses can model e.g. a topology by overriding latency."""
+    def __init__(self, latency=0.05, jitter=0.01, bandwidth=1000000,
+                 loss=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self._free = {} # sender: time its uplink is free
+
+    def arrival(self, now, sender, receiver, size, rng):
+        """The time at which a message of size bytes sent now arrives, None
+        if it is lost"""
+        start = max(now, self._free.get(sender, now))
+        sent = start + (size / self.bandwidth if self.bandwidth else 0)
+        self._free[sender] = sent
+        if rng.random() < self.loss:
+            return None
+        return sent + self.latency + rng.uniform(0, self.jitter)
+
+class SimulatedNode(object):
+    """A transaction node in a Simulation, with its peers"""
+    def __init__(self, simulation, index):
+        self.simulation = simulation
+        self.index = index
+        self.peers = []
+        self.blockchain = TransactionBlockChain()
+        self.database = Database(":memory:")
+        migrate(self.database.connection)
+        self.synchronizer = TransactionSynchronizer(
+            self.database, Address(seed="simulation node %d" % index).address)
+        self.synchronizer.init("simulation", index, {}, {})
+        self.template = (None, None) # (tip, data of the next block)
+        self.lengths = {} # peer: the length it announced, if longer
+        self.request = None # (peer, number) of the pending request for blocks
+        self.pulled = {} # peer: the mempool sequence of its last reply
+
+    @property
+    def db(self):
+        return self.database.connection
+
+    def __repr__(self):
+        return "node %d" % self.index
+
+    def send(self, peer, size, action, *args):
+        self.simulation.send(self, peer, size, action, *args)
+
+    def tip(self):
+        return self.blockchain[-1].get_hash() if len(self.blockchain) else None
+
+    def start(self):
+        """Schedule the periodic activities, at random phases"""
+        clock, rng = self.simulation.clock, self.simulation.rng
+        clock.every(SYNC_INTERVAL, self.poll_lengths,
+                    rng.uniform(0, SYNC_INTERVAL))
+        clock.every(MEMPOOL_PULL_INTERVAL, self.pull_mempool,
+                    rng.uniform(0, MEMPOOL_PULL_INTERVAL))
+        clock.every(BLOCK_TEMPLATE_INTERVAL, self.renew_template,
+                    rng.uniform(0, BLOCK_TEMPLATE_INTERVAL))
+
+    # mining
+
+    def renew_template(self):
+        self.synchronizer.update(self.blockchain)
+        self.template = (self.tip(), self.synchronizer.next_block_data(
+            self.blockchain, {}))
+
+    def mine(self):
+        """Called when this node finds a block"""
+        if self.template[0] != self.tip() or self.template[1] is None:
+            self.renew_template()
+        timestamp = EPOCH + datetime.timedelta(
+            seconds=self.simulation.clock.now)
+        block = self.blockchain.next_block(self.template[1],
+                                           timestamp.isoformat())
+        self.simulation.mined(self, block)
+        self.blockchain.append(block)
+        self.new_tip(len(self.blockchain) - 1)
+
+    def new_tip(self, start):
+        """The blocks from start on are new"""
+        for block in self.blockchain[start:]:
+            self.simulation.received(self, block)
+        self.renew_template()
+        for peer in self.peers:
+            self.send(peer, CONTROL_BYTES, peer.on_length, self,
+                      len(self.blockchain))
+
+    # syncing
+
+    def poll_lengths(self):
+        for peer in self.peers:
+            self.send(peer, CONTROL_BYTES, peer.on_length_request, self)
+
+    def on_length_request(self, peer):
+        self.send(peer, CONTROL_BYTES, peer.on_length, self,
+                  len(self.blockchain))
+
+    def on_length(self, peer, length):
+        if length > len(self.blockchain):
+            self.lengths[peer] = length
+            self.sync()
+
+    def sync(self):
+        """Request the blocks of the peer with the longest blockchain,
+        unless a request is pending"""
+        if self.request is not None:
+            return
+        longer = [peer for peer in self.peers
+                  if self.lengths.get(peer, 0) > len(self.blockchain)]
+        self.lengths = dict((peer, self.lengths[peer]) for peer in longer)
+        if not longer:
+            return
+        peer = max(longer, key=self.lengths.get)
+        self.request = (peer, next(self.simulation.requests))
+        self.send(peer, CONTROL_BYTES, peer.on_blocks_request, self,
+                  self.blockchain, self.request)
+        self.simulation.clock.after(PEER_TIMEOUT, self.timeout, self.request)
+
+    def timeout(self, request):
+        if self.request == request: # no reply
+            self.request = None
+            self.lengths.pop(request[0], None)
+            self.sync()
+
+    def on_blocks_request(self, peer, blockchain, request):
+        start = fork_point(self.blockchain, blockchain)
+        blocks = self.blockchain[start:]
+        self.send(peer, CONTROL_BYTES + sum(map(self.simulation.block_size,
+                                                blocks)),
+                  peer.on_blocks, self, start, blocks, request)
+
+    def on_blocks(self, peer, start, blocks, request):
+        if self.request != request: # timed out
+            return
+        self.request = None
+        self.lengths.pop(peer, None)
+        if start + len(blocks) > len(self.blockchain):
+            try:
+                check_blocks(blocks, start, start + len(blocks), 0)
+                blockchain = self.blockchain.extended(start, blocks)
+                blockchain.get_balances()
+            except (ValueError, AssertionError):
+                # AssertionError: invalid balances
+                pass
+            else:
+                self.blockchain = blockchain
+                self.new_tip(start)
+        self.sync()
+
+    # transactions
+
+    def submit(self, tx):
+        """A transaction pushed to this node, as in /pushtx"""
+        if is_relayable(tx) and tx.is_valid() and not exists(tx, self.db):
+            insert(tx, self.db)
+            evict(self.db)
+
+    def pull_mempool(self):
+        for peer in self.peers:
+            self.send(peer, CONTROL_BYTES, peer.on_mempool_request, self,
+                      self.pulled.get(peer))
+
+    def on_mempool_request(self, peer, sequence):
+        current = mempool_sequence(self.db)
+        txs = [] if sequence == current else get_unprocessed(self.db)
+        self.send(peer, CONTROL_BYTES + sum(map(transaction_size, txs)),
+                  peer.on_mempool, self, current, txs)
+
+    def on_mempool(self, peer, sequence, txs):
+        self.pulled[peer] = sequence
+        for tx in txs:
+            if is_relayable(tx) and not exists(tx, self.db) and tx.is_valid():
+                insert(tx, self.db, commit=False)
+        self.db.commit()
+
+def fork_point(blockchain, other):
+    """The number of blocks at the start that the blockchains have in
+    common"""
+    index = min(len(blockchain), len(other)) - 1
+    while index >= 0 and \
+          blockchain[index].get_hash() != other[index].get_hash():
+        index -= 1
+    return index + 1
+
+class Simulation(object):
+    """Nodes that mine and exchange blocks and transactions over a
+    transport in virtual time"""
+    def __init__(self, n_nodes, transport=None, seed=0, block_interval=60,
+                 hashrates=None, degree=ACTIVE_VIEW_SIZE):
+        """n_nodes nodes, each connected to at least degree others (and to
+        the next one, so that all are connected), with relative hash rates
+        (by default all the same)"""
+        self.clock = Clock()
+        self.rng = random.Random(seed)
+        self.transport = transport or Transport()
+        self.block_interval = block_interval
+        self.nodes = [SimulatedNode(self, i) for i in range(n_nodes)]
+        self.hashrates = hashrates or [1] * n_nodes
+        self.requests = itertools.count() # numbers the requests for blocks
+        self.mining_end = None
+        self._sizes = {} # block hash: encoded size
+        # statistics
+        self.mined_at = {} # block hash: (time, node)
+        self.received_at = {} # block hash: {node: time}
+        self.submitted_at = {} # transaction uuid: time
+        self.bytes_sent = 0
+        self.messages_lost = 0
+        self.connect(min(degree, n_nodes - 1))
+
+    def connect(self, degree):
+        def link(node, other):
+            if other is not node and other not in node.peers:
+                node.peers.append(other)
+                other.peers.append(node)
+        for node, other in zip(self.nodes, self.nodes[1:] + self.nodes[:1]):
+            link(node, other)
+        for node in self.nodes:
+            while len(node.peers) < degree:
+                link(node, self.rng.choice(self.nodes))
+
+    def send(self, sender, receiver, size, action, *args):
+        self.bytes_sent += size
+        arrival = self.transport.arrival(self.clock.now, sender, receiver,
+                                         size, self.rng)
+        if arrival is None:
+            self.messages_lost += 1
+        else:
+            self.clock.at(arrival, action, *args)
+
+    def block_size(self, block):
+        hash = block.get_hash()
+        if hash not in self._sizes:
+            self._sizes[hash] = len(encoding.dumps(block.__dict__))
+        return self._sizes[hash]
+
+    def add_load(self, load):
+        """Submit the transactions of the load, a list of (time, node index,
+        transaction)"""
+        for time, index, tx in load:
+            self.clock.at(time, self.submit, self.nodes[index], tx)
+
+    def submit(self, node, tx):
+        self.submitted_at.setdefault(tx.uuid, self.clock.now)
+        node.submit(tx)
+
+    def find_block(self):
+        if self.clock.now >= self.mining_end:
+            return
+        self.rng.choices(self.nodes, self.hashrates)[0].mine()
+        self.clock.after(self.rng.expovariate(1 / self.block_interval),
+                         self.find_block)
+
+    def mined(self, node, block):
+        self.mined_at[block.get_hash()] = (self.clock.now, node)
+
+    def received(self, node, block):
+        self.received_at.setdefault(block.get_hash(), {}).setdefault(
+            node, self.clock.now)
+
+    def run(self, duration, settle=2 * SYNC_INTERVAL):
+        """Mine blocks for duration seconds, let the nodes settle for some
+        more seconds without mining, and return the report"""
+        self.mining_end = self.clock.now + duration
+        for node in self.nodes:
+            node.start()
+        self.clock.after(self.rng.expovariate(1 / self.block_interval),
+                         self.find_block)
+        self.clock.run(self.mining_end + settle)
+        return self.report(duration)
+
+    def report(self, duration):
+        """The statistics of the blocks in the longest blockchain of the
+        nodes (the main chain) and of the transactions in them"""
+        main = max((node.blockchain for node in self.nodes), key=len)
+        propagation, coverage, inclusion = [], [], []
+        for block in main:
+            hash = block.get_hash()
+            mined, miner = self.mined_at[hash]
+            received = self.received_at[hash]
+            propagation.extend(time - mined for node, time in received.items()
+                               if node is not miner)
+            if len(received) == len(self.nodes):
+                coverage.append(max(received.values()) - mined)
+            inclusion.extend(mined - self.submitted_at[tx.uuid]
+                             for tx in block.get_transaction_bundle()
+                             if tx.uuid in self.submitted_at)
+        return OrderedDict([
+            ("blocks_mined", len(self.mined_at)),
+            ("orphan_rate", 1 - len(main) / len(self.mined_at)
+             if self.mined_at else 0),
+            ("block_propagation_s", percentiles(propagation)),
+            ("block_coverage_s", percentiles(coverage)),
+            ("transactions_submitted", len(self.submitted_at)),
+            ("transactions_pending", len(self.submitted_at) - len(inclusion)),
+            ("inclusion_latency_s", percentiles(inclusion)),
+            ("transactions_per_s", len(inclusion) / duration),
+            ("bytes_sent", self.bytes_sent),
+            ("messages_lost", self.messages_lost),
+            ("nodes_in_sync", len(set(node.tip() for node in self.nodes)) == 1),
+        ])
+
+def poisson_load(simulation, rate, start=0, end=60, n_addresses=20,
+                 max_amount=0.001, max_fee=0.0001):
+    """Transactions at random times with the given average rate per second
+    between start and end, between random pairs of n_addresses addresses,
+    with random amounts and fees up to the given maxima, each submitted to
+    a random node"""
+    rng = simulation.rng
+    keys = [Address(seed="simulation address %d" % i)
+            for i in range(n_addresses)]
+    load = []
+    time = start + rng.expovariate(rate)
+    while time < end:
+        sender, receiver = rng.sample(keys, 2)
+        tx = Transaction(sender.address, receiver.address,
+                         round(rng.uniform(0.0001, max_amount), 6),
+                         round(rng.uniform(0, max_fee), 6),
+                         "load %d" % len(load),
+                         uuid=str(uuid_module.UUID(int=rng.getrandbits(128))))
+        tx.sign(sender)
+        load.append((time, rng.randrange(len(simulation.nodes)), tx))
+        time += rng.expovariate(rate)
+    return load
+
+def print_report(report):
+    for name, value in report.items():
+        if isinstance(value, dict):
+            value = "  ".join("%s %s" % (key, "-" if v is None else "%.3f" % v)
+                              for key, v in value.items())
+        print("%-24s %s" % (name, value))
+
+if __name__ == "__main__":
+    opt, _ = getopt.getopt(sys.argv[1:], "n:t:s:i:r:d:l:j:b:p:")
+    opt = dict(opt)
+    transport = Transport(latency=float(opt.get("-l", 0.05)),
+                          jitter=float(opt.get("-j", 0.01)),
+                          bandwidth=float(opt.get("-b", 1000000)),
+                          loss=float(opt.get("-p", 0)))
+    duration = float(opt.get("-t", 600))
+    simulation = Simulation(int(opt.get("-n", 8)), transport,
+                            seed=int(opt.get("-s", 0)),
+                            block_interval=float(opt.get("-i", 60)),
+                            degree=int(opt.get("-d", ACTIVE_VIEW_SIZE)))
+    simulation.add_load(poisson_load(simulation, float(opt.get("-r", 0.05)),
+                                     end=duration))
+    print_report(simulation.run(duration))
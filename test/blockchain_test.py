@@ -13,8 +13,20 @@ import unittest, doctest
 def suite(top_dir=None):
     sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
     import block
+    import blockchain
     import transaction
     import address
+    import mempool
+    import ledger
+    import bloom
+    import merkle
+    import encoding
+    import sharedstate
+    import scheduler
+    import peers
+    import metrics
+    import profiling
+    import simulation
 
     # discovery is done from the directory where the main test
     # module (this one) is located
@@ -26,7 +38,9 @@ def suite(top_dir=None):
     unittestsuites = [unittest.defaultTestLoader.discover(
         testpath, pattern='test*.py', top_level_dir=top_dir)]
 
-    doctests = [block, transaction, address]
+    doctests = [block, blockchain, transaction, address, mempool, ledger, bloom,
+                merkle, encoding, sharedstate, scheduler, peers,
+                metrics, profiling, simulation]
     doctestsuites = [doctest.DocTestSuite(test, optionflags=
                                           doctest.ELLIPSIS |
                                           doctest.NORMALIZE_WHITESPACE |
@@ -1,10 +1,23 @@
 #! /usr/bin/env python3
 
 import unittest
+import os
+import tempfile
+import datetime
+import copy
+import threading
+import requests
+from unittest import mock
+import blockchain
+from blockchain import BlockChain
+from block import difficulty_target, work
+import node
+from node import Synchronizer
 from transaction import Transaction, TransactionBundle, \
     TransactionBlock, TransactionBlockChain
 from address import Address
-from config import NEW_ADDRESS_BALANCE, BLOCK_REWARD
+from merkle import verify_proof
+from config import NEW_ADDRESS_BALANCE, BLOCK_REWARD, TARGET_BLOCK_INTERVAL
 
 class TransactionBlockChainTest(unittest.TestCase):
     def test_new_balance(self):
@@ -85,5 +98,248 @@ class TransactionBlockChainTest(unittest.TestCase):
         self.assertFalse(
             TransactionBlockChain([block0, block1]).is_valid(difficulty=0))
         
+    def test_merkle_root(self):
+        keys = [Address(seed=str(i)) for i in range(2)]
+        txs = [Transaction(keys[0].address, keys[1].address, 0.1 * i, 0.01)
+               for i in range(3)]
+        for tx in txs:
+            tx.sign(keys[0])
+        bundle = TransactionBundle(miner_address=keys[1].address,
+                                   transactions=txs)
+        chain = TransactionBlockChain()
+        chain.append(chain.mine(bundle.as_json(), difficulty=0))
+        block = chain[0]
+        self.assertEqual(block.version, 2)
+        self.assertEqual(block.merkle_root, bundle.merkle_root())
+        self.assertTrue(chain.is_valid(difficulty=0))
+        for tx in txs:
+            self.assertTrue(verify_proof(tx.leaf_hash(),
+                                         bundle.merkle_proof(tx.uuid),
+                                         block.merkle_root))
+        # the data can't be changed without changing the merkle root, and
+        # with it the hash
+        original_hash = block.get_hash()
+        bundle.transactions.pop()
+        block.data = bundle.as_json()
+        self.assertFalse(block.is_valid())
+        block.set_transaction_bundle(bundle)
+        self.assertTrue(block.is_valid())
+        self.assertNotEqual(block.get_hash(), original_hash)
+
+    def test_storage(self):
+        keys = [Address(seed=str(i)) for i in range(2)]
+        tx = Transaction(keys[0].address, keys[1].address, 0.1, 0.01)
+        tx.sign(keys[0])
+        chain = TransactionBlockChain()
+        for i in range(2):
+            bundle = TransactionBundle(miner_address=keys[1].address,
+                                       transactions=[tx] if i else [])
+            chain.append(chain.mine(bundle.as_json(), difficulty=0))
+        with tempfile.TemporaryDirectory() as data_dir:
+            for storage in ["json", "binary", "json"]:
+                for block in chain:
+                    block.save(data_dir, storage)
+                # a block is stored in one format only
+                self.assertEqual(len(os.listdir(data_dir)), len(chain))
+                loaded = TransactionBlockChain.load(data_dir)
+                self.assertEqual([b.get_hash() for b in loaded],
+                                 [b.get_hash() for b in chain])
+                self.assertTrue(loaded.is_valid(difficulty=0))
+
+    def test_save_shorter(self):
+        def mined(n, miner):
+            chain = TransactionBlockChain()
+            for _ in range(n):
+                bundle = TransactionBundle(miner_address=miner)
+                chain.append(chain.mine(bundle.as_json(), difficulty=0))
+            return chain
+        longer, shorter = mined(5, "a"), mined(3, "b")
+        with tempfile.TemporaryDirectory() as data_dir:
+            longer.save(data_dir)
+            # e.g. a blockchain with more work replaced the longer one
+            shorter.save(data_dir)
+            loaded = TransactionBlockChain.load(data_dir)
+            self.assertEqual(loaded, shorter)
+            self.assertTrue(loaded.is_valid(difficulty=0))
+
+    def test_mine_stop(self):
+        chain = TransactionBlockChain()
+        stop = threading.Event()
+        stop.set()
+        bundle = TransactionBundle(miner_address="")
+        self.assertIsNone(chain.mine(bundle.as_json(), 0, stop=stop))
+        stop.clear()
+        self.assertIsNotNone(chain.mine(bundle.as_json(), 0, stop=stop))
+
+@mock.patch.object(blockchain, "RETARGET_WINDOW", 4)
+class RetargetTest(unittest.TestCase):
+    start = datetime.datetime(2020, 1, 1)
+
+    def extend(self, chain, n, interval, difficulty=1):
+        """Append n blocks at the given interval (in seconds) that satisfy
+        their targets, without waiting for them as mine does"""
+        for _ in range(n):
+            timestamp = self.start + datetime.timedelta(
+                seconds=interval * len(chain))
+            block = chain.next_block("block %d" % len(chain),
+                                     timestamp.isoformat())
+            target = chain.target(block.index, difficulty)
+            while not block.satisfies_pow(target):
+                block.nonce += 1
+            chain.append(block)
+        return chain
+
+    def test_target(self):
+        limit = difficulty_target(1)
+        fast = self.extend(BlockChain(), 8, TARGET_BLOCK_INTERVAL / 2)
+        self.assertEqual(fast.target(3, 1), limit)
+        self.assertEqual(fast.target(4, 1), limit // 2)
+        self.assertEqual(fast.target(8, 1), limit // 4)
+        self.assertEqual(fast.target(8, 0), difficulty_target(0))
+        # much faster: by at most a factor 4 per window
+        self.assertEqual(self.extend(BlockChain(), 4, 0).target(4, 1),
+                         limit // 4)
+        # slower: never easier than the initial target
+        slow = self.extend(BlockChain(), 8, TARGET_BLOCK_INTERVAL * 2)
+        self.assertEqual(slow.target(8, 1), limit)
+
+    def test_is_valid(self):
+        chain = self.extend(BlockChain(), 6, TARGET_BLOCK_INTERVAL / 2)
+        self.assertTrue(chain.is_valid(1))
+        self.assertFalse(chain.is_valid(2))
+        # a block that only satisfies the initial target
+        block = chain.next_block("easy", chain[-1].timestamp)
+        while not block.satisfies_pow(difficulty_target(1)) or \
+              block.satisfies_pow(chain.target(block.index, 1)):
+            block.nonce += 1
+        chain.append(block)
+        self.assertFalse(chain.is_valid(1))
+
+    def test_work(self):
+        fast = self.extend(BlockChain(), 12, TARGET_BLOCK_INTERVAL / 2)
+        slow = self.extend(BlockChain(), 13, TARGET_BLOCK_INTERVAL)
+        limit = difficulty_target(1)
+        self.assertEqual(slow.work(1), 13 * work(limit))
+        self.assertEqual(fast.work(1), 4 * (work(limit) + work(limit // 2) +
+                                            work(limit // 4)))
+        # the shorter blockchain has more work
+        self.assertGreater(fast.work(1), slow.work(1))
+        self.assertEqual(slow.work(0), 13)
+
+    @mock.patch.object(node, "DIFFICULTY", 1)
+    def test_malformed_timestamp(self):
+        chain = self.extend(BlockChain(), 21, TARGET_BLOCK_INTERVAL)
+        chain[0].timestamp = "yesterday"
+        synchronizer = Synchronizer()
+        synchronizer.init("localhost", 0, {}, {})
+        own = BlockChain()
+        with mock.patch.object(synchronizer, "chainwork",
+                               return_value=(21, 10 ** 9)), \
+             mock.patch.object(synchronizer, "is_pruned",
+                               return_value=False), \
+             mock.patch.object(node, "block_hash", return_value="tip"), \
+             mock.patch.object(synchronizer, "download_blockchain",
+                               return_value=(0, chain)):
+            # the peer is rejected instead of the error escaping
+            self.assertIs(synchronizer.get_longest_blockchain(
+                own, {"localhost:1": 0}), own)
+        self.assertEqual(synchronizer.rejected, {"localhost:1": "tip"})
+
+# the blocks are mined at difficulty 0
+@mock.patch.object(node, "DIFFICULTY", 0)
+class AssumeValidTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        keys = [Address(seed=str(i)) for i in range(2)]
+        # not signed, so only valid if assumed to be
+        self.tx = Transaction(keys[0].address, keys[1].address, 0.1, 0, "")
+        self.chain = TransactionBlockChain()
+        for txs in [[], [self.tx], []]:
+            bundle = TransactionBundle("", keys[1].address, txs)
+            self.chain.append(self.chain.mine(bundle.as_json(), 0))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def synchronizer(self, reindex=False):
+        synchronizer = Synchronizer()
+        synchronizer.chainclass = TransactionBlockChain
+        synchronizer.init("localhost", 0, {}, {}, reindex=reindex)
+        return synchronizer
+
+    def test_is_valid(self):
+        self.assertFalse(self.chain.is_valid(0))
+        self.assertFalse(self.chain.is_valid(0, assumed=1))
+        self.assertTrue(self.chain.is_valid(0, assumed=2))
+        self.assertFalse(self.chain.is_valid(10, assumed=2))
+        # the links are checked all the same
+        self.chain[1].nonce += 1
+        self.assertFalse(self.chain.is_valid(0, assumed=3))
+
+    def test_load(self):
+        data_dir = self.directory.name
+        self.synchronizer().save_blockchain(self.chain, data_dir)
+        self.assertEqual(self.synchronizer().load_blockchain(data_dir),
+                         self.chain)
+        with self.assertRaises(AssertionError):
+            self.synchronizer(reindex=True).load_blockchain(data_dir)
+        # blocks that weren't recorded as validated are validated
+        bundle = TransactionBundle("", "", [self.tx])
+        self.chain.append(self.chain.mine(bundle.as_json(), 0))
+        self.chain.save(data_dir)
+        with self.assertRaises(AssertionError):
+            self.synchronizer().load_blockchain(data_dir)
+
+@mock.patch.object(node, "DIFFICULTY", 0)
+class PrunedSyncTest(unittest.TestCase):
+    def mine(self, chain, miner, n):
+        for _ in range(n):
+            bundle = TransactionBundle("", miner)
+            chain.append(chain.mine(bundle.as_json(), 0))
+        return chain
+
+    def test_fork_in_pruned_blocks(self):
+        own = self.mine(TransactionBlockChain(), "own", 3)
+        # a fork after the genesis block, with more work
+        peer = self.mine(TransactionBlockChain([copy.copy(own[0])]), "peer", 3)
+        own.prune(1)
+        self.assertTrue(own[1].is_pruned())
+        synchronizer = Synchronizer()
+        synchronizer.chainclass = TransactionBlockChain
+        synchronizer.init("localhost", 0, {}, {})
+        def download(table, peers, start, end, chainclass, difficulty):
+            return peer[start:end]
+        with mock.patch.object(synchronizer, "chainwork",
+                               return_value=(len(peer), len(peer))), \
+             mock.patch.object(synchronizer, "is_pruned",
+                               return_value=False), \
+             mock.patch.object(synchronizer, "fork_point", return_value=1), \
+             mock.patch.object(node, "block_hash", return_value="tip"), \
+             mock.patch.object(node, "download_blocks", side_effect=download):
+            synced = synchronizer.get_longest_blockchain(
+                own, {"localhost:1": 0})
+        # built anew from the genesis block
+        self.assertEqual(synced, peer)
+        self.assertIsNone(synced.snapshot)
+
+    def test_capabilities_unknown(self):
+        own = self.mine(TransactionBlockChain(), "own", 1)
+        synchronizer = Synchronizer()
+        synchronizer.init("localhost", 0, {}, {})
+        response = mock.Mock()
+        response.json.return_value = {} # without "pruned"
+        failures = [requests.ConnectionError(), response]
+        with mock.patch.object(synchronizer, "chainwork",
+                               return_value=(3, 3)), \
+             mock.patch.object(synchronizer.peer_table, "get",
+                               side_effect=failures), \
+             mock.patch.object(synchronizer, "download_blockchain") \
+             as download:
+            for _ in failures:
+                # the peer isn't used, nor does the sync round fail
+                self.assertIs(synchronizer.get_longest_blockchain(
+                    own, {"localhost:1": 0}), own)
+        download.assert_not_called()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,72 @@
+#! /usr/bin/env python3
+
+import unittest
+import json
+import requests
+from blockchain import BlockChain
+from peers import PeerTable
+from download import download_blocks, DownloadError
+
+class FakeResponse(object):
+    """A json response to a request with stream=True"""
+    status_code = 200
+    headers = {"Content-Type": "application/json"}
+
+    def __init__(self, value):
+        self.content = json.dumps(value).encode("utf8")
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+class FakePeerTable(PeerTable):
+    """Serves /blocks of the chain for every peer, except that the peer
+    "dead" doesn't respond and the peer "corrupt" changes the blocks."""
+    def __init__(self, chain):
+        PeerTable.__init__(self)
+        self.chain = chain
+        self.requests = []
+
+    def get(self, peer, path, etag=None, params=None, **kwargs):
+        self.requests.append((peer, params["start"], params["end"]))
+        if peer == "dead":
+            self.failed(peer)
+            raise requests.ConnectionError("dead")
+        blocks = [dict(block.__dict__) for block in
+                  self.chain[params["start"]:params["end"]]]
+        if peer == "corrupt":
+            for block in blocks:
+                block["data"] = "corrupt"
+        self.succeeded(peer, 0.01)
+        return FakeResponse(blocks)
+
+class DownloadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.chain = BlockChain()
+        for i in range(23):
+            cls.chain.append(cls.chain.mine("block %d" % i, 0))
+
+    def test_download(self):
+        table = FakePeerTable(self.chain)
+        blocks = download_blocks(table, ["dead", "good1", "corrupt", "good2"],
+                                 2, 23, BlockChain, 0, range_size=5)
+        self.assertEqual(blocks, self.chain.blocks[2:])
+        # the pieces were spread over the peers, and the failed ones retried
+        self.assertEqual(len(set(peer for (peer, _, _) in table.requests)), 4)
+        self.assertFalse(table.available("dead"))
+        self.assertFalse(table.available("corrupt"))
+        self.assertTrue(table.available("good1"))
+        self.assertTrue(BlockChain(self.chain.blocks[:2] + blocks).is_valid(0))
+
+    def test_all_fail(self):
+        table = FakePeerTable(self.chain)
+        with self.assertRaises(DownloadError):
+            download_blocks(table, ["dead", "corrupt"], 0, 23, BlockChain, 0,
+                            range_size=5)
+
+if __name__ == '__main__':
+    unittest.main()
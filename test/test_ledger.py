@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+
+import unittest
+from transaction import Transaction, TransactionBundle, TransactionBlockChain
+from address import Address
+from mempool import connect, migrate, insert, get_unprocessed
+import ledger
+
+class LedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.db = connect(":memory:")
+        migrate(self.db)
+        self.keys = [Address(seed=str(i)) for i in range(4)]
+        self.addr = [a.address for a in self.keys]
+
+    def transaction(self, i, j, amount, fee):
+        tx = Transaction(self.addr[i], self.addr[j], amount, fee,
+                         "%d -> %d" % (i, j))
+        tx.sign(self.keys[i])
+        return tx
+
+    def mine(self, chain, miner, *transactions):
+        bundle = TransactionBundle("", self.addr[miner], list(transactions))
+        chain.append(chain.mine(bundle.as_json(), 0))
+
+    def assertLedgerEqual(self, chain):
+        for confirmations in range(1, len(chain) + 1):
+            expected = chain.get_balances(confirmations)
+            actual = dict(ledger.get_balances(
+                self.db, confirmations=confirmations))
+            self.assertEqual(sorted(expected), sorted(actual))
+            for address in expected:
+                self.assertAlmostEqual(expected[address], actual[address])
+                self.assertAlmostEqual(
+                    expected[address],
+                    ledger.get_balance(self.db, address, confirmations))
+
+    def test_connect_and_reorganize(self):
+        chain = TransactionBlockChain()
+        tx01 = self.transaction(0, 1, 0.5, 0.01)
+        insert(tx01, self.db)
+        self.mine(chain, 2, tx01)
+        self.mine(chain, 3, self.transaction(1, 0, 1.2, 0.02))
+        self.assertEqual(ledger.sync(self.db, chain), (0, 2))
+        self.assertLedgerEqual(chain)
+        self.assertEqual(get_unprocessed(self.db), [])
+
+        # replace the last block by two others
+        fork = TransactionBlockChain(chain[:1])
+        self.mine(fork, 1)
+        self.mine(fork, 1, self.transaction(2, 3, 0.3, 0))
+        self.assertEqual(ledger.sync(self.db, fork), (1, 2))
+        self.assertLedgerEqual(fork)
+        # the transaction of the disconnected block is unprocessed again
+        self.assertEqual(len(get_unprocessed(self.db)), 1)
+
+        history = ledger.get_history(self.db, self.addr[1], limit=2)
+        self.assertEqual([entry["kind"] for entry in history["history"]],
+                         ["reward", "reward"])
+        history = ledger.get_history(self.db, self.addr[1], history["cursor"],
+                                     limit=2)
+        self.assertEqual([entry["kind"] for entry in history["history"]],
+                         ["received"])
+        self.assertIsNone(history["cursor"])
+
+    def test_reset(self):
+        chain = TransactionBlockChain()
+        tx01 = self.transaction(0, 1, 0.5, 0.01)
+        insert(tx01, self.db)
+        self.mine(chain, 2, tx01)
+        self.mine(chain, 3)
+        ledger.sync(self.db, chain)
+        ledger.reset(self.db)
+        self.assertEqual(ledger.tip(self.db), -1)
+        self.assertEqual(len(get_unprocessed(self.db)), 1)
+        self.assertEqual(ledger.sync(self.db, chain), (0, 2))
+        self.assertLedgerEqual(chain)
+        self.assertEqual(get_unprocessed(self.db), [])
+
+    def test_prefix(self):
+        chain = TransactionBlockChain()
+        for i in range(4):
+            self.mine(chain, i)
+        ledger.sync(self.db, chain)
+        prefix = self.addr[0][:2]
+        self.assertEqual(ledger.get_balances(self.db, prefix),
+                         [(self.addr[0], ledger.get_balance(self.db,
+                                                            self.addr[0]))])
+        first, second = ledger.get_balances(self.db, limit=2)
+        self.assertEqual(ledger.get_balances(self.db, after=first[0], limit=1),
+                         [second])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+
+import unittest
+from collections import defaultdict
+from transaction import Transaction
+from address import Address
+from mempool import MIGRATIONS, connect, migrate, insert, exists, get_unprocessed, \
+    evict, drop_conflicting, pending_balance, pending_balances, mempool_sequence, \
+    insert_many, existing, mempool_etag
+
+class MempoolTest(unittest.TestCase):
+    def setUp(self):
+        self.db = connect(":memory:")
+        migrate(self.db)
+        self.keys = [Address(seed=str(i)) for i in range(3)]
+        self.addr = [a.address for a in self.keys]
+
+    def transaction(self, i, j, amount, fee):
+        tx = Transaction(self.addr[i], self.addr[j], amount, fee,
+                         "%d -> %d" % (i, j))
+        tx.sign(self.keys[i])
+        return tx
+
+    def test_migrate_twice(self):
+        migrate(self.db)
+        self.assertEqual(self.db.execute("pragma user_version").fetchone()[0],
+                         len(MIGRATIONS))
+
+    def test_evict_lowest_fee(self):
+        txs = [self.transaction(0, 1, 0.1, fee) for fee in [0.03, 0.01, 0.02]]
+        for tx in txs:
+            insert(tx, self.db)
+        # within the limits
+        self.assertEqual(evict(self.db, max_transactions=3), [])
+        self.assertEqual(evict(self.db, max_transactions=2), [txs[1].uuid])
+        self.assertEqual(len(get_unprocessed(self.db)), 2)
+        # only the highest fee fits in the size of two transactions
+        evict(self.db, max_bytes=2 * len(txs[0].as_json()) - 1)
+        self.assertEqual([tx.uuid for tx in get_unprocessed(self.db)],
+                         [txs[0].uuid])
+
+    def test_pending_balances(self):
+        insert(self.transaction(0, 1, 0.5, 0.01), self.db)
+        insert(self.transaction(1, 2, 0.25, 0.02), self.db)
+        insert(self.transaction(0, 2, 0.5, 0.01), self.db, block=0)
+        pending = pending_balances(self.db)
+        self.assertEqual(len(pending), 3)
+        self.assertAlmostEqual(pending[self.addr[0]], -0.51)
+        self.assertAlmostEqual(pending[self.addr[1]], 0.5 - 0.27)
+        self.assertAlmostEqual(pending[self.addr[2]], 0.25)
+        for address in self.addr:
+            self.assertAlmostEqual(pending_balance(self.db, address),
+                                   pending[address])
+        self.assertEqual(pending_balance(self.db, "unknown"), 0)
+
+    def test_drop_conflicting(self):
+        mined = self.transaction(0, 1, 0.5, 0.01)
+        insert(mined, self.db, block=0)
+        double_spend = self.transaction(0, 2, 0.5, 0.01)
+        affordable = self.transaction(0, 2, 0.1, 0.01)
+        waiting = self.transaction(1, 2, 5.0, 0.01) # 1 hasn't spent yet
+        for tx in [double_spend, affordable, waiting]:
+            insert(tx, self.db)
+        balances = defaultdict(float, {self.addr[0]: 0.49})
+        self.assertEqual(drop_conflicting(self.db, balances), 1)
+        self.assertFalse(exists(double_spend, self.db))
+        self.assertTrue(exists(affordable, self.db))
+        self.assertTrue(exists(waiting, self.db))
+
+    def test_mempool_sequence(self):
+        sequences = [mempool_sequence(self.db)]
+        tx = self.transaction(0, 1, 0.5, 0.01)
+        insert(tx, self.db)
+        sequences.append(mempool_sequence(self.db))
+        # mined: no longer unprocessed
+        self.db.execute("update transactions set block = 0")
+        sequences.append(mempool_sequence(self.db))
+        # transactions that were already mined don't change the mempool
+        insert(self.transaction(0, 2, 0.5, 0.01), self.db, block=1)
+        self.db.execute("update transactions set block = 2 where block = 1")
+        self.assertEqual(mempool_sequence(self.db), sequences[-1])
+        self.assertEqual(len(set(sequences)), 3)
+
+    def test_insert_many(self):
+        txs = [self.transaction(0, 1, 0.1, fee) for fee in [0.01, 0.02]]
+        insert(txs[0], self.db)
+        sequence = mempool_sequence(self.db)
+        insert_many(txs, self.db, ignore=True)
+        self.assertEqual(len(get_unprocessed(self.db)), 2)
+        self.assertEqual(mempool_sequence(self.db), sequence + 1)
+        self.assertEqual(existing([tx.uuid for tx in txs] + ["unknown"],
+                                  self.db),
+                         set(tx.uuid for tx in txs))
+
+    def test_mempool_etag(self):
+        # a database created again starts with the same sequence
+        other = connect(":memory:")
+        migrate(other)
+        self.assertEqual(mempool_sequence(other), mempool_sequence(self.db))
+        self.assertNotEqual(mempool_etag(other), mempool_etag(self.db))
+        etag = mempool_etag(self.db)
+        insert(self.transaction(0, 1, 0.1, 0.01), self.db)
+        self.assertNotEqual(mempool_etag(self.db), etag)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+#! /usr/bin/env python3
+
+import unittest
+import json
+from metrics import Registry, exposition
+from mempool import connect, migrate, QUERY_SECONDS
+
+class MetricsTest(unittest.TestCase):
+    def test_processes(self):
+        web, miner = Registry(), Registry()
+        web.gauge("peers", "Peers").set(3, view="active")
+        miner.gauge("peers", "Peers").set(2, view="active")
+        miner.histogram("phase_seconds", "Phases").observe(20, phase="mining")
+        # the snapshots are shared as json
+        text = exposition({"web": json.loads(json.dumps(web.snapshot())),
+                           "miner": json.loads(json.dumps(miner.snapshot()))})
+        self.assertEqual(text.count("# TYPE peers gauge"), 1)
+        self.assertIn('peers{process="miner",view="active"} 2', text)
+        self.assertIn('peers{process="web",view="active"} 3', text)
+        self.assertIn('phase_seconds_bucket{process="miner",phase="mining",'
+                      'le="10"} 0', text)
+        self.assertIn('phase_seconds_bucket{process="miner",phase="mining",'
+                      'le="+Inf"} 1', text)
+
+    def test_clear(self):
+        registry = Registry()
+        counter = registry.counter("hashes_total", "Hashes")
+        counter.inc(5)
+        registry.clear()
+        counter.inc(1)
+        self.assertEqual(counter.value(), 1)
+        # declared again: the same metric
+        self.assertIs(registry.counter("hashes_total", "Hashes"), counter)
+
+    def test_query_timing(self):
+        db = connect(":memory:")
+        migrate(db)
+        db.execute("select count(*) from transactions").fetchone()
+        self.assertIn({"statement": "select transactions"},
+                      [labels for labels, _ in
+                       QUERY_SECONDS.snapshot()["samples"]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+
+import unittest
+import requests
+from peers import PeerTable, add_to_view, sample_view
+from config import PEER_BACKOFF, PEER_MAX_BACKOFF
+
+class PeerTableTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.table = PeerTable(clock=lambda: self.now)
+
+    def test_backoff(self):
+        delays = []
+        for _ in range(12):
+            self.table.failed("dead:5000")
+            delays.append(self.table.stats["dead:5000"].retry_time - self.now)
+        self.assertEqual(delays[:3],
+                         [PEER_BACKOFF, 2 * PEER_BACKOFF, 4 * PEER_BACKOFF])
+        self.assertEqual(delays[-1], PEER_MAX_BACKOFF)
+        # a success resets the backoff
+        self.table.succeeded("dead:5000", 0.1)
+        self.assertTrue(self.table.available("dead:5000"))
+        self.table.failed("dead:5000")
+        self.assertEqual(self.table.stats["dead:5000"].retry_time - self.now,
+                         PEER_BACKOFF)
+
+    def test_score(self):
+        # flaky peers rank below reliable ones with the same latency
+        for i in range(10):
+            self.table.succeeded("reliable:5000", 0.1)
+            self.table.succeeded("flaky:5000", 0.1)
+            if i % 2:
+                self.table.failed("flaky:5000")
+                self.now += PEER_MAX_BACKOFF
+        self.assertEqual(self.table.best(["flaky:5000", "reliable:5000"]),
+                         ["reliable:5000", "flaky:5000"])
+        # the round trip time is smoothed
+        self.table.succeeded("reliable:5000", 10)
+        self.assertLess(self.table.stats["reliable:5000"].rtt, 2)
+
+    def test_get_failure(self):
+        # nothing listens on port 1
+        with self.assertRaises(requests.RequestException):
+            self.table.get("127.0.0.1:1", "/running")
+        self.assertFalse(self.table.available("127.0.0.1:1"))
+        self.assertEqual(self.table.best(["127.0.0.1:1"]), [])
+
+class ViewTest(unittest.TestCase):
+    def test_bounded(self):
+        view = {}
+        evicted = []
+        for i in range(100):
+            evicted += add_to_view(view, ["peer%d" % i], 8)
+        self.assertEqual(len(view), 8)
+        self.assertIn("peer99", view)
+        self.assertEqual(len(evicted), 92)
+        self.assertEqual(set(evicted) | set(view),
+                         set("peer%d" % i for i in range(100)))
+
+    def test_known_peers_stay(self):
+        view = {"a": 1.0, "b": 2.0}
+        self.assertEqual(add_to_view(view, ["a", "b"], 2), [])
+        self.assertEqual(view, {"a": 1.0, "b": 2.0})
+
+    def test_sample(self):
+        views = [{"a": 0, "b": 0}, {"b": 0, "c": 0}]
+        self.assertEqual(len(sample_view(views, 2)), 2)
+        self.assertEqual(sorted(sample_view(views, 5, exclude=["a"])),
+                         ["b", "c"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+
+import os
+import unittest
+import tempfile
+import threading
+from profiling import Profiler, list_profiles, profile_text
+
+def work():
+    return sum(i * i for i in range(10000))
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.enabled = False
+        self.profiler = Profiler(lambda: self.enabled, self.directory, "miner",
+                                 interval=3600, keep=2)
+
+    def test_disabled(self):
+        with self.profiler.profile("phase", "sync"):
+            work()
+        self.profiler.flush()
+        self.assertEqual(list_profiles(self.directory), [])
+
+    def test_added_up(self):
+        self.enabled = True
+        for _ in range(3):
+            with self.profiler.profile("route", "/block"):
+                work()
+        with self.profiler.profile("phase", "mining"):
+            work()
+        # nothing is written before the interval
+        self.assertEqual(list_profiles(self.directory), [])
+        self.profiler.flush()
+        files = list_profiles(self.directory)
+        self.assertEqual(len(files), 2)
+        self.assertEqual(list_profiles(self.directory, "miner-route-block-"),
+                         [f for f in files if "route" in f])
+        text = profile_text(os.path.join(
+            self.directory, list_profiles(self.directory, "miner-route")[0]))
+        self.assertIn("work", text)
+        # the three calls, added up
+        self.assertRegex(text, r"\n\s+3\s+[\d.\s]+\S*\(work\)")
+
+    def test_nested(self):
+        self.enabled = True
+        with self.profiler.profile("phase", "outer"):
+            with self.profiler.profile("phase", "inner"):
+                work()
+        self.profiler.flush()
+        self.assertEqual(len(list_profiles(self.directory)), 1)
+
+    def test_rotation(self):
+        self.enabled = True
+        for _ in range(4):
+            with self.profiler.profile("phase", "sync"):
+                work()
+            self.profiler.flush()
+        self.assertEqual(len(list_profiles(self.directory)), 2)
+
+    def test_clear(self):
+        self.enabled = True
+        with self.profiler.profile("phase", "sync"):
+            work()
+        self.profiler.clear()
+        self.profiler.flush()
+        self.assertEqual(list_profiles(self.directory), [])
+
+    def test_threads(self):
+        self.enabled = True
+        def request():
+            with self.profiler.profile("route", "/nodes"):
+                work()
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.profiler.flush()
+        self.assertEqual(len(list_profiles(self.directory)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
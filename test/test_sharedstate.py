@@ -0,0 +1,60 @@
+#! /usr/bin/env python3
+
+import unittest
+from unittest import mock
+from multiprocessing import Process
+import sharedstate
+from sharedstate import SharedDict
+
+def register(peers, flags, n, prefix="peer"):
+    for i in range(n):
+        peers["%s%d" % (prefix, i)] = float(i)
+    flags["done"] = True
+
+class SharedDictTest(unittest.TestCase):
+    def test_other_process(self):
+        peers, flags = SharedDict(4096), SharedDict(256)
+        flags["done"] = False
+        peers["here"] = 0.0 # read before the other process changes it
+        self.assertEqual(peers.keys(), ["here"])
+        process = Process(target=register, args=(peers, flags, 20))
+        process.start()
+        process.join()
+        self.assertTrue(flags["done"])
+        self.assertEqual(len(peers), 21)
+        self.assertEqual(peers["peer19"], 19.0)
+
+    def test_concurrent_writers(self):
+        peers, flags = SharedDict(8192), SharedDict(256)
+        processes = [Process(target=register,
+                             args=(peers, flags, 50, "process%d." % j))
+                     for j in range(4)]
+        for process in processes:
+            process.start()
+        for i in range(50):
+            peers["local%d" % i] = i
+        for process in processes:
+            process.join()
+        # no changes are lost
+        self.assertEqual(len(peers), 250)
+
+    def test_copies(self):
+        d = SharedDict(256)
+        d["a"] = [1, 2]
+        d["a"].append(3)
+        d.get("a").append(3)
+        d.items()[0][1].append(3)
+        self.assertEqual(d["a"], [1, 2])
+
+    @mock.patch.object(sharedstate, "READ_TIMEOUT", 0.05)
+    def test_stuck_writer(self):
+        d = SharedDict(256)
+        d["a"] = 1
+        # a writer that died between the increments of the sequence number
+        d._sequence.value += 1
+        d._cache = (None, {}) # as in another process
+        with self.assertRaises(TimeoutError):
+            d.get("a")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+
+import random
+import unittest
+from simulation import Clock, Transport, Simulation, poisson_load
+from util import percentiles
+
+class ClockTest(unittest.TestCase):
+    def test_order(self):
+        clock, events = Clock(), []
+        clock.at(2, events.append, "b")
+        clock.at(1, events.append, "a")
+        clock.at(2, events.append, "c") # same time: in order of scheduling
+        clock.every(1.5, lambda: events.append(clock.now), start=0.5)
+        clock.run(3)
+        self.assertEqual(events, [0.5, "a", "b", "c", 2.0])
+        self.assertEqual(clock.now, 3)
+
+class TransportTest(unittest.TestCase):
+    def test_bandwidth(self):
+        transport = Transport(latency=0.1, jitter=0, bandwidth=1000)
+        rng = random.Random(0)
+        self.assertAlmostEqual(transport.arrival(0, "a", "b", 500, rng), 0.6)
+        # after the first message is sent
+        self.assertAlmostEqual(transport.arrival(0, "a", "c", 500, rng), 1.1)
+        # other senders aren't delayed
+        self.assertAlmostEqual(transport.arrival(0, "b", "a", 500, rng), 0.6)
+
+    def test_loss(self):
+        transport = Transport(loss=0.5, bandwidth=None)
+        rng = random.Random(0)
+        lost = sum(transport.arrival(0, "a", "b", 100, rng) is None
+                   for _ in range(1000))
+        self.assertTrue(400 < lost < 600)
+
+class SimulationTest(unittest.TestCase):
+    def test_fork(self):
+        simulation = Simulation(3, seed=0)
+        a, b, c = simulation.nodes
+        a.mine()
+        simulation.clock.run(1)
+        # a and b find the next block at the same time
+        a.mine()
+        b.mine()
+        simulation.clock.run(2)
+        self.assertEqual([len(node.blockchain) for node in simulation.nodes],
+                         [2, 2, 2])
+        self.assertNotEqual(a.tip(), b.tip())
+        c.mine()
+        simulation.clock.run(3)
+        self.assertEqual(len(set(node.tip() for node in simulation.nodes)), 1)
+        simulation.mining_end = 0
+        self.assertAlmostEqual(simulation.report(1)["orphan_rate"], 1 / 4)
+
+    def test_lossy_network(self):
+        simulation = Simulation(6, Transport(loss=0.2), seed=2,
+                                block_interval=20, degree=2)
+        simulation.add_load(poisson_load(simulation, 0.05, end=200))
+        report = simulation.run(300, settle=60)
+        self.assertGreater(report["messages_lost"], 0)
+        self.assertTrue(report["nodes_in_sync"])
+        self.assertEqual(report["transactions_pending"], 0)
+        self.assertGreater(report["block_propagation_s"]["p90"], 0.05)
+
+    def test_percentiles(self):
+        self.assertEqual(list(percentiles(range(1, 101)).values()),
+                         [51, 91, 100, 100])
+        self.assertEqual(percentiles([])["p50"], None)
+
+if __name__ == '__main__':
+    unittest.main()
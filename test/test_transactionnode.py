@@ -0,0 +1,222 @@
+#! /usr/bin/env python3
+
+import os
+import json
+import unittest
+import tempfile
+from unittest import mock
+import encoding
+import transaction
+import transactionnode
+import ledger
+import node as nodemodule
+from transactionnode import node, TransactionSynchronizer
+from transaction import Transaction, TransactionBundle, TransactionBlockChain
+from address import Address
+from mempool import Database, migrate, get_unprocessed, insert_many
+
+class PushTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        transactionnode.database = Database(
+            os.path.join(self.directory.name, "transactions.db"))
+        migrate(transactionnode.database.connection)
+        self.client = node.test_client()
+        self.keys = [Address(seed=str(i)) for i in range(2)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def transaction(self, amount, sign=True):
+        tx = Transaction(self.keys[0].address, self.keys[1].address, amount,
+                         0.01, "push")
+        if sign:
+            tx.sign(self.keys[0])
+        return tx
+
+    def test_pushtxs(self):
+        txs = [self.transaction(0.1), self.transaction(0.2),
+               self.transaction(0.3, sign=False)]
+        txs.append(txs[0])
+        response = self.client.put("/pushtxs",
+                                   json=[tx.__dict__ for tx in txs])
+        results = response.get_json()
+        self.assertEqual(len(results), 4)
+        self.assertTrue(results[0].startswith("received"))
+        self.assertTrue(results[1].startswith("received"))
+        self.assertTrue(results[2].startswith("Invalid"))
+        self.assertTrue(results[3].startswith("duplicate"))
+        self.assertEqual(len(get_unprocessed(transactionnode.get_db())), 2)
+        # the same result as /pushtx
+        response = self.client.put("/pushtx", json=txs[1].as_json())
+        self.assertTrue(response.data.startswith(b"duplicate"))
+
+    def test_binary(self):
+        tx = self.transaction(0.1)
+        response = self.client.put(
+            "/pushtxs", data=encoding.dumps([tx.__dict__]),
+            headers={"Content-Type": encoding.MIMETYPE,
+                     "Accept": encoding.ACCEPT})
+        self.assertEqual(encoding.loads(response.data),
+                         ["received transaction %s" % tx.uuid])
+
+    def test_bad_request(self):
+        self.assertEqual(self.client.put("/pushtxs", json={"a": 1})
+                         .status_code, 400)
+        self.assertEqual(self.client.put("/pushtxs", json=[{"a": 1}])
+                         .status_code, 400)
+
+    def test_bad_binary(self):
+        header = encoding.MAGIC + bytes([encoding.VERSION])
+        def put(body):
+            return self.client.put(
+                "/pushtxs", data=header + bytes(body),
+                headers={"Content-Type": encoding.MIMETYPE}).status_code
+        # an unknown key code
+        self.assertEqual(put([encoding.LIST, 1, encoding.DICT, 1,
+                              encoding.KEY, 255, encoding.NONE]), 400)
+        # nested too deeply
+        self.assertEqual(put(10000 * [encoding.LIST, 1] + [encoding.NONE]),
+                         400)
+
+    def test_proof(self):
+        tx = self.transaction(0.1)
+        chain = TransactionBlockChain()
+        for txs in [[tx], []]:
+            bundle = TransactionBundle("", self.keys[1].address, txs)
+            chain.append(chain.mine(bundle.as_json(), 0))
+        ledger.sync(transactionnode.get_db(), chain)
+        with mock.patch.object(nodemodule, "DATA_DIR", self.directory.name), \
+             mock.patch.object(node, "chainclass", TransactionBlockChain,
+                               create=True):
+            data_dir = nodemodule.get_chaindata_dir(
+                80, TransactionBlockChain, create=True)
+            chain.save(data_dir)
+            response = self.client.get("/proof?transaction_id=" + tx.uuid)
+            self.assertEqual(json.loads(response.data)["transaction"]["uuid"],
+                             tx.uuid)
+            chain.prune(1)
+            chain.save(data_dir)
+            response = self.client.get("/proof?transaction_id=" + tx.uuid)
+            self.assertEqual(response.status_code, 410)
+
+class ArgumentsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        transactionnode.database = Database(
+            os.path.join(self.directory.name, "transactions.db"))
+        migrate(transactionnode.database.connection)
+        self.client = node.test_client()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_announce(self):
+        for query in ["", "url=localhost:1", "url=localhost:1&length=x",
+                      "url=localhost:1&length=-1", "length=3"]:
+            self.assertEqual(self.client.get("/announce?" + query)
+                             .status_code, 400, query)
+
+    def test_history(self):
+        for query in ["limit=0", "limit=-1", "limit=x", "cursor=x"]:
+            self.assertEqual(self.client.get("/history?address=a&" + query)
+                             .status_code, 400, query)
+        with mock.patch.object(ledger, "get_history",
+                               return_value={}) as get_history, \
+             mock.patch.object(transactionnode, "MAX_HISTORY_PAGE", 10):
+            self.client.get("/history?address=a&limit=100000000")
+        self.assertEqual(get_history.call_args[0][3], 10)
+
+class TemplateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = Database(
+            os.path.join(self.directory.name, "transactions.db"))
+        migrate(self.database.connection)
+        self.synchronizer = TransactionSynchronizer(self.database, "miner")
+        self.synchronizer.init("localhost", 0, {}, {})
+        self.chain = TransactionBlockChain()
+        self.synchronizer.update(self.chain)
+        self.keys = [Address(seed=str(i)) for i in range(4)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def transaction(self, sender, fee, msg):
+        tx = Transaction(self.keys[sender].address, self.keys[3].address,
+                         0.1, fee, msg)
+        tx.sign(self.keys[sender])
+        return tx
+
+    def test_fee_per_byte(self):
+        small = self.transaction(0, 0.01, "")
+        large = self.transaction(1, 0.02, 1000 * "x") # less per byte
+        cheap = self.transaction(2, 0.001, "")
+        insert_many([small, large, cheap], self.database.connection)
+        limit = small.size() + cheap.size() + 10
+        with mock.patch.object(transactionnode, "MAX_BLOCK_BYTES", limit), \
+             mock.patch.object(transaction, "MAX_BLOCK_BYTES", limit):
+            data = self.synchronizer.next_block_data(self.chain, {})
+            # the large one doesn't fit, but leaves room for the cheap one
+            self.assertEqual([tx.uuid for tx in
+                              TransactionBundle.from_json(data)],
+                             [small.uuid, cheap.uuid])
+            self.assertTrue(self.chain.next_block(data).is_valid())
+        with mock.patch.object(transaction, "MAX_BLOCK_BYTES", limit - 20):
+            self.assertFalse(self.chain.next_block(data).is_valid())
+            self.assertFalse(TransactionBlockChain(
+                [self.chain.mine(data, 0)]).is_valid(0))
+
+    def test_incremental(self):
+        first = self.transaction(0, 0.01, "first")
+        insert_many([first], self.database.connection)
+        data = self.synchronizer.next_block_data(self.chain, {})
+        self.assertEqual(self.synchronizer.next_block_data(self.chain, {}),
+                         data)
+        # new transactions are added after the selected ones
+        second = self.transaction(1, 0.02, "second")
+        insert_many([second], self.database.connection)
+        data = self.synchronizer.next_block_data(self.chain, {})
+        self.assertEqual([tx.uuid for tx in TransactionBundle.from_json(data)],
+                         [first.uuid, second.uuid])
+        # on a new tip the selection starts over
+        self.chain.append(self.chain.mine(data, 0))
+        self.synchronizer.update(self.chain)
+        third = self.transaction(2, 0.01, "third")
+        insert_many([third], self.database.connection)
+        data = self.synchronizer.next_block_data(self.chain, {})
+        self.assertEqual([tx.uuid for tx in TransactionBundle.from_json(data)],
+                         [third.uuid])
+
+    def test_funding_later(self):
+        # an address without funds, that the third one pays later
+        poor = Address(seed="poor")
+        spend = Transaction(poor.address, self.keys[3].address, 1.5, 0.01, "")
+        spend.sign(poor)
+        insert_many([spend], self.database.connection)
+        data = self.synchronizer.next_block_data(self.chain, {})
+        self.assertEqual(len(TransactionBundle.from_json(data)), 0)
+        fund = Transaction(self.keys[2].address, poor.address, 0.9, 0, "")
+        fund.sign(self.keys[2])
+        insert_many([fund], self.database.connection)
+        data = self.synchronizer.next_block_data(self.chain, {})
+        self.assertEqual([tx.uuid for tx in TransactionBundle.from_json(data)],
+                         [fund.uuid, spend.uuid])
+
+    def test_chained(self):
+        # each one can only be paid for after the previous one, and they
+        # come in the opposite order of their fees
+        keys = [Address(seed="chain %d" % i) for i in range(4)]
+        txs = []
+        for i in range(3):
+            tx = Transaction(keys[i].address, keys[i + 1].address,
+                             0.9 + 0.5 * i, 0.01 * (i + 1), "")
+            tx.sign(keys[i])
+            txs.append(tx)
+        insert_many(txs, self.database.connection)
+        data = self.synchronizer.next_block_data(self.chain, {})
+        self.assertEqual([tx.uuid for tx in TransactionBundle.from_json(data)],
+                         [tx.uuid for tx in txs])
+
+if __name__ == '__main__':
+    unittest.main()
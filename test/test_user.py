@@ -0,0 +1,21 @@
+#! /usr/bin/env python3
+
+import unittest
+from transaction import Transaction
+from address import Address
+from user import presign
+
+class PresignTest(unittest.TestCase):
+    def test_presign(self):
+        txs = [Transaction.from_json(tx)
+               for tx in presign(25, 5, 0.001, workers=2, batch_size=10)]
+        self.assertEqual(len(txs), 25)
+        self.assertEqual(len(set(tx.uuid for tx in txs)), 25)
+        addresses = set(Address(seed=str(seed)).address for seed in range(5))
+        for tx in txs:
+            self.assertTrue(tx.is_valid())
+            self.assertIn(tx.from_addr, addresses)
+            self.assertLessEqual(tx.amount, 0.001)
+
+if __name__ == '__main__':
+    unittest.main()
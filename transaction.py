@@ -1,14 +1,18 @@
 #! /usr/bin/env python3
 
+import os
 import json
 from textwrap import dedent
 import requests
 import uuid as uuid_module
 from address import verify_signature
 from collections import defaultdict
-from block import Block
+from block import Block, calculate_hash
 from blockchain import BlockChain
-from config import BLOCK_REWARD, MAX_TRANSACTIONS_PER_BLOCK, NEW_ADDRESS_BALANCE
+from bloom import BloomFilter
+from merkle import leaf_hash, merkle_root, merkle_proof
+from config import BLOCK_REWARD, MAX_BLOCK_BYTES, \
+    NEW_ADDRESS_BALANCE, BLOCK_VERSION
 
 class Transaction(object):
     """
@@ -84,6 +88,16 @@ class Transaction(object):
     def header(self):
         return ("{0.uuid}:{0.from_addr}:{0.to_addr}:" 
                 + "{0.amount}:{0.fee}:{0.msg}").format(self)
+
+    def size(self):
+        """The size in bytes of the transaction, as it is stored and sent
+        around."""
+        return len(self.as_json())
+
+    def leaf_hash(self):
+        """The hash of this transaction, including the signature, as a leaf
+        of the merkle tree of a TransactionBundle"""
+        return leaf_hash(json.dumps(self.__dict__, sort_keys=True))
             
     def __str__(self):
         return dedent("""\
@@ -131,9 +145,32 @@ class TransactionBundle(object):
 
     def is_valid(self):
         return all(tx.is_valid() for tx in self)
-    
+
+    def size(self):
+        """The total size of the transactions, that is limited to
+        MAX_BLOCK_BYTES for every block"""
+        return sum(tx.size() for tx in self)
+
+    def merkle_leaves(self):
+        """The leaves of the merkle tree: the hash of msg and miner_address,
+        followed by the hashes of the transactions"""
+        return [leaf_hash(json.dumps(
+            {"msg": self.msg, "miner_address": self.miner_address},
+            sort_keys=True))] + [tx.leaf_hash() for tx in self]
+
+    def merkle_root(self):
+        return merkle_root(self.merkle_leaves())
+
+    def merkle_proof(self, uuid):
+        """The merkle proof (see merkle.merkle_proof) of the transaction
+        with the given uuid, or None if it isn't in this bundle."""
+        for i, tx in enumerate(self, 1):
+            if tx.uuid == uuid:
+                return merkle_proof(self.merkle_leaves(), i)
+        return None
+
     def __len__(self):
-        return len(self.blocks)
+        return len(self.transactions)
 
     def __iter__(self):
         return self.transactions.__iter__()
@@ -147,33 +184,155 @@ class TransactionBundle(object):
 #     raise NotImplementedError()
 
 class TransactionBlock(Block):
+    """A block whose data is a TransactionBundle in json format.
+
+    Blocks of version 1 are hashed like any Block. From version 2 the hash
+    is taken over the merkle root of the bundle instead of the data, so that
+    the header (the block without data) suffices to verify the proof of work
+    and to verify with a merkle proof that a transaction is in the block.
+
+    >>> block = TransactionBlock(0, version=2, nonce=0,
+    ...                          data=TransactionBundle("msg").as_json())
+    >>> header = block.header()
+    >>> "data" in header
+    False
+    >>> TransactionBlock(**header).get_hash() == block.get_hash()
+    True
+    """
+    # Defaults for blocks that don't have these fields, so that version 1
+    # blocks are serialized as before.
+    version = 1
+    merkle_root = None
+
+    def __init__(self, *args, version=1, merkle_root=None, **kwargs):
+        super(TransactionBlock, self).__init__(*args, **kwargs)
+        if version > 1:
+            self.version = version
+            self.merkle_root = merkle_root
+            if merkle_root is None and self.data:
+                self.merkle_root = self.get_transaction_bundle().merkle_root()
+
+    def get_hash(self):
+        if self.version == 1:
+            return super(TransactionBlock, self).get_hash()
+        return calculate_hash(self.index, self.prev_hash, self.merkle_root,
+                              self.timestamp, self.nonce)
+
+    def header(self):
+        """The fields on which the hash depends, as a dictionary that can
+        be passed to the constructor. Only for version 2 and later."""
+        assert self.version > 1, "Version 1 blocks are hashed with their data"
+        return dict((k, v) for (k, v) in self.__dict__.items() if k != "data")
+
     def get_transaction_bundle(self):
         return TransactionBundle.from_json(self.data)
     
     def set_transaction_bundle(self, txs):
         self.data = txs.as_json()
+        if self.version > 1:
+            self.merkle_root = txs.merkle_root()
+
+    def bloom_filter(self):
+        """A BloomFilter of the addresses (including the miner address) and
+        the transaction uuids in this block."""
+        txs = self.get_transaction_bundle()
+        items = [txs.miner_address]
+        for tx in txs:
+            items.extend([tx.uuid, tx.from_addr, tx.to_addr])
+        return BloomFilter.for_items(items)
         
     def is_valid(self):
+        txs = self.get_transaction_bundle()
         return super(TransactionBlock, self).is_valid() and \
-            self.get_transaction_bundle().is_valid()
+            (self.version == 1 or self.merkle_root == txs.merkle_root()) and \
+            txs.size() <= MAX_BLOCK_BYTES and txs.is_valid()
 
     
 class TransactionBlockChain(BlockChain):
+    """A blockchain of TransactionBlocks.
+
+    When it is pruned, a snapshot of the balances and of the transaction
+    uuids (to detect duplicates) after the last pruned block is kept, from
+    which the balances can be computed without the pruned data:
+
+    >>> chain = TransactionBlockChain()
+    >>> for i in range(5):
+    ...     chain.append(chain.mine(TransactionBundle("", "miner").as_json(), 0))
+    >>> balances = chain.get_balances()
+    >>> chain.prune(2)
+    >>> [block.is_pruned() for block in chain]
+    [True, True, True, False, False]
+    >>> chain.get_balances() == balances and chain.is_valid(difficulty=0)
+    True
+    """
+    # stored in the data directory of the blocks
+    SNAPSHOT_FILENAME = "snapshot.state"
+
+    def __init__(self, blocks=None, snapshot=None):
+        super(TransactionBlockChain, self).__init__(blocks)
+        # {"index": index of the last pruned block, "hash": its hash,
+        #  "balances": the balances after it, "uuids": the uuids up to it}
+        self.snapshot = snapshot
+
+    @classmethod
+    def load(cls, data_dir):
+        bchain = super(TransactionBlockChain, cls).load(data_dir)
+        filename = os.path.join(data_dir, cls.SNAPSHOT_FILENAME)
+        if os.path.isfile(filename):
+            with open(filename, 'r') as snapshot_file:
+                bchain.snapshot = json.load(snapshot_file)
+        return bchain
+
+    def save(self, data_dir):
+        super(TransactionBlockChain, self).save(data_dir)
+        if self.snapshot is not None and \
+           self._saved[data_dir].get("snapshot") is not self.snapshot:
+            self._saved[data_dir]["snapshot"] = self.snapshot
+            filename = os.path.join(data_dir, self.SNAPSHOT_FILENAME)
+            with open(filename, 'w') as snapshot_file:
+                json.dump(self.snapshot, snapshot_file)
+
+    def prune(self, depth):
+        """Discard the data of all blocks except the last depth ones, after
+        taking a snapshot of the balances."""
+        last = len(self) - depth - 1 # the last block to prune
+        if last < 0 or self[last].is_pruned():
+            return
+        balances, uuids = self._replay(last + 1)
+        super(TransactionBlockChain, self).prune(depth)
+        self.snapshot = {"index": last, "hash": self[last].get_hash(),
+                         "balances": dict(balances), "uuids": sorted(uuids)}
+
     @staticmethod
     def new_block(*args, **kwargs):
         """Contructs a block of a class compatible with this BlockChain class
         with the specified arguments"""
         return TransactionBlock(*args, **kwargs)
-        
-    def is_valid(self, difficulty):
-        # check balances, validity and unicity of transactions
-        try:
-            # raises AssertionError if positivity of balances and unicity
-            # of transactions is not satisfied
-            self.get_balances()
-        except AssertionError:
-            return False
-        return super(TransactionBlockChain, self).is_valid(difficulty)
+
+    def extended(self, start, blocks):
+        """Keeps the snapshot, so the blocks from start on shouldn't replace
+        pruned blocks"""
+        assert self.snapshot is None or self.snapshot["index"] < start, \
+            "Block %d is pruned" % start
+        return type(self)(self.blocks[:start] + blocks, self.snapshot)
+
+    def next_block(self, data, timestamp=None):
+        """Newly mined blocks have version BLOCK_VERSION"""
+        block = super(TransactionBlockChain, self).next_block(data, timestamp)
+        return self.new_block(version=BLOCK_VERSION, **block.__dict__)
+
+    def is_valid(self, difficulty, assumed=0):
+        # check balances, validity and unicity of transactions, unless all
+        # blocks are assumed to be valid
+        if assumed < len(self):
+            try:
+                # raises AssertionError if positivity of balances and
+                # unicity of transactions is not satisfied
+                self.get_balances()
+            except AssertionError:
+                return False
+        return super(TransactionBlockChain, self).is_valid(difficulty,
+                                                           assumed)
     
     def get_balances(self, confirmations=1):
         """Returns a dictionary whose keys are all addresses appearing in the
@@ -184,9 +343,25 @@ class TransactionBlockChain(BlockChain):
         If a number of confirmations is passed, the balance is based only on
         transactions that have the specified number of confirmations, default 1,
         meaning anywhere in the chain (last block or earlier)."""
+        return self._replay(len(self) - confirmations + 1)[0]
+
+    def _replay(self, end):
+        """The balances and the set of transaction uuids after the blocks
+        up to (not including) end, starting from the snapshot if there is
+        one. Raises AssertionError if these can't be computed or the
+        balances are not valid."""
         balances = defaultdict(lambda:NEW_ADDRESS_BALANCE)
         transaction_uuids = set()
-        for block in self[:len(self) - confirmations + 1]:
+        start = 0
+        if self.snapshot is not None:
+            start = self.snapshot["index"] + 1
+            assert start <= end, "Balances before block %d are pruned" % start
+            assert self[start - 1].get_hash() == self.snapshot["hash"], \
+                "The snapshot is not of this blockchain"
+            balances.update(self.snapshot["balances"])
+            transaction_uuids.update(self.snapshot["uuids"])
+        for block in self[start:end]:
+            assert not block.is_pruned(), "Block %d is pruned" % block.index
             txs = block.get_transaction_bundle()
             for tx in txs:
                 assert not tx.uuid in transaction_uuids, \
@@ -198,7 +373,7 @@ class TransactionBlockChain(BlockChain):
             balances[txs.miner_address] += BLOCK_REWARD
             assert all([balance >= 0 for balance in balances.values()]), \
                 "Negative balances in block %d" % block.index
-        return balances
+        return balances, transaction_uuids
     
     def get_balance(self, address, confirmations=1):
         return self.get_balances(confirmations)[address]
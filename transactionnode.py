@@ -6,187 +6,353 @@ services to it:
 provides mempool services (receive and broadcast transactions):
 
 /pushtx(tx)       # post transaction in json format
-/unprocessed      # json of all unprocessed transactions
+/pushtxs(txs)     # put a list of transactions (json or binary, see
+                  # encoding.py) at once; returns the result of each
+/unprocessed      # json (or binary, see encoding.py) of all unprocessed
+                  # transactions
 /balance(address) # return balance of given address (pending/confirmed)
 /balances(prefix) # return balances of all addresses with the given prefix
+                  # (paginated with limit and after)
+/history(address) # changes in the balance of the address (paginated with
+                  # cursor)
+/filters          # bloom filters of the blocks
+                  # /unprocessed, /balances and /filters have ETags, and
+                  # answer requests with If-None-Match with 304 if they
+                  # didn't change
 /confirmations(transaction_id)
+/proof(transaction_id) # merkle proof that the transaction is in a block
 
 """
 
 import sys
 import os
 import getopt
-import sqlite3
 import requests
 import json
-from flask import request
-from node import node, start, active_peers, \
-    get_nodedata_dir, get_chaindata_dir, helptext, get_host_port, Synchronizer
+from collections import defaultdict
+from flask import request, abort
+from node import node, start, active_peers, get_nodedata_dir, \
+    get_chaindata_dir, stored_chainlength, helptext, get_host_port, \
+    Synchronizer, encoded_response, streamed_response, conditional_response
+from block import block_filename, read_block_file
+import encoding
 from transaction import Transaction, TransactionBundle, TransactionBlockChain
 from address import Address, could_be_valid_address
+import ledger
+from mempool import Database, migrate, exists, existing, insert, \
+    insert_many, iter_unprocessed, to_transaction, is_relayable, expire, \
+    evict, drop_conflicting, pending_balance, pending_balances, \
+    mempool_sequence, mempool_etag
 # should always be TransactionBlockChain or a subclass
-from config import MAX_TRANSACTIONS_PER_BLOCK
+from config import MAX_BLOCK_BYTES, MAX_PUSH_BATCH, MAX_HISTORY_PAGE
 
-db_connection = None # sqlite3.connect("")
+database = None # mempool.Database
+
+def get_db():
+    """The connection to the transaction database for the current thread"""
+    return database.connection
+
+def ledger_etag(db):
+    """The ETag of the responses derived from the ledger only: the hash of
+    its last block"""
+    return ledger.tip_hash(db) or "empty"
 
 # @node.route('/test', methods=['GET'])
 # def test():
 #     return "test"
 
+def accept_transactions(txs, db):
+    """Insert the transactions that are accepted in the mempool, all in one
+    database transaction, and return for each a message saying whether it
+    was received or why it was ignored"""
+    results, accepted = [], []
+    found = existing([tx.uuid for tx in txs], db)
+    for tx in txs:
+        if not is_relayable(tx):
+            results.append("Fee below minimum relay fee; ignoring")
+        elif not tx.is_valid():
+            results.append("Invalid transaction; ignoring")
+        elif tx.uuid in found:
+            results.append("duplicate transaction; ignoring")
+        else:
+            found.add(tx.uuid) # also a duplicate further in the batch
+            accepted.append(tx)
+            results.append("received transaction %s" % tx.uuid)
+    if accepted:
+        insert_many(accepted, db)
+        evicted = set(evict(db))
+        results = ["mempool full and fee too low; ignoring"
+                   if tx.uuid in evicted else result
+                   for tx, result in zip(txs, results)]
+    return results
+
 @node.route('/pushtx', methods=['PUT'])
 def pushtx():
     tx = Transaction.from_json(request.get_json())
-    if not tx.is_valid():
-        return "Invalid transaction; ignoring"
-    if not exists(tx, db_connection):
-        insert(tx, db_connection)
-        return "received transaction %s" % (tx.uuid)
-    else:
-        return "duplicate transaction; ignoring"
+    return accept_transactions([tx], get_db())[0]
+
+@node.route('/pushtxs', methods=['PUT'])
+def pushtxs():
+    """Accepts a list of transactions, as dictionaries, in json or in the
+    binary encoding (with its Content-Type). Returns the list of the
+    results, as those of /pushtx."""
+    try:
+        if request.mimetype == encoding.MIMETYPE:
+            items = encoding.loads(request.get_data())
+        else:
+            items = request.get_json(force=True)
+        if not isinstance(items, list):
+            abort(400)
+        txs = [Transaction(**item) for item in items]
+    except (ValueError, TypeError):
+        # TypeError: items that aren't transactions
+        abort(400)
+    if len(txs) > MAX_PUSH_BATCH:
+        abort(413)
+    return encoded_response(accept_transactions(txs, get_db()))
 
-def exists(tx, db):
-    c = db.execute(
-        "select count(*) from transactions where uuid=?;", (tx.uuid,))
-    return c.fetchone()[0] != 0
-    
-def insert(tx, db):
-    db.execute(
-        """insert into transactions values 
-           (:uuid, :from_addr, :to_addr, :amount, :fee, :msg, :signature, NULL)""",
-        tx.__dict__)
-    db.commit()
-
-def get_unprocessed(db):
-    c = db.execute(
-        """select uuid, from_addr, to_addr, amount, fee, msg, signature 
-           from transactions where block is NULL""")
-    return [Transaction(
-        **dict(zip(["uuid", "from_addr", "to_addr",
-                    "amount", "fee", "msg", "signature"], data))) for data in c]
-    
 @node.route('/unprocessed', methods=['GET'])
 def unprocessed():
     """Returns unprocessed transactions in the form of a json list 
-    of transaction contructor dictionaries."""
+    of transaction contructor dictionaries.
+    Supports conditional requests, with the mempool sequence (and the
+    identity of the database) as ETag."""
     # update_blockchain() - update is done in main_process
-    return json.dumps(
-        list(transaction.__dict__
-             for transaction in get_unprocessed(db_connection)))
+    db = get_db()
+    return conditional_response(
+        mempool_etag(db),
+        lambda: streamed_response(transaction.__dict__
+                                  for transaction in iter_unprocessed(db)))
 
 class TransactionSynchronizer(Synchronizer):
     chainclass = TransactionBlockChain
 
-    def __init__(self, db_connection, miner_address):
-        self.db_connection = db_connection
+    def __init__(self, database, miner_address):
+        self.database = database
         self.miner_address = miner_address
+        # the transactions selected for the next block, see next_block_data
+        self.selection = None
+
+    @property
+    def db_connection(self):
+        return self.database.connection
         
-    def __update_db_from_blockchain(self, blockchain, add_missing=False):
-        """Resets the block ID for each transaction in the mempool database"""
-        self.db_connection.execute(
-            "update transactions set block = NULL")
-        for block in blockchain:
-            for tx in block.get_transaction_bundle():
-                if add_missing:
-                    # add transactions in the blockchain that are not in the
-                    # database.
-                    # This command may not be standard SQL, but it works in sqlite
-                    self.db_connection.execute(
-                        """insert or ignore into transactions values 
-                        (:uuid, :from_addr, :to_addr, :amount, :fee, :msg, :signature, NULL)""",
-                        tx.__dict__)
-                self.db_connection.execute(
-                    "update transactions set block = ? where uuid = ?",
-                    (block.index, tx.uuid))
-        self.db_connection.commit()
-        
-    def next_block_data(self, blockchain, active_peers):
-        # Add unprocessed transactions from all peers to database
-        for peer in active_peers.keys(): # have to explictly loop over keys:
-                                         # does not exacly behave as dict
+    def update(self, blockchain):
+        """Bring the ledger in the database up to date with the blockchain"""
+        ledger.sync(self.db_connection, blockchain)
+        if self.prune_depth is not None:
+            ledger.prune(self.db_connection,
+                         len(blockchain) - self.prune_depth - 1)
+
+    def load_blockchain(self, chaindata_dir):
+        """When reindexing, the ledger is also built again from scratch"""
+        blockchain = super(TransactionSynchronizer, self).load_blockchain(
+            chaindata_dir)
+        if self.reindex:
+            ledger.reset(self.db_connection)
+            self.db_connection.commit()
+        return blockchain
+
+    def pull_mempool(self, active_peers):
+        """Add unprocessed transactions from all peers to database"""
+        # a copy, the best peers first: may change meanwhile
+        for peer in self.peer_table.best(active_peers.keys()):
+            url = "http://%s/unprocessed" % peer
             try:
-                txs = requests.get("http://%s/unprocessed" % peer).json()
-            except requests.ConnectionError:
-                continue
-            for tx in txs:
-                # add transactions in the blockchain that are not in the database.
-                # This command may not be standard SQL, but it works in sqlite
-                self.db_connection.execute(
-                    """insert or ignore into transactions values 
-                    (:uuid, :from_addr, :to_addr, :amount, :fee, :msg, :signature, NULL)""",
-                    tx)
+                response = self.peer_table.get(
+                    peer, "/unprocessed", self.etags.get(url),
+                    headers={"Accept": encoding.ACCEPT}, stream=True)
+                if response.status_code == 304: # nothing new
+                    continue
+                # the transactions are handled as they arrive
+                for tx in self.peer_table.iter_response(
+                        peer, "/unprocessed", response):
+                    # add transactions from peers that are not in the
+                    # database, subject to the same policy as those pushed
+                    # directly.
+                    tx = Transaction(**tx)
+                    if is_relayable(tx) and \
+                       not exists(tx, self.db_connection) and tx.is_valid():
+                        insert(tx, self.db_connection, commit=False)
+                self.etags[url] = response.headers.get("ETag")
+            except (requests.RequestException, ValueError):
+                # ValueError: the stream was cut off or is invalid, keep
+                # the transactions received before
+                pass
             self.db_connection.commit()
-        self.__update_db_from_blockchain(blockchain, add_missing=True)
-
-        # c = self.db_connection.execute(
-        #     """select uuid, from_addr, to_addr, amount, fee, msg, signature 
-        #     from transactions where block is NULL order by fee desc limit ?""",
-        #     MAX_TRANSACTIONS_PER_BLOCK)
-        c = self.db_connection.execute(
-            """select uuid, from_addr, to_addr, amount, fee, msg, signature 
-            from transactions where block is NULL order by fee desc""")
-
-        balances = blockchain.get_balances()
-
-        transactions = []
-        for data in c:
-            tx = Transaction(
-                **dict(zip(["uuid", "from_addr", "to_addr",
-                            "amount", "fee", "msg", "signature"], data)))
-            if balances[tx.from_addr] >= tx.amount + tx.fee:
-                balances[tx.from_addr] -= tx.amount + tx.fee
-                balances[tx.to_addr] += tx.amount
-                transactions.append(tx)
-                
-            if len(transactions) >= MAX_TRANSACTIONS_PER_BLOCK:
-                break
-        
-        msg = "Mined by %s" % self.node_address
-        return TransactionBundle(msg, self.miner_address, transactions).as_json()
+
+    def next_block_data(self, blockchain, active_peers):
+        """The transactions with the highest fee per byte that fit in the
+        block (see MAX_BLOCK_BYTES) and that can be paid for. The selection
+        is kept while the tip of the blockchain stays the same, and only
+        extended, if the mempool changed at all."""
+        # the transactions of the peers are pulled in pull_mempool
+        db = self.db_connection
+        tip = (len(blockchain),
+               blockchain.head().get_hash() if len(blockchain) else None)
+        selection = self.selection
+        if selection is None or selection["tip"] != tip:
+            balances = ledger.get_sender_balances(db)
+            drop_conflicting(db, balances)
+            selection = self.selection = {
+                "tip": tip, "balances": balances, "changes": defaultdict(float),
+                "transactions": [], "room": MAX_BLOCK_BYTES,
+                # the uuids of the transactions, and the transactions that
+                # were considered with their sizes
+                "selected": set(), "parsed": {},
+                "sequence": None, "data": None}
+        expire(db)
+        if mempool_sequence(db) != selection["sequence"]:
+            evict(db)
+            # changes after this are picked up by the next call
+            selection["sequence"] = mempool_sequence(db)
+            self.select_transactions(selection)
+            selection["data"] = None
+        if selection["data"] is None:
+            msg = "Mined by %s" % self.node_address
+            selection["data"] = TransactionBundle(
+                msg, self.miner_address, selection["transactions"]).as_json()
+        return selection["data"]
+
+    def select_transactions(self, selection):
+        """Add unprocessed transactions that weren't selected yet to the
+        selection, the highest fee per byte first, as long as they fit and
+        can be paid for. A transaction that doesn't fit may leave room for
+        smaller ones. One that can't be paid for is deferred until a
+        transaction to its sender is selected."""
+        db = self.db_connection
+        # in the blockchain, also of the senders that weren't known yet, and
+        # the changes due to the selected transactions
+        balances, changes = selection["balances"], selection["changes"]
+        balances.update(ledger.get_sender_balances(db))
+        selected, parsed = selection["selected"], selection["parsed"]
+        # the transactions that can't be paid for yet, by sender
+        deferred = defaultdict(list)
+        def select(tx, size):
+            """Select the transaction if it fits and can be paid for, and
+            then the deferred ones of its recipient, and so on; defer it if
+            it can't be paid for"""
+            candidates = [(tx, size)]
+            while candidates:
+                tx, size = candidates.pop()
+                if size > selection["room"]:
+                    continue
+                if balances[tx.from_addr] + changes[tx.from_addr] < \
+                   tx.amount + tx.fee:
+                    deferred[tx.from_addr].append((tx, size))
+                    continue
+                changes[tx.from_addr] -= tx.amount + tx.fee
+                changes[tx.to_addr] += tx.amount
+                selection["transactions"].append(tx)
+                selected.add(tx.uuid)
+                selection["room"] -= size
+                # the highest fee per byte first
+                candidates.extend(reversed(deferred.pop(tx.to_addr, [])))
+        rows = db.execute(
+            """select uuid, from_addr, to_addr, amount, fee, msg, signature,
+            size from transactions where block is NULL
+            order by fee / size desc, received""").fetchall()
+        for data in rows:
+            # the size as stored, without parsing it
+            if data[0] in selected or data[-1] > selection["room"]:
+                continue
+            if data[0] not in parsed:
+                # with the size as the block is validated
+                tx = to_transaction(data[:-1])
+                parsed[data[0]] = (tx, tx.size())
+            select(*parsed[data[0]])
+        # forget the transactions that left the mempool
+        current = set(data[0] for data in rows)
+        for uuid in list(parsed):
+            if uuid not in current:
+                del parsed[uuid]
 
 
 @node.route('/balance', methods=['GET'])
 def balance():
     # update_blockchain() - update is done in main_process
-    # NOTE: block rewards and recipients of fees don't end up in the database
-    # so we really need the blockchain. Note that the child process of this same
-    # node actually has the blockchain, but we don't use it.
-    port = request.environ["SERVER_PORT"] # already is a string
-    local_blockchain = node.chainclass.load(get_chaindata_dir(port, node.chainclass))
+    # The ledger, including block rewards and fees, is kept up to date by the
+    # child process of this same node, that has the blockchain.
     address = request.args.get('address')
     confirmations = int(request.args.get('confirmations', '1'))
-    confirmed_balance = local_blockchain.get_balance(address, confirmations)
-    received, transferred = None, None
+    balance = ledger.get_balance(get_db(), address, confirmations)
     if confirmations == 0: # also consider unprocessed transactions
-        received = db_connection.execute(
-            "select sum(amount) from transactions where to_addr=? and block is NULL;",
-            (address,)).fetchone()[0]
-        transferred = db_connection.execute(
-            "select sum(amount) + sum(fee) from transactions where from_addr=? and block is NULL;",
-            (address,)).fetchone()[0]
-    return str(confirmed_balance + (received or 0) - (transferred or 0))
+        balance += pending_balance(get_db(), address)
+    return str(balance)
 
 @node.route('/balances', methods=['GET'])
 def balances():
-    """All balances, or only those starting with a certain prefix"""
-    port = request.environ["SERVER_PORT"] # already is a string
-    local_blockchain = node.chainclass.load(get_chaindata_dir(port, node.chainclass))
-    prefix = request.args.get('prefix',"")
+    """All balances, or only those starting with a certain prefix, in
+    the order of the addresses. At most limit balances are returned if
+    specified, and only of addresses after the given one, so that the last
+    address returned can be passed as after to get the next page."""
+    prefix = request.args.get('prefix', "")
+    after = request.args.get('after', "")
+    limit = request.args.get('limit')
+    limit = None if limit is None else int(limit)
     confirmations = int(request.args.get('confirmations', '1'))
-    all_confirmed_balances = local_blockchain.get_balances(confirmations)
-    selected_balances = all_confirmed_balances if not prefix \
-                        else dict(balance for balance in all_confirmed_balances.items()
-                                   if balance[0].startswith(prefix))
-    if confirmations == 0: # also consider unprocessed transactions
-        received, transferred = None, None
-        for address in selected_balances:
-            received = db_connection.execute(
-                "select sum(amount) from transactions where to_addr=? and block is NULL;",
-                (address,)).fetchone()[0]
-            transferred = db_connection.execute(
-                "select sum(amount) + sum(fee) from transactions where from_addr=? and block is NULL;",
-                (address,)).fetchone()[0]
-            selected_balances[address] += ((received or 0) - (transferred or 0))
-    return json.dumps(selected_balances)
+    db = get_db()
+    if confirmations != 0:
+        # streamed while they are read
+        return conditional_response(
+            ledger_etag(db),
+            lambda: streamed_response(ledger.iter_balances(
+                db, prefix, after, limit, confirmations), pairs=True))
+    return conditional_response(
+        "%s-%s" % (ledger_etag(db), mempool_etag(db)),
+        lambda: pending_balances_response(db, prefix, after, limit))
+
+def pending_balances_response(db, prefix, after, limit):
+    """The response to /balances with confirmations=0: the balances include
+    the unprocessed transactions."""
+    selected_balances = dict(ledger.get_balances(db, prefix, after, limit))
+    pending = pending_balances(db)
+    addresses = sorted(set(selected_balances).union(
+        address for address in pending
+        if address.startswith(prefix) and address > after))[:limit]
+    selected_balances = dict(
+        (address, pending.get(address, 0) +
+         (selected_balances[address] if address in selected_balances
+          else ledger.get_balance(db, address)))
+        for address in addresses)
+    return streamed_response(selected_balances.items(), pairs=True)
+
+@node.route('/history', methods=['GET'])
+def history():
+    """The changes in the balance of an address, most recent first, in
+    pages of at most limit (default 100, at most MAX_HISTORY_PAGE) entries.
+    Each page comes with a cursor to pass to get the next one (null on the
+    last page)."""
+    address = request.args.get('address')
+    if not address:
+        abort(400)
+    try:
+        cursor = request.args.get('cursor')
+        cursor = None if cursor is None else int(cursor)
+        limit = int(request.args.get('limit', '100'))
+    except ValueError:
+        abort(400)
+    if limit <= 0:
+        abort(400)
+    return json.dumps(ledger.get_history(
+        get_db(), address, cursor, min(limit, MAX_HISTORY_PAGE)))
+
+@node.route('/filters', methods=['GET'])
+def filters():
+    """The bloom filters of the blocks with start <= index < end (by
+    default all of them), as a json list of dictionaries with the index and
+    hash of the block and the filter in hex (see bloom.BloomFilter.as_hex).
+    With these clients can find the blocks that may concern an address or
+    transaction without downloading the others."""
+    start = int(request.args.get('start', '0'))
+    end = request.args.get('end')
+    db = get_db()
+    return conditional_response(
+        ledger_etag(db),
+        lambda: encoded_response([
+            {"index": index, "hash": hash, "filter": bloom}
+            for index, hash, bloom in ledger.get_filters(
+                    db, start, None if end is None else int(end))]))
 
 @node.route('/confirmations', methods=['GET'])
 def confirmations():
@@ -194,16 +360,44 @@ def confirmations():
     uuid = request.args.get('transaction_id', "")
     if uuid == "":
         abort(400)
-    block = db_connection.execute(
+    block = get_db().execute(
         "select block from transactions where uuid=?;",
         (uuid,)).fetchone()[0]
     if block is None:
         return "0"
     else:
         port = request.environ["SERVER_PORT"] # already is a string
-        chainlen = len(os.listdir(get_chaindata_dir(port, node.chainclass)))
+        chainlen = stored_chainlength(get_chaindata_dir(port, node.chainclass))
         return str(chainlen - block)
 
+@node.route('/proof', methods=['GET'])
+def proof():
+    """Proof that a transaction is in the blockchain: a json dictionary with
+    the transaction, the header of its block and the merkle proof (see
+    merkle.merkle_proof) of the transaction in the block.
+    Returns 404 if the transaction isn't in the blockchain, 400 if its
+    block is of version 1, which has no merkle root, and 410 if the data of
+    its block was pruned."""
+    uuid = request.args.get('transaction_id', "")
+    if uuid == "":
+        abort(400)
+    row = get_db().execute(
+        "select block from transactions where uuid=?;", (uuid,)).fetchone()
+    if row is None or row[0] is None:
+        abort(404)
+    port = request.environ["SERVER_PORT"] # already is a string
+    filename = block_filename(get_chaindata_dir(port, node.chainclass), row[0])
+    block = node.chainclass.new_block(**read_block_file(filename))
+    if block.version == 1:
+        abort(400)
+    if block.is_pruned():
+        abort(410) # Gone
+    txs = block.get_transaction_bundle()
+    tx = [tx for tx in txs if tx.uuid == uuid][0]
+    return json.dumps({"transaction": tx.__dict__,
+                       "header": block.header(),
+                       "proof": txs.merkle_proof(uuid)})
+
 def get_database_dir(port, create=False):
     return get_nodedata_dir(port, "", TransactionBlockChain, create)
 
@@ -216,38 +410,22 @@ def transaction_helptext(filename):
                       address, a seed may be passed.
         """
 
-def get_db_connection(opt, port):
+def get_database(opt, port):
     """For a database filename db, create the database if it didn't
-    exist, set the blocks of all transactions to NULL and return the
-    database connection."""
+    exist or bring its schema up to date and return the database."""
     db = opt.get("-d", "transactions.db")
     db_path = os.path.join(get_database_dir(port, create=True), db)
-    db_existed = os.path.isfile(db_path)
+    database = Database(db_path)
     # will be created if it doesn't exist
-    db_connection = sqlite3.connect(db_path)
-    if not db_existed:
-        db_connection.execute("""
-        create table transactions
-        (uuid      varchar primary key not null,
-         from_addr varchar             not null,
-         to_addr   varchar             not null,
-         amount    real                not null,
-         fee       real                not null,
-         msg       varchar             not null,
-         signature varchar             not null,
-         block     int);""")
-
-    # The local blockchain is empty on startup: set all transactions to
-    # unprocessed (no blocks)
-    db_connection.execute(
-        "update transactions set block = NULL")
-    db_connection.commit()
-    return db_connection
+    db_connection = database.connection
+    migrate(db_connection)
+    return database
 
 if __name__ == '__main__':
     # options for transaction database. Take care of the unicity of filenames
     # for different nodes.
-    opt, peer_urls = getopt.getopt(sys.argv[1:], "hHp:t:d:m:")
+    opt, peer_urls = getopt.getopt(sys.argv[1:], "hH:p:P:t:d:m:",
+                                   ["reindex"])
     opt = dict(opt)
     if "-h" in opt:
         print(transaction_helptext(os.path.basename(sys.argv[0])))
@@ -260,9 +438,9 @@ if __name__ == '__main__':
     if not could_be_valid_address(miner_address):
         miner_address = Address(seed=miner_address).address
     
-    db_connection = get_db_connection(opt, port)
+    database = get_database(opt, port)
 
     # Start the node with tracker services and the new transaction services
     # as well as the mining process
     start(opt, peer_urls, host, port, active_peers,
-          TransactionSynchronizer(db_connection, miner_address))
+          TransactionSynchronizer(database, miner_address))
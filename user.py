@@ -3,12 +3,26 @@
 import sys
 import getopt
 import os
+import time
+import shelve
+import threading
 import requests
-from random import random, randrange
-from util import multidict
+import multiprocessing
+from urllib.parse import urlencode
+from random import random, randrange, uniform
+from concurrent.futures import ThreadPoolExecutor
+from util import multidict, conditional_get, percentiles
 from address import Address, could_be_valid_address
-from transaction import Transaction
-from config import NODE_ADDRESSES
+from transaction import Transaction, TransactionBlock
+from block import difficulty_target
+from bloom import BloomFilter
+from merkle import verify_proof
+import encoding
+from config import NODE_ADDRESSES, DIFFICULTY, DATA_DIR
+
+# Responses with an ETag are cached here, so that they are requested again
+# with If-None-Match, and don't have to be sent if they didn't change
+CACHE_FILE = os.path.join(DATA_DIR, "usercache")
 
 def showhelp(path):
     print("""Usage:
@@ -50,24 +64,271 @@ def showhelp(path):
           Show the balance of all addresses that start with the specified prefix. 
           All addresses if prefix is omitted.
 
+          -n <num>       - number of balances fetched per request (default 1000)
+
+        - scan <address>
+
+          Show the transactions of the address (or the address generated from
+          the seed) in the blockchain. Only the blocks whose bloom filter
+          matches the address are downloaded.
+
+        - verify <transaction_id>
+
+          Verify that the transaction is in a block with a valid proof of
+          work, using a merkle proof and the header of the block only.
+
         - rnd 
 
           -s <max-seed>  - generate seeds in the range 0..max-seed (default 100)
           -n <num>       - number of random transactions (default 1)
 
+        - load
+
+          Push random transactions between the addresses of the seeds
+          0..max-seed to the running nodes at a target rate, and report the
+          latency of their acceptance and of their confirmation (inclusion
+          in a block of the first running node). The transactions are
+          signed before they are pushed, in several processes.
+
+          -n <num>       - number of transactions (default 1000)
+          -r <rate>      - transactions per second (default 100)
+          -s <max-seed>  - as for rnd (default 100)
+          -a <amount>    - maximum amount of a transaction (default 0.001)
+          -c <num>       - concurrent requests (default 16)
+          -b <num>       - transactions per request, to /pushtxs if more
+                           than 1 (default 1)
+          -w <num>       - processes that sign (default the number of cores)
+          -T <seconds>   - time to wait for confirmations (default 300)
+
     """.format(os.path.basename(path)))
 
-def send(tx, node_addresses):
+def push(txs, address, session=requests):
+    """Push the transactions to the node in a single request, and return
+    the result for each. Nodes that don't have /pushtxs get them one by
+    one."""
+    response = session.put("http://%s/pushtxs" % address,
+                           json=[tx.__dict__ for tx in txs],
+                           headers={"Accept": encoding.ACCEPT})
+    if response.status_code == 404:
+        return [session.put("http://%s/pushtx" % address,
+                            json=tx.as_json()).text for tx in txs]
+    response.raise_for_status()
+    return encoding.response_value(response)
+
+def send(txs, node_addresses):
     success = []
     for address in node_addresses:
         try:
-            requests.put("http://%s/pushtx" % address, json=tx.as_json())
+            results = push(txs, address)
             success.append(address)
-        except requests.ConnectionError as e:
-            print("Couldn't submit transaction to %s" % (address))
+        except requests.RequestException as e:
+            print("Couldn't submit transactions to %s" % (address))
+            continue
+        for tx, result in zip(txs, results):
+            if not result.startswith("received"):
+                print("%s: %s" % (address, result))
     if success:
         print("Successfully submitted to %s" % (success))
-        print(tx)
+        for tx in txs:
+            print(tx)
+
+# the addresses of the seeds, derived once in every signing process
+_addresses = {}
+
+def _derive_addresses(max_seed):
+    for seed in range(max_seed):
+        _addresses[seed] = Address(seed=str(seed))
+
+def sign_batch(specs):
+    """The json of the transactions with the given (seed_from, seed_to,
+    amount, fee) signed, in a process initialized with _derive_addresses"""
+    txs = []
+    for seed_from, seed_to, amount, fee in specs:
+        source = _addresses[seed_from]
+        tx = Transaction(source.address, _addresses[seed_to].address,
+                         amount, fee, "load from seed %d to seed %d"
+                         % (seed_from, seed_to))
+        tx.sign(source)
+        txs.append(tx.as_json())
+    return txs
+
+def presign(n, max_seed, max_amount, workers, batch_size=100):
+    """The json of n random transactions between the addresses of the seeds
+    0..max-seed, signed by workers processes"""
+    specs = []
+    for i in range(n):
+        amount = round(uniform(0.0001, max_amount), 6)
+        specs.append((randrange(max_seed), randrange(max_seed), amount,
+                      round(amount * 0.1 * random(), 6)))
+    batches = [specs[i:i + batch_size] for i in range(0, n, batch_size)]
+    with multiprocessing.Pool(workers, _derive_addresses, (max_seed,)) \
+         as pool:
+        return [tx for batch in pool.imap(sign_batch, batches)
+                for tx in batch]
+
+def running_nodes(node_addresses):
+    """The nodes that respond"""
+    running = []
+    for node in node_addresses:
+        try:
+            requests.get("http://%s/chainlength" % node, timeout=2)
+            running.append(node)
+        except requests.RequestException:
+            pass
+    return running
+
+def watch_confirmations(node, sent, confirmed, stop):
+    """Until the Event stop is set, record in confirmed the time from
+    sending (the time in sent) to the inclusion of the transactions in a
+    block of the node, by their uuid"""
+    session = requests.Session()
+    length = int(session.get("http://%s/chainlength" % node).text)
+    while not stop.wait(1):
+        try:
+            new_length = int(session.get("http://%s/chainlength" % node).text)
+            if new_length <= length:
+                continue
+            response = session.get("http://%s/blocks" % node, params={
+                "start": length, "end": new_length},
+                headers={"Accept": encoding.ACCEPT}, stream=True)
+            now = time.time()
+            for blockdata in encoding.iter_response(response):
+                for tx in TransactionBlock(**blockdata) \
+                        .get_transaction_bundle():
+                    if tx.uuid in sent and tx.uuid not in confirmed:
+                        confirmed[tx.uuid] = now - sent[tx.uuid]
+            length = new_length
+        except (requests.RequestException, ValueError):
+            # ValueError: the stream was cut off, try again
+            continue
+
+def load(txs, nodes, rate, concurrency, timeout, batch_size=1):
+    """Push the transactions (json) to the nodes in turn at the given rate
+    with concurrent requests, one per request to /pushtx or batch_size per
+    request to /pushtxs, and wait at most timeout seconds for them to be
+    confirmed. Returns the accept latencies, the confirmation latencies,
+    the number of rejected and failed transactions and the time taken to
+    push."""
+    sessions = threading.local() # a connection per thread, kept alive
+    sent = {} # uuid: time sent
+    accepted, confirmed = [], {}
+    failures = {"rejected": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def push_batch(batch, node):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        batch = [Transaction.from_json(tx) for tx in batch]
+        start = time.time()
+        try:
+            if batch_size == 1:
+                results = [sessions.session.put(
+                    "http://%s/pushtx" % node, json=batch[0].as_json(),
+                    timeout=30).text]
+            else:
+                results = push(batch, node, sessions.session)
+        except requests.RequestException:
+            with lock:
+                failures["failed"] += len(batch)
+            return
+        with lock:
+            for tx, result in zip(batch, results):
+                if result.startswith("received"):
+                    sent[tx.uuid] = start
+                    accepted.append(time.time() - start)
+                else:
+                    failures["rejected"] += 1
+
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch_confirmations,
+                               args=(nodes[0], sent, confirmed, stop))
+    watcher.start()
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(0, len(txs), batch_size):
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(push_batch, txs[i:i + batch_size],
+                            nodes[i // batch_size % len(nodes)])
+    duration = time.time() - start
+    deadline = time.time() + timeout
+    while len(confirmed) < len(sent) and time.time() < deadline:
+        time.sleep(1)
+    stop.set()
+    watcher.join()
+    return accepted, list(confirmed.values()), failures, duration
+
+def print_percentiles(name, values):
+    print("%-26s %s" % (name, "  ".join(
+        "%s %s" % (key, "-" if value is None else "%.3f" % value)
+        for key, value in percentiles(values).items())))
+
+def cached_get(url, params=None):
+    """The value (json or binary, see encoding.py) of the response to a GET
+    request of the url. If the response to the same request was cached, it
+    is returned instead when the node answers that it didn't change."""
+    key = url + "?" + urlencode(sorted((params or {}).items()))
+    if not os.path.isdir(DATA_DIR):
+        os.makedirs(DATA_DIR)
+    with shelve.open(CACHE_FILE) as cache:
+        etag, value = cache.get(key, (None, None))
+        response = conditional_get(url, etag, params=params,
+                                   headers={"Accept": encoding.ACCEPT})
+        if response.status_code == 304:
+            return value
+        value = encoding.response_value(response)
+        if response.status_code == 200 and "ETag" in response.headers:
+            cache[key] = (response.headers["ETag"], value)
+        return value
+
+def get_balances(node, prefix, limit):
+    """Generates (address, balance) for all addresses starting with prefix,
+    fetching them from the node in pages of limit balances."""
+    after = ""
+    while True:
+        page = cached_get("http://%s/balances" % node,
+                          params={"prefix": prefix, "after": after,
+                                  "limit": limit})
+        for balance in page.items():
+            yield balance
+        if len(page) < limit:
+            return
+        after = max(page)
+
+def scan(node, address):
+    """Generates the transactions in the blockchain of the node that
+    concern the address."""
+    filters = cached_get("http://%s/filters" % node)
+    for f in filters:
+        if address not in BloomFilter.from_hex(f["filter"]):
+            continue
+        block = TransactionBlock(**cached_get(
+            "http://%s/block" % node, params={"index": f["index"]}))
+        for tx in block.get_transaction_bundle():
+            if address in (tx.from_addr, tx.to_addr):
+                yield block.index, tx
+
+def verify(node, uuid):
+    """Obtains a proof that the transaction is in the blockchain of the
+    node and verifies it. Returns the verified transaction and the index of
+    its block, or raises a ValueError if the proof isn't valid."""
+    response = requests.get("http://%s/proof" % node,
+                            params={"transaction_id": uuid})
+    if response.status_code != 200:
+        raise ValueError("No proof available (status %d)"
+                         % response.status_code)
+    proof = response.json()
+    tx = Transaction(**proof["transaction"])
+    header = TransactionBlock(**proof["header"])
+    if tx.uuid != uuid or not tx.is_valid():
+        raise ValueError("Not a valid transaction with id %s" % uuid)
+    if not verify_proof(tx.leaf_hash(), proof["proof"], header.merkle_root):
+        raise ValueError("The transaction is not in the block")
+    # its actual target depends on earlier blocks, that aren't checked here
+    if not header.satisfies_pow(difficulty_target(DIFFICULTY)):
+        raise ValueError("The block doesn't satisfy the proof of work")
+    return tx, header.index
 
 def get_node_addresses(opt):
     addresses = opt.get("-t", [])
@@ -98,36 +359,69 @@ if __name__ == "__main__":
         else:
             address = Address.load(opt["-f"])
         msg = opt.get("-M", "")
-        fee = opt.get("-F", 0)
+        fee = float(opt.get("-F", 0))
         tx = Transaction(address.address, dest, amount, fee, msg)
         tx.sign(address)
-        send(tx, get_node_addresses(opt))
+        send([tx], get_node_addresses(opt))
     elif cmd == "address":
         opt, remaining = getopt.getopt(sys.argv[2:], "")
         opt = multidict(opt)
         print(Address(seed=remaining[0]).address)
     elif cmd == "balance":
-        opt, remaining = getopt.getopt(sys.argv[2:], "t:")
+        opt, remaining = getopt.getopt(sys.argv[2:], "t:n:")
         opt = multidict(opt)
         prefix = "" if not remaining else remaining[0]
+        limit = int(opt.get("-n", 1000))
         balances = None
         for node in get_node_addresses(opt):
             try:
-                balances = requests.get("http://%s/balances" % node,
-                                        params={"prefix": prefix}).json()
+                balances = list(get_balances(node, prefix, limit))
                 break
             except requests.ConnectionError:
                 continue
         if balances is None:
             print("Could not connect to any node")
         else:
-            for balance in balances.items():
+            for balance in balances:
                 print("%s: %.6f" % balance)
+    elif cmd == "scan":
+        opt, remaining = getopt.getopt(sys.argv[2:], "t:")
+        opt = multidict(opt)
+        assert len(remaining) == 1, "one argument required: address"
+        address = remaining[0]
+        if not could_be_valid_address(address):
+            address = Address(seed=address).address
+        for node in get_node_addresses(opt):
+            try:
+                for index, tx in scan(node, address):
+                    print("block %d:\n%s\n" % (index, tx))
+                break
+            except requests.ConnectionError:
+                continue
+        else:
+            print("Could not connect to any node")
+    elif cmd == "verify":
+        opt, remaining = getopt.getopt(sys.argv[2:], "t:")
+        opt = multidict(opt)
+        assert len(remaining) == 1, "one argument required: transaction id"
+        for node in get_node_addresses(opt):
+            try:
+                tx, index = verify(node, remaining[0])
+                print("Verified to be in block %d:\n%s" % (index, tx))
+                break
+            except requests.ConnectionError:
+                continue
+            except ValueError as e:
+                print("%s: %s" % (node, e))
+                break
+        else:
+            print("Could not connect to any node")
     elif cmd == "rnd":
         opt, remaining = getopt.getopt(sys.argv[2:], "n:s:t:")
         opt = multidict(opt)
         n = int(opt.get("-n", 1))
         max_seed = int(opt.get("-s", 100))
+        txs = []
         for i in range(n):
             seed_from = str(randrange(max_seed))
             seed_to = str(randrange(max_seed))
@@ -139,7 +433,33 @@ if __name__ == "__main__":
                   % (seed_from, seed_to)
             tx = Transaction(source.address, dest.address, amount, fee, msg)
             tx.sign(source)
-            send(tx, get_node_addresses(opt))
+            txs.append(tx)
+        send(txs, get_node_addresses(opt))
+    elif cmd == "load":
+        opt, remaining = getopt.getopt(sys.argv[2:], "n:r:s:a:c:w:T:b:t:")
+        opt = multidict(opt)
+        nodes = running_nodes(get_node_addresses(opt))
+        if not nodes:
+            print("Could not connect to any node")
+            sys.exit(1)
+        n = int(opt.get("-n", 1000))
+        rate = float(opt.get("-r", 100))
+        start = time.time()
+        txs = presign(n, int(opt.get("-s", 100)),
+                      float(opt.get("-a", 0.001)),
+                      int(opt.get("-w", os.cpu_count())))
+        print("Signed %d transactions in %.1fs" % (n, time.time() - start))
+        accepted, confirmed, failures, duration = load(
+            txs, nodes, rate, int(opt.get("-c", 16)),
+            float(opt.get("-T", 300)), int(opt.get("-b", 1)))
+        print("Pushed %d transactions to %s in %.1fs (%.1f per second): "
+              "%d accepted, %d rejected, %d failed" %
+              (n, ", ".join(nodes), duration, n / duration, len(accepted),
+               failures["rejected"], failures["failed"]))
+        print_percentiles("accept latency (s)", accepted)
+        print_percentiles("confirmation latency (s)", confirmed)
+        print("%d of %d accepted transactions confirmed" %
+              (len(confirmed), len(accepted)))
     else:
         print("Command '%s' not recognized" % cmd)
         sys.exit()
@@ -1,8 +1,10 @@
 import socket
+import requests
 from dateutil import tz, parser
 import sys
 import pdb
 import os
+from collections import OrderedDict
 
 # class ForkablePdb(pdb.Pdb):
 #     """A Pdb subclass that may be used
@@ -49,6 +51,26 @@ def multidict(items):
             ret[k] = v
     return ret
 
+def conditional_get(url, etag=None, **kwargs):
+    """requests.get(url, **kwargs), with an If-None-Match header if the
+    ETag of an earlier response is given, so that the server can answer
+    with 304 (Not Modified) and no body if the resource didn't change."""
+    if etag is not None:
+        kwargs["headers"] = dict(kwargs.get("headers") or {},
+                                 **{"If-None-Match": etag})
+    return requests.get(url, **kwargs)
+
+def percentiles(values):
+    """The median, 90th and 99th percentile and the maximum of the values
+    (None if there are none)"""
+    values = sorted(values)
+    def percentile(p):
+        return values[min(len(values) - 1, int(p * len(values)))] \
+            if values else None
+    return OrderedDict([("p50", percentile(0.5)), ("p90", percentile(0.9)),
+                        ("p99", percentile(0.99)),
+                        ("max", values[-1] if values else None)])
+
 def port_is_free(port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try: